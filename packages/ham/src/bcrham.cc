@@ -8,6 +8,9 @@
 #include <ctime>
 #include <fstream>
 #include <cfenv>
+#include <sstream>
+#include <unistd.h>
+#include <fcntl.h>
 
 #include "dphandler.h"
 #include "bcrutils.h"
@@ -22,35 +25,140 @@ using namespace std;
 
 // ----------------------------------------------------------------------------------------
 vector<vector<Sequence> > GetSeqs(Args &args, Track *trk);
+void run_job(Args &args, HMMHolder &hmms, GermLines &gl, Track *trk, clock_t run_start);
 void run_algorithm(HMMHolder &hmms, GermLines &gl, vector<vector<Sequence> > &qry_seq_list, Args &args);
+int run_server();
+bool redirect_output(string outfname, string errfname);
 
 // ----------------------------------------------------------------------------------------
 int main(int argc, const char * argv[]) {
+  if(argc == 2 && string(argv[1]) == "--server")  // persistent worker that reads jobs from stdin (see run_server())
+    return run_server();
+
   clock_t run_start(clock());
   Args args(argc, argv);
-  srand(args.random_seed());
 
   // init some infrastructure
   vector<string> characters {"A", "C", "G", "T"};
   Track track("NUKES", characters, args.ambig_base());
   GermLines gl(args.datadir(), args.locus());
   HMMHolder hmms(args.hmmdir(), gl, &track);
-  vector<vector<Sequence> > qry_seq_list(GetSeqs(args, &track));
+  run_job(args, hmms, gl, &track, run_start);
+  return 0;
+}
+
+// ----------------------------------------------------------------------------------------
+void run_job(Args &args, HMMHolder &hmms, GermLines &gl, Track *trk, clock_t run_start) {
+  srand(args.random_seed());
+  vector<vector<Sequence> > qry_seq_list(GetSeqs(args, trk));
 
   if(args.cache_naive_seqs()) {
-    Glomerator glom(hmms, gl, qry_seq_list, &args, &track);
+    Glomerator glom(hmms, gl, qry_seq_list, &args, trk);
     glom.CacheNaiveSeqs();
   } else if(args.partition()) {  // NOTE this is kind of hackey -- there's some code duplication between Glomerator and the loop below... but only a little, and they're doing fairly different things, so screw it for the time being
-    Glomerator glom(hmms, gl, qry_seq_list, &args, &track);
+    Glomerator glom(hmms, gl, qry_seq_list, &args, trk);
     glom.Cluster();
   } else {
     run_algorithm(hmms, gl, qry_seq_list, args);
   }
 
   printf("        time: bcrham %.1f\n", ((clock() - run_start) / (double)CLOCKS_PER_SEC));
+}
+
+// ----------------------------------------------------------------------------------------
+// Run as a persistent worker: each line on stdin is a job of the form '<stdout file> <stderr file> <usual bcrham arguments>'.
+// The germlines and hmms stay in memory between jobs (as long as consecutive jobs use the same ones), and after each job we write 'done <status>' to the original stdout.
+int run_server() {
+  FILE *reply(fdopen(dup(STDOUT_FILENO), "w"));  // each job's output goes to its own files, so replies need their own copy of the original stdout
+  if(reply == nullptr)
+    throw runtime_error("couldn't open reply stream in bcrham server\n");
+  vector<string> characters {"A", "C", "G", "T"};
+  Track *track(nullptr);
+  GermLines *gl(nullptr);
+  HMMHolder *hmms(nullptr);
+  string resource_key;  // hmm dir, germline dir, locus, and ambiguous base for which we currently have things loaded
+
+  string line;
+  while(getline(cin, line)) {
+    stringstream ss(line);
+    vector<string> words;
+    string word;
+    while(ss >> word)
+      words.push_back(word);
+    if(words.size() == 0)
+      continue;
+
+    int status(0);
+    if(words.size() < 3 || !redirect_output(words[0], words[1])) {
+      status = 1;
+    } else {
+      try {
+        clock_t run_start(clock());
+        vector<const char*> job_argv {"bcrham"};
+        for(size_t iw = 2; iw < words.size(); ++iw)
+          job_argv.push_back(words[iw].c_str());
+        Args args(job_argv.size(), job_argv.data());
+        string key(args.hmmdir() + " " + args.datadir() + " " + args.locus() + " " + args.ambig_base());
+        if(key != resource_key) {
+          delete hmms;  // the hmms hold references to the germlines and track, so they have to go first
+          delete gl;
+          delete track;
+          track = new Track("NUKES", characters, args.ambig_base());
+          gl = new GermLines(args.datadir(), args.locus());
+          hmms = new HMMHolder(args.hmmdir(), *gl, track);
+          resource_key = key;
+        }
+        run_job(args, *hmms, *gl, track, run_start);
+      } catch(exception &e) {
+        cerr << "ERROR: " << e.what() << endl;
+        status = 1;
+        delete hmms;  // a failed job may leave the hmms in a weird state (e.g. with rescaled mute freqs), so reload everything for the next one
+        delete gl;
+        delete track;
+        hmms = nullptr;
+        gl = nullptr;
+        track = nullptr;
+        resource_key = "";
+      }
+    }
+
+    cout.flush();
+    fflush(stdout);
+    cerr.flush();
+    fflush(stderr);
+    fprintf(reply, "done %d\n", status);
+    fflush(reply);
+  }
+
+  delete hmms;
+  delete gl;
+  delete track;
+  fclose(reply);
   return 0;
 }
 
+// ----------------------------------------------------------------------------------------
+// point stdout and stderr at new files (for the next job in run_server())
+bool redirect_output(string outfname, string errfname) {
+  cout.flush();
+  fflush(stdout);
+  cerr.flush();
+  fflush(stderr);
+  int outfd(open(outfname.c_str(), O_WRONLY | O_CREAT | O_TRUNC, 0644));
+  if(outfd < 0)
+    return false;
+  int errfd(open(errfname.c_str(), O_WRONLY | O_CREAT | O_TRUNC, 0644));
+  if(errfd < 0) {
+    close(outfd);
+    return false;
+  }
+  dup2(outfd, STDOUT_FILENO);
+  dup2(errfd, STDERR_FILENO);
+  close(outfd);
+  close(errfd);
+  return true;
+}
+
 // ----------------------------------------------------------------------------------------
 // read input sequences from file and return as vector of sequences
 vector<vector<Sequence> > GetSeqs(Args &args, Track *trk) {
@@ -6,7 +6,6 @@ import sys
 import os
 import operator
 from subprocess import check_call
-import scipy
 import glob
 import numpy
 
@@ -321,15 +320,6 @@ class AlleleFinder(object):
                 self.counts[gene][igl][n_mutes]['muted'] += 1  # mark that we saw this germline position mutated once in a sequence with <n_mutes> regional mutation frequency
             self.counts[gene][igl][n_mutes][query_seq[ipos]] += 1  # if there's a new allele, we need this to work out what the snp'd base is
 
-    # ----------------------------------------------------------------------------------------
-    def get_residual_sum(self, xvals, yvals, errs, slope, intercept, debug=False):
-        def expected(x):
-            return slope * x + intercept
-        residuals = [(y - expected(x))**2 / err**2 for x, y, err in zip(xvals, yvals, errs)]
-        if debug:
-            print 'resid: ' + ' '.join(['%5.3f' % r for r in residuals])
-        return sum(residuals)
-
     # ----------------------------------------------------------------------------------------
     def dbgstr(self, fitfo, extra_str='', pvals=None):
         return_strs = []
@@ -378,57 +368,107 @@ class AlleleFinder(object):
         return True
 
     # ----------------------------------------------------------------------------------------
-    def get_scipy_results(self, fixed_y_icpt, linefunc, n_mutelist, freqs, errs, bounds, fitfo):
-        params, cov = scipy.optimize.curve_fit(linefunc, n_mutelist, freqs, sigma=errs, bounds=bounds)
-        self.n_fits += 1
-
-        def retrieve(param):
-            iparam = self.param_order.index(param)
-            cov_err = math.sqrt(cov[iparam][iparam])
-            if self.cov_err_ok(cov_err, errs):
-                err = cov_err
+    def get_wls_results(self, fixed_y_icpt, xvals, freqs, errs, y_icpt_bounds):
+        """
+        Closed-form weighted least squares line fits for each row in <freqs> and <errs> (all rows share <xvals>), with slope restricted to <self.default_slope_bounds>, and
+        y-icpt either fixed to, or restricted to, the corresponding row of <y_icpt_bounds>.
+        Chi-square is quadratic in the parameters, so if the unconstrained minimum is outside the bounds the constrained one is on an edge, where it's a one-parameter fit.
+        Variances are scaled by chi-square / ndof, as in scipy's curve_fit() with absolute_sigma=False.
+        """
+        weights = 1. / errs**2
+        S, Sx, Sxx = weights.sum(axis=1), (weights * xvals).sum(axis=1), (weights * xvals**2).sum(axis=1)
+        Sy, Sxy = (weights * freqs).sum(axis=1), (weights * freqs * xvals).sum(axis=1)
+        slope_lo, slope_hi = self.default_slope_bounds
+        y_icpt_lo, y_icpt_hi = y_icpt_bounds[:, 0], y_icpt_bounds[:, 1]
+
+        def chisq(slopes, y_icpts):
+            return (weights * (freqs - slopes[:, None] * xvals - y_icpts[:, None])**2).sum(axis=1)
+        def slope_for_y_icpt(y_icpts):
+            return numpy.clip((Sxy - y_icpts * Sx) / Sxx, slope_lo, slope_hi)
+        def y_icpt_for_slope(slopes):
+            return numpy.clip((Sy - slopes * Sx) / S, y_icpt_lo, y_icpt_hi)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):  # degenerate x values give infinite variances, same as curve_fit()
+            if fixed_y_icpt:
+                y_icpts = y_icpt_lo
+                slopes = slope_for_y_icpt(y_icpts)
+                slope_vars, y_icpt_vars = 1. / Sxx, numpy.zeros(len(S))
+                ndof = len(xvals) - 1
             else:
-                err = self.hack_err(param, errs, n_mutelist)
-            return params[iparam], err
-
-        fitfo['slope'], fitfo['slope_err'] = retrieve('slope')
-        if not fixed_y_icpt:
-            fitfo['y_icpt'], fitfo['y_icpt_err'] = retrieve('y_icpt')
+                det = S * Sxx - Sx**2
+                slopes = (S * Sxy - Sx * Sy) / det
+                y_icpts = (Sxx * Sy - Sx * Sxy) / det
+                out_of_bounds = (slopes < slope_lo) | (slopes > slope_hi) | (y_icpts < y_icpt_lo) | (y_icpts > y_icpt_hi)
+                if out_of_bounds.any():
+                    edge_slopes = numpy.array([slope_for_y_icpt(y_icpt_lo), slope_for_y_icpt(y_icpt_hi), numpy.full(len(S), slope_lo), numpy.full(len(S), slope_hi)])
+                    edge_y_icpts = numpy.array([y_icpt_lo, y_icpt_hi, y_icpt_for_slope(edge_slopes[2]), y_icpt_for_slope(edge_slopes[3])])
+                    ibest = numpy.argmin([chisq(s, y) for s, y in zip(edge_slopes, edge_y_icpts)], axis=0)
+                    irows = numpy.arange(len(S))
+                    slopes = numpy.where(out_of_bounds, edge_slopes[ibest, irows], slopes)
+                    y_icpts = numpy.where(out_of_bounds, edge_y_icpts[ibest, irows], y_icpts)
+                slope_vars, y_icpt_vars = S / det, Sxx / det
+                ndof = len(xvals) - 2
+
+        residual_sums = chisq(slopes, y_icpts)
+        scale = residual_sums / ndof
+        return slopes, y_icpts, slope_vars * scale, y_icpt_vars * scale, residual_sums
 
     # ----------------------------------------------------------------------------------------
-    def get_curvefit(self, pvals, y_icpt_bounds, debug=False):
-        n_mutelist, freqs, errs = self.get_tmp_fitvals(pvals)  # this is probably kind of slow
-        if y_icpt_bounds[0] == y_icpt_bounds[1]:  # fixed y-icpt
-            fitfo = self.default_fitfo(n_mutelist, freqs, errs, ndof=len(n_mutelist) - 1, y_icpt_bounds=y_icpt_bounds)
-            fitfo['y_icpt'] = y_icpt_bounds[0]
-            if fitfo['ndof'] > 0:
-                def linefunc(x, slope):
-                    return slope*x + fitfo['y_icpt']
-                bounds = self.default_slope_bounds
-                self.get_scipy_results(True, linefunc, n_mutelist, freqs, errs, bounds, fitfo)  # modifies <fitfo>
-            elif fitfo['ndof'] == 0:
-                fitfo = self.approx_fit_vals(pvals, fixed_y_icpt=fitfo['y_icpt'], debug=debug)
-        else:  # floating y-icpt
-            fitfo = self.default_fitfo(n_mutelist, freqs, errs, ndof=len(n_mutelist) - 2, y_icpt_bounds=y_icpt_bounds)
+    def get_curvefits(self, pvals_list, y_icpt_bounds_list, dbgs=None):
+        """ fit a line to each entry in <pvals_list>, doing all the fits with the same x values and type of y-icpt bounds at once """
+        if dbgs is None:
+            dbgs = [False for _ in pvals_list]
+        fitfos = []
+        fit_groups = {}
+        for ifit, (pvals, y_icpt_bounds) in enumerate(zip(pvals_list, y_icpt_bounds_list)):
+            n_mutelist, freqs, errs = self.get_tmp_fitvals(pvals)
+            fixed_y_icpt = y_icpt_bounds[0] == y_icpt_bounds[1]
+            fitfo = self.default_fitfo(n_mutelist, freqs, errs, ndof=len(n_mutelist) - (1 if fixed_y_icpt else 2), y_icpt_bounds=y_icpt_bounds)
+            if fixed_y_icpt:
+                fitfo['y_icpt'] = y_icpt_bounds[0]
             if fitfo['ndof'] > 0:
-                def linefunc(x, slope, y_icpt):
-                    return slope*x + y_icpt
-                bounds = [[s, y] for s, y in zip(self.default_slope_bounds, y_icpt_bounds)]
-                self.get_scipy_results(False, linefunc, n_mutelist, freqs, errs, bounds, fitfo)  # modifies <fitfo>
-            elif fitfo['ndof'] == 0:
-                fitfo = self.approx_fit_vals(pvals, fixed_y_icpt=None, debug=debug)
-
-        if fitfo['ndof'] > 0:
-            fitfo['residual_sum'] = self.get_residual_sum(n_mutelist, freqs, errs, fitfo['slope'], fitfo['y_icpt'])
-            fitfo['residuals_over_ndof'] = float(fitfo['residual_sum']) / fitfo['ndof']
-        else:
-            fitfo['residual_sum'] = 1.
-            fitfo['residuals_over_ndof'] = 0.
+                key = (tuple(n_mutelist), fixed_y_icpt)
+                if key not in fit_groups:
+                    fit_groups[key] = []
+                fit_groups[key].append(ifit)
+            else:
+                if fitfo['ndof'] == 0:
+                    fitfo = self.approx_fit_vals(pvals, fixed_y_icpt=(fitfo['y_icpt'] if fixed_y_icpt else None), debug=dbgs[ifit])
+                fitfo['residual_sum'] = 1.
+                fitfo['residuals_over_ndof'] = 0.
+            fitfos.append(fitfo)
+
+        for (n_mutelist, fixed_y_icpt), ifits in fit_groups.items():
+            slopes, y_icpts, slope_vars, y_icpt_vars, residual_sums = self.get_wls_results(fixed_y_icpt,
+                                                                                           numpy.array(n_mutelist, dtype=float),
+                                                                                           numpy.array([fitfos[i]['yvals'] for i in ifits], dtype=float),
+                                                                                           numpy.array([fitfos[i]['errs'] for i in ifits], dtype=float),
+                                                                                           numpy.array([fitfos[i]['y_icpt_bounds'] for i in ifits], dtype=float))
+            self.n_fits += len(ifits)
+            for irow, ifit in enumerate(ifits):
+                fitfo = fitfos[ifit]
+                paramfos = [('slope', slopes, slope_vars)]
+                if not fixed_y_icpt:
+                    paramfos.append(('y_icpt', y_icpts, y_icpt_vars))
+                for param, vals, variances in paramfos:
+                    fitfo[param] = float(vals[irow])
+                    cov_err = math.sqrt(variances[irow])
+                    if self.cov_err_ok(cov_err, fitfo['errs']):
+                        fitfo[param + '_err'] = cov_err
+                    else:
+                        fitfo[param + '_err'] = self.hack_err(param, fitfo['errs'], fitfo['xvals'])
+                fitfo['residual_sum'] = float(residual_sums[irow])
+                fitfo['residuals_over_ndof'] = fitfo['residual_sum'] / fitfo['ndof']
+
+        for fitfo, dbg in zip(fitfos, dbgs):
+            if dbg:
+                print self.dbgstr(fitfo, extra_str='fit', pvals={'n_mutelist' : fitfo['xvals'], 'freqs' : fitfo['yvals'], 'errs': fitfo['errs']})  # not necessarily the same as <pvals>
 
-        if debug:
-            print self.dbgstr(fitfo, extra_str='fit', pvals={'n_mutelist' : n_mutelist, 'freqs' : freqs, 'errs': errs})  # not necessarily the same as <pvals>
+        return fitfos
 
-        return fitfo
+    # ----------------------------------------------------------------------------------------
+    def get_curvefit(self, pvals, y_icpt_bounds, debug=False):
+        return self.get_curvefits([pvals], [y_icpt_bounds], dbgs=[debug])[0]
 
     # ----------------------------------------------------------------------------------------
     def get_reweights(self, gene, position, debug=False):
@@ -699,50 +739,54 @@ class AlleleFinder(object):
         return istart_freq - last_freq > self.big_discontinuity_factor(istart) * joint_freq_err
 
     # ----------------------------------------------------------------------------------------
-    def fit_position(self, gene, istart, pos, prevals, postvals, bothvals, candidate_ratios, residfo, debug=False):
+    def returnfcn(self, label, dbg):
+        if dbg:
+            print label
+            return False  # keep going (don't skip it) if it's a dbg pos/istart
+        else:
+            return True
+
+    # ----------------------------------------------------------------------------------------
+    def prefilter_position(self, gene, istart, pos, prevals, postvals, bothvals, big_y_icpt_bounds):  # return True if it's worth fitting <pos> (also fills in the entry for <pos> in <big_y_icpt_bounds>)
         dbg = self.dbgfcn(pos, istart)
         if dbg:
             print 'pos %d' % pos
         big_y_icpt, big_y_icpt_err = self.get_big_y(postvals)
-        big_y_icpt_bounds = self.get_big_y_icpt_bounds(big_y_icpt, big_y_icpt_err)  # (big_y_icpt - 1.5*big_y_icpt_err, big_y_icpt + 1.5*big_y_icpt_err)  # we want the bounds to be lenient enough to accomodate non-zero slopes (in the future, we could do something cleverer like extrapolating with the slope of the line to x=0)
+        big_y_icpt_bounds[pos] = self.get_big_y_icpt_bounds(big_y_icpt, big_y_icpt_err)  # (big_y_icpt - 1.5*big_y_icpt_err, big_y_icpt + 1.5*big_y_icpt_err)  # we want the bounds to be lenient enough to accomodate non-zero slopes (in the future, we could do something cleverer like extrapolating with the slope of the line to x=0)
 
         def returnfcn(label):
-            if dbg:
-                print label
-                return False  # keep going (don't skip it) if it's a dbg pos/istart
-            else:
-                return True
+            return self.returnfcn(label, dbg)
 
         # need to have enough mutated counts in the <istart>th bin (this is particularly important (partly) because it's the handle that tells us it's *this* <istart> that's correct, rather than <istart> + 1)
         if self.counts[gene][pos][istart]['muted'] < self.n_muted_min_per_bin:
             if returnfcn('only %d muted in <istart>th bin' % self.counts[gene][pos][istart]['muted']):
-                return
+                return False
 
         if sum(postvals['obs']) < self.n_muted_min or sum(postvals['total']) < self.n_total_min:
             if returnfcn('too few overall post-counts'):
-                return
+                return False
 
         # skip if the discontinuity is less than <factor> sigma, or if hardly any entries at i-1 and the bin totals are closer than <factor> sigma (not actualy OR, but basically)
         if not self.big_discontinuity(bothvals, istart, debug=dbg):
             if returnfcn('no big dicontinuity'):
-                return
+                return False
 
         if istart <= self.hard_code_three:
             # if the bounds include zero, there won't be much difference between the two fits
-            if big_y_icpt_bounds[0] <= 0.:
-                if returnfcn('big-y-icpt lower bound %f <= 0.' % big_y_icpt_bounds[0]):
-                    return
+            if big_y_icpt_bounds[pos][0] <= 0.:
+                if returnfcn('big-y-icpt lower bound %f <= 0.' % big_y_icpt_bounds[pos][0]):
+                    return False
 
             # if a rough estimate of the y-icpt is less than zero, the zero-icpt fit is probably going to be pretty good
             approx_fitfo = self.approx_fit_vals(postvals)
             if approx_fitfo['y_icpt'] < 0.:
                 if returnfcn('approx post fit y-icpt %f < 0' % approx_fitfo['y_icpt']):
-                    return
+                    return False
 
         # if there's only two points in <prevals>, we can't use the bad fit there to tell us this isn't a candidate, so we check and skip if the <istart - 1>th freq isn't really low
         if istart == 2 and bothvals['freqs'][istart - 1] > big_y_icpt - 1.5 * big_y_icpt_err:  # TODO wait isn't this the same as lower bound?
             if returnfcn('complicated istart = 2 special case'):
-                return
+                return False
 
         # approximate pre-slope should be smaller than approximate post-slope (for smaller <istart>s, post-slope tends to be flat, so you can't require this)
         if istart >= self.hard_code_five:
@@ -750,17 +794,17 @@ class AlleleFinder(object):
             post_approx = self.approx_fit_vals(postvals)
             if not self.consistent(pre_approx['slope'], pre_approx['slope_err'], post_approx['slope'], post_approx['slope_err'], dbgstr='slope', debug=dbg) and pre_approx['slope'] > post_approx['slope']:
                 if returnfcn('pre approx slope bigger than post approx slope'):
-                    return
+                    return False
 
-        onefit = self.get_curvefit(bothvals, y_icpt_bounds=(0., 0.), debug=dbg)
+        return True
 
-        # don't bother with the two-piece fit if the one-piece fit is pretty good
-        if onefit['residuals_over_ndof'] < self.min_bad_fit_residual:
-            if returnfcn('one-piece fit is pretty good %f' % onefit['residuals_over_ndof']):
-                return
+    # ----------------------------------------------------------------------------------------
+    def evaluate_position_fits(self, gene, istart, pos, bothvals, onefit, prefit, postfit, candidate_ratios, residfo):
+        dbg = self.dbgfcn(pos, istart)
+
+        def returnfcn(label):
+            return self.returnfcn(label, dbg)
 
-        prefit = self.get_curvefit(prevals, y_icpt_bounds=(0., 0.), debug=dbg)
-        postfit = self.get_curvefit(postvals, y_icpt_bounds=big_y_icpt_bounds, debug=dbg)
         twofit_residuals = prefit['residuals_over_ndof'] * prefit['ndof'] + postfit['residuals_over_ndof'] * postfit['ndof']
         twofit_ndof = prefit['ndof'] + postfit['ndof']
         twofit_residuals_over_ndof = twofit_residuals / twofit_ndof
@@ -828,8 +872,24 @@ class AlleleFinder(object):
     def fit_istart(self, gene, istart, positions_to_try_to_fit, debug=False):
         bothxyvals, prexyvals, postxyvals = self.get_both_pre_post_vals(gene, istart, positions_to_try_to_fit)
         ratios, residfo = {}, {}
-        for pos in positions_to_try_to_fit:
-            self.fit_position(gene, istart, pos, prexyvals[pos], postxyvals[pos], bothxyvals[pos], ratios, residfo, debug=debug)
+
+        # the fits for all positions that make it to each step get done at once
+        big_y_icpt_bounds = {}
+        positions = [pos for pos in positions_to_try_to_fit if self.prefilter_position(gene, istart, pos, prexyvals[pos], postxyvals[pos], bothxyvals[pos], big_y_icpt_bounds)]
+        dbgs = [self.dbgfcn(pos, istart) for pos in positions]
+        onefits = dict(zip(positions, self.get_curvefits([bothxyvals[pos] for pos in positions], [(0., 0.) for _ in positions], dbgs=dbgs)))
+
+        # don't bother with the two-piece fit if the one-piece fit is pretty good
+        for pos in list(positions):
+            if onefits[pos]['residuals_over_ndof'] < self.min_bad_fit_residual:
+                if self.returnfcn('one-piece fit is pretty good %f' % onefits[pos]['residuals_over_ndof'], self.dbgfcn(pos, istart)):
+                    positions.remove(pos)
+        dbgs = [self.dbgfcn(pos, istart) for pos in positions]
+        prefits = self.get_curvefits([prexyvals[pos] for pos in positions], [(0., 0.) for _ in positions], dbgs=dbgs)
+        postfits = self.get_curvefits([postxyvals[pos] for pos in positions], [big_y_icpt_bounds[pos] for pos in positions], dbgs=dbgs)
+
+        for pos, prefit, postfit in zip(positions, prefits, postfits):
+            self.evaluate_position_fits(gene, istart, pos, bothxyvals[pos], onefits[pos], prefit, postfit, ratios, residfo)
         sorted_positions = sorted(ratios, key=lambda p: ratios[p], reverse=True)  # sort the candidate positions in decreasing order of residual ratio
         sorted_positions = sorted_positions[ : len(sorted_positions) - len(sorted_positions) % istart]  # remove any extra positions
         if len(sorted_positions) >= 2 * istart:  # if there's more than one candidate allele, sorted such that similar positions are together, and maybe we'll get the combinations right
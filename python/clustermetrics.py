@@ -0,0 +1,221 @@
+import numpy
+from scipy.special import gammaln
+
+# NOTE this module shouldn't import utils, since utils imports it
+
+# ----------------------------------------------------------------------------------------
+def add_uids(uid_indices, partition):
+    """ add any uids in <partition> that aren't already in <uid_indices> (a map from uid to integer index) """
+    for cluster in partition:
+        for uid in cluster:
+            if uid not in uid_indices:
+                uid_indices[uid] = len(uid_indices)
+
+# ----------------------------------------------------------------------------------------
+def get_entries(partition, uid_indices):
+    """ return arrays with the uid index and cluster index of each entry (i.e. each occurrence of a uid) in <partition> """
+    entry_uids = numpy.array([uid_indices[uid] for cluster in partition for uid in cluster], dtype=numpy.int64)
+    entry_clusters = numpy.repeat(numpy.arange(len(partition), dtype=numpy.int64), [len(cluster) for cluster in partition])
+    return entry_uids, entry_clusters
+
+# ----------------------------------------------------------------------------------------
+def count_pairs(keys):
+    """ return sorted unique values in <keys>, and the number of times each occurs """
+    if len(keys) == 0:
+        return numpy.array([], dtype=numpy.int64), numpy.array([], dtype=numpy.int64)
+    return numpy.unique(keys, return_counts=True)
+
+# ----------------------------------------------------------------------------------------
+def lookup_counts(unique_keys, counts, query_keys):
+    """ return the count for each key in <query_keys> (zero for keys that don't appear in <unique_keys>) """
+    query_keys = numpy.asarray(query_keys, dtype=numpy.int64)
+    if len(unique_keys) == 0:
+        return numpy.zeros(len(query_keys), dtype=numpy.int64)
+    indices = numpy.minimum(numpy.searchsorted(unique_keys, query_keys), len(unique_keys) - 1)
+    return numpy.where(unique_keys[indices] == query_keys, counts[indices], 0)
+
+# ----------------------------------------------------------------------------------------
+def get_overlap_counts(uids_a, clusters_a, uids_b, clusters_b, n_uids, n_clusters_b):
+    """
+    For each entry in a, and for each *distinct* b cluster that contains that entry's uid, increment the count for the pair (a cluster, b cluster).
+    I.e. entries in a are counted with multiplicity, but membership in b is a yes/no thing.
+    Returns sorted keys (a cluster index * <n_clusters_b> + b cluster index) and the corresponding counts.
+    """
+    b_pairs = numpy.unique(uids_b * n_clusters_b + clusters_b)  # distinct (uid, b cluster) pairs, sorted by uid
+    b_pair_uids, b_pair_clusters = b_pairs // n_clusters_b, b_pairs % n_clusters_b
+    n_b_clusters_per_uid = numpy.bincount(b_pair_uids, minlength=n_uids)
+    first_b_pair = numpy.cumsum(n_b_clusters_per_uid) - n_b_clusters_per_uid  # index in <b_pairs> of each uid's first pair
+
+    reps = n_b_clusters_per_uid[uids_a]  # number of (distinct) b clusters containing each a entry's uid (almost always one)
+    offsets = numpy.repeat(first_b_pair[uids_a] - numpy.cumsum(reps) + reps, reps) + numpy.arange(reps.sum())  # indices in <b_pairs> for each expanded a entry
+    return count_pairs(numpy.repeat(clusters_a, reps) * n_clusters_b + b_pair_clusters[offsets])
+
+# ----------------------------------------------------------------------------------------
+def ccfs(partition, true_partition, reco_ids, seed_unique_id=None):
+    """
+    Vectorized version of the per-sequence ccfs (see utils.new_ccfs_that_need_better_names()).
+    <reco_ids> is a map from uid to reco id for (at least) every uid in <partition>.
+    If <true_partition> is None, it's taken to be the groups of entries in <partition> with the same reco id (i.e. what utils.get_true_partition() would give).
+    """
+    uid_indices = {}
+    add_uids(uid_indices, partition)
+    if true_partition is not None:
+        add_uids(uid_indices, true_partition)
+    n_uids = len(uid_indices)
+    inf_uids, inf_clusters = get_entries(partition, uid_indices)
+
+    reco_indices = {}  # map from reco id to integer index
+    reco_labels = numpy.array([reco_indices.setdefault(reco_ids[uid], len(reco_indices)) for cluster in partition for uid in cluster], dtype=numpy.int64)  # reco label for each entry in <partition>
+    uid_reco_labels = numpy.zeros(n_uids, dtype=numpy.int64)
+    uid_reco_labels[inf_uids] = reco_labels
+
+    if true_partition is None:
+        true_uids, true_clusters = inf_uids, reco_labels
+    else:
+        true_uids, true_clusters = get_entries(true_partition, uid_indices)
+
+    query_uids, query_true_clusters = true_uids, true_clusters  # the uids over which we average (with multiplicity)
+    if seed_unique_id is not None:  # only look at the seed's entries in the true partition
+        is_seed = true_uids == uid_indices.get(seed_unique_id, -1)
+        query_uids, query_true_clusters = true_uids[is_seed], true_clusters[is_seed]
+    n_queries = len(query_uids)
+    if n_queries > 1e6:
+        raise Exception('you should start worrying about numerical precision if you\'re going to run on this many queries')
+
+    n_inf_clusters = max(1, len(partition))
+    distinct_inf_pairs = numpy.unique(inf_uids * n_inf_clusters + inf_clusters)
+    n_clusters_per_uid = numpy.bincount(distinct_inf_pairs // n_inf_clusters, minlength=n_uids)
+    for iuid in numpy.unique(query_uids[n_clusters_per_uid[query_uids] > 1]):
+        uid = [u for u, i in uid_indices.items() if i == iuid][0]
+        for _ in range((query_uids == iuid).sum()):
+            print 'WARNING %s in multiple clusters' % uid
+    unique_uids, first_entries = numpy.unique(inf_uids, return_index=True)
+    first_clusters = numpy.zeros(n_uids, dtype=numpy.int64)  # index of the first cluster in <partition> in which each uid appears (we only look at that one)
+    first_clusters[unique_uids] = inf_clusters[first_entries]
+    query_inf_clusters = first_clusters[query_uids]
+
+    # clonal fraction: fraction of each query's inferred cluster with the same reco id
+    n_reco = max(1, len(reco_indices))
+    clonal_keys, clonal_counts = count_pairs(inf_clusters * n_reco + reco_labels)
+    n_clonal = lookup_counts(clonal_keys, clonal_counts, query_inf_clusters * n_reco + uid_reco_labels[query_uids])
+    inf_cluster_sizes = numpy.bincount(inf_clusters, minlength=len(partition))
+    clonal_fractions = n_clonal.astype(float) / inf_cluster_sizes[query_inf_clusters]
+
+    # fraction present: fraction of each query's true cluster that appears in its inferred cluster
+    overlap_keys, overlap_counts = get_overlap_counts(true_uids, true_clusters, inf_uids, inf_clusters, n_uids, n_inf_clusters)
+    n_present = lookup_counts(overlap_keys, overlap_counts, query_true_clusters * n_inf_clusters + query_inf_clusters)
+    true_cluster_sizes = numpy.bincount(true_clusters)
+    fractions_present = n_present.astype(float) / true_cluster_sizes[query_true_clusters]
+
+    return float(clonal_fractions.sum()) / n_queries, float(fractions_present.sum()) / n_queries
+
+# ----------------------------------------------------------------------------------------
+def get_cluster_labels(part_a, part_b):
+    """
+    Return arrays with, for each entry in <part_a>, the index of its cluster in <part_a> and the index of the first cluster in <part_b> that contains it.
+    Raises an exception if the two partitions don't have the same uids.
+    """
+    uid_indices = {}
+    add_uids(uid_indices, part_a)
+    n_uids_a = len(uid_indices)
+    add_uids(uid_indices, part_b)
+    if len(uid_indices) > n_uids_a:
+        raise Exception('couldn\'t find %s in partition a' % ' '.join(sorted([uid for uid, i in uid_indices.items() if i >= n_uids_a])))
+    uids_a, labels_a = get_entries(part_a, uid_indices)
+    uids_b, clusters_b = get_entries(part_b, uid_indices)
+
+    unique_uids, first_entries = numpy.unique(uids_b, return_index=True)
+    if len(unique_uids) < n_uids_a:
+        missing = set(range(n_uids_a)) - set(unique_uids.tolist())
+        raise Exception('couldn\'t find %s in partition b' % ' '.join(sorted([uid for uid, i in uid_indices.items() if i in missing])))
+    first_clusters = numpy.zeros(n_uids_a, dtype=numpy.int64)
+    first_clusters[unique_uids] = clusters_b[first_entries]
+    return labels_a, first_clusters[uids_a]
+
+# ----------------------------------------------------------------------------------------
+def contingency(labels_a, labels_b):
+    """ return sparse contingency table for two label arrays, as arrays of (row index, column index, count) for each nonzero entry """
+    n_b = int(labels_b.max()) + 1 if len(labels_b) > 0 else 1
+    keys, counts = count_pairs(labels_a * n_b + labels_b)
+    return keys // n_b, keys % n_b, counts
+
+# ----------------------------------------------------------------------------------------
+def entropy(labels):
+    sizes = numpy.bincount(labels)
+    sizes = sizes[sizes > 0].astype(float)
+    n_tot = sizes.sum()
+    return -numpy.sum((sizes / n_tot) * (numpy.log(sizes) - numpy.log(n_tot)))
+
+# ----------------------------------------------------------------------------------------
+def mutual_information(labels_a, labels_b):
+    irows, icols, nij = contingency(labels_a, labels_b)
+    row_sums = numpy.bincount(irows, weights=nij)
+    col_sums = numpy.bincount(icols, weights=nij)
+    n_tot = float(nij.sum())
+    pij = nij / n_tot
+    log_outer = -numpy.log(row_sums[irows] * col_sums[icols]) + 2 * numpy.log(n_tot)
+    return numpy.sum(pij * (numpy.log(nij) - numpy.log(n_tot)) + pij * log_outer)
+
+# ----------------------------------------------------------------------------------------
+def expected_mutual_information(sizes_a, sizes_b, n_tot):
+    """ expected mutual information between two random partitions with cluster sizes <sizes_a> and <sizes_b> (it only depends on the sizes, so we loop over distinct sizes rather than clusters) """
+    usizes_a, mults_a = numpy.unique(sizes_a, return_counts=True)
+    usizes_b, mults_b = numpy.unique(sizes_b, return_counts=True)
+    gln_n = gammaln(n_tot + 1)
+    emi = 0.
+    for a, mult_a in zip(usizes_a.tolist(), mults_a.tolist()):  # for each distinct size in a, vectorize over all distinct sizes in b and all possible intersection sizes nij
+        starts = numpy.maximum(1, a + usizes_b - n_tot)
+        ends = numpy.minimum(a, usizes_b) + 1
+        lengths = numpy.maximum(0, ends - starts)
+        b = numpy.repeat(usizes_b, lengths).astype(float)
+        weights = mult_a * numpy.repeat(mults_b, lengths)
+        nij = (numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths) + numpy.repeat(starts, lengths)).astype(float)
+        term2 = numpy.log(n_tot) + numpy.log(nij) - numpy.log(a) - numpy.log(b)
+        gln = gammaln(a + 1) + gammaln(b + 1) + gammaln(n_tot - a + 1) + gammaln(n_tot - b + 1) - gln_n - gammaln(nij + 1) - gammaln(a - nij + 1) - gammaln(b - nij + 1) - gammaln(n_tot - a - b + nij + 1)
+        emi += numpy.sum(weights * (nij / n_tot) * term2 * numpy.exp(gln))
+    return emi
+
+# ----------------------------------------------------------------------------------------
+def adjusted_mutual_information(partition_a, partition_b):
+    """ same as (older versions of) sklearn.metrics.cluster.adjusted_mutual_info_score(), i.e. normalized by the max of the two entropies """
+    labels_a, labels_b = [numpy.unique(labels, return_inverse=True)[1] for labels in get_cluster_labels(partition_a, partition_b)]  # relabel so there's no empty clusters
+    n_a, n_b = len(numpy.unique(labels_a)), len(numpy.unique(labels_b))
+    if (n_a == n_b == 1) or (n_a == n_b == 0):
+        return 1.0
+    mi = mutual_information(labels_a, labels_b)
+    emi = expected_mutual_information(numpy.bincount(labels_a), numpy.bincount(labels_b), len(labels_a))
+    h_a, h_b = entropy(labels_a), entropy(labels_b)
+    return float((mi - emi) / (max(h_a, h_b) - emi))
+
+# ----------------------------------------------------------------------------------------
+def adjusted_rand_index(partition_a, partition_b):
+    """ same as sklearn.metrics.cluster.adjusted_rand_score() """
+    def n_pairs(vals):
+        vals = vals.astype(float)
+        return numpy.sum(vals * (vals - 1) / 2.)
+    labels_a, labels_b = get_cluster_labels(partition_a, partition_b)
+    n_tot = len(labels_a)
+    n_a, n_b = len(numpy.unique(labels_a)), len(numpy.unique(labels_b))
+    if (n_a == n_b == 1) or (n_a == n_b == 0) or (n_a == n_b == n_tot):
+        return 1.0
+    _, _, nij = contingency(labels_a, labels_b)
+    sum_comb = n_pairs(nij)
+    sum_comb_a = n_pairs(numpy.bincount(labels_a))
+    sum_comb_b = n_pairs(numpy.bincount(labels_b))
+    expected_index = sum_comb_a * sum_comb_b / (n_tot * (n_tot - 1) / 2.)
+    max_index = (sum_comb_a + sum_comb_b) / 2.
+    return float((sum_comb - expected_index) / (max_index - expected_index))
+
+# ----------------------------------------------------------------------------------------
+def intersection_matrix(clusters_a, clusters_b):
+    """ return 2d array whose ij^th entry is the number of uids in the i^th cluster in <clusters_a> that are also in the j^th cluster in <clusters_b> """
+    uid_indices = {}
+    add_uids(uid_indices, clusters_a)
+    add_uids(uid_indices, clusters_b)
+    uids_a, iclusts_a = get_entries(clusters_a, uid_indices)
+    uids_b, iclusts_b = get_entries(clusters_b, uid_indices)
+    n_b = max(1, len(clusters_b))
+    keys, counts = get_overlap_counts(uids_a, iclusts_a, uids_b, iclusts_b, len(uid_indices), n_b)
+    imatrix = numpy.zeros((len(clusters_a), len(clusters_b)), dtype=numpy.int64)
+    imatrix[keys // n_b, keys % n_b] = counts
+    return imatrix
@@ -2,8 +2,86 @@ import os
 import sys
 import math
 import csv
+import numpy
 
 import utils
+import clustermetrics
+
+# ----------------------------------------------------------------------------------------
+class PartitionList(object):
+    """
+    Acts like a list of partitions (each a list of lists of uids), but stores each partition as an int32 array of cluster indices, where each distinct
+    cluster is stored only once (as the bytes of an int32 array of indices into a single uid table). Consecutive partitions in a path share all but a
+    few of their clusters, so each step only costs four bytes per cluster plus whichever clusters changed. Cluster and uid order are preserved.
+    NOTE each partition you get back is a new list, so modifying it in place does *not* change the stored partition -- assign it back (partitions[ipart] = partition) instead.
+    """
+    def __init__(self):
+        self.uids = []  # uid index : uid
+        self.uid_indices = {}  # uid : uid index
+        self.clusters = []  # cluster index : bytes of int32 array of uid indices
+        self.cluster_indices = {}  # bytes of int32 array of uid indices : cluster index
+        self.encoded_partitions = []  # int32 array of cluster indices for each partition
+        self.cached_partition = (None, None)  # most recently decoded (index, partition), since callers tend to ask for the same one (usually the best) over and over
+
+    # ----------------------------------------------------------------------------------------
+    def encode_cluster(self, cluster):
+        for uid in cluster:
+            if uid not in self.uid_indices:
+                self.uid_indices[uid] = len(self.uids)
+                self.uids.append(uid)
+        key = numpy.array([self.uid_indices[uid] for uid in cluster], dtype=numpy.int32).tostring()
+        if key not in self.cluster_indices:
+            self.cluster_indices[key] = len(self.clusters)
+            self.clusters.append(key)
+        return self.cluster_indices[key]
+
+    # ----------------------------------------------------------------------------------------
+    def decode_cluster(self, icluster):
+        return [self.uids[iuid] for iuid in numpy.frombuffer(self.clusters[icluster], dtype=numpy.int32).tolist()]
+
+    # ----------------------------------------------------------------------------------------
+    def append(self, partition):
+        self.encoded_partitions.append(numpy.array([self.encode_cluster(cluster) for cluster in partition], dtype=numpy.int32))
+
+    # ----------------------------------------------------------------------------------------
+    def pop(self, ipart):
+        partition = self[ipart]
+        self.encoded_partitions.pop(ipart)
+        self.cached_partition = (None, None)
+        return partition
+
+    # ----------------------------------------------------------------------------------------
+    def n_clusters(self, ipart):  # doesn't need to decode the partition
+        return len(self.encoded_partitions[ipart])
+
+    # ----------------------------------------------------------------------------------------
+    def get_partition_str(self, ipart, cluster_strs):  # csv-style string for the <ipart>th partition (<cluster_strs> caches the string for each cluster, since they're shared between partitions)
+        for icluster in self.encoded_partitions[ipart].tolist():
+            if icluster not in cluster_strs:
+                cluster_strs[icluster] = ':'.join(self.decode_cluster(icluster))
+        return ';'.join([cluster_strs[icluster] for icluster in self.encoded_partitions[ipart].tolist()])
+
+    # ----------------------------------------------------------------------------------------
+    def __getitem__(self, ipart):
+        if ipart < 0:
+            ipart += len(self.encoded_partitions)
+        if self.cached_partition[0] != ipart:
+            self.cached_partition = (ipart, [self.decode_cluster(icluster) for icluster in self.encoded_partitions[ipart].tolist()])
+        return [list(cluster) for cluster in self.cached_partition[1]]  # copy, so the caller can't modify the cached one
+
+    # ----------------------------------------------------------------------------------------
+    def __setitem__(self, ipart, partition):
+        self.encoded_partitions[ipart] = numpy.array([self.encode_cluster(cluster) for cluster in partition], dtype=numpy.int32)
+        self.cached_partition = (None, None)
+
+    # ----------------------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.encoded_partitions)
+
+    # ----------------------------------------------------------------------------------------
+    def __iter__(self):
+        for ipart in range(len(self.encoded_partitions)):
+            yield self[ipart]
 
 # ----------------------------------------------------------------------------------------
 class ClusterPath(object):
@@ -12,7 +90,7 @@ class ClusterPath(object):
         self.initial_path_index = initial_path_index  # NOTE this is set to None if it's nonsensical, e.g. if we're merging several paths with different indices
 
         # NOTE make *damn* sure if you add another list here that you also take care of it in remove_first_partition()
-        self.partitions = []  # it would of course be damn nice to glomph these into a class at some point
+        self.partitions = PartitionList()  # it would of course be damn nice to glomph these into a class at some point (well, at least the partitions themselves are now in one)
         self.logprobs = []
         self.n_procs = []
         self.ccfs = []  # pair of floats (not just a float) for each partition
@@ -59,7 +137,7 @@ class ClusterPath(object):
         if ccfs is None:
             ccfs = [None, None]
         # NOTE you typically want to allow duplicate (in terms of log prob) partitions, since they can have different n procs
-        self.partitions.append(partition)  # NOTE not deep copied
+        self.partitions.append(partition)  # NOTE gets encoded, so later modifications to <partition> aren't reflected in the path (use self.partitions[ip] = <partition> to replace one)
         self.logprobs.append(logprob)
         self.n_procs.append(n_procs)
         self.logweights.append(logweight)
@@ -100,7 +178,7 @@ class ClusterPath(object):
                 lines = [line for line in reader]  # not sure that I really need this step
             self.readlines(lines, process_csv=True)
         elif utils.getsuffix(fname) == '.yaml':
-            utils.read_yaml_output(fname, cpath=self)
+            utils.read_yaml_output(fname, cpath=self, skip_annotations=True)
         else:
             raise Exception('unhandled annotation file suffix %s' % outfname)
 
@@ -115,8 +193,9 @@ class ClusterPath(object):
                 if line['seed_unique_id'] != self.seed_unique_id:
                     print '%s seed uids for each line not all the same %s %s' % (utils.color('yellow', 'warning'), line['seed_unique_id'], self.seed_unique_id)
 
+            partition = line['partition']
             if process_csv:
-                line['partition'] = [cluster_str.split(':') for cluster_str in line['partition'].split(';')]
+                partition = [cluster_str.split(':') for cluster_str in partition.split(';')]
 
             ccfs = [None, None]
             if 'ccf_under' in line and 'ccf_over' in line:  # I don't know what I want to do if there's one but not the other, but it shouldn't be possible
@@ -124,10 +203,11 @@ class ClusterPath(object):
                     ccfs = [float(line['ccf_under']), float(line['ccf_over'])]
                 self.we_have_a_ccf = True
 
-            self.add_partition(line['partition'], float(line['logprob']), int(line.get('n_procs', 1)), logweight=float(line.get('logweight', 0)), ccfs=ccfs)
+            self.add_partition(partition, float(line['logprob']), int(line.get('n_procs', 1)), logweight=float(line.get('logweight', 0)), ccfs=ccfs)
 
     # ----------------------------------------------------------------------------------------
     def calculate_missing_values(self, reco_info, only_ip=None):
+        reco_ids = {}  # uid : reco id, shared between partitions (most uids are in all of them)
         for ip in range(len(self.partitions)):
             if only_ip is not None and ip != only_ip:
                 continue
@@ -135,8 +215,12 @@ class ClusterPath(object):
             if self.ccfs[ip][0] is not None and self.ccfs[ip][1] is not None:  # already have them
                 continue
 
-            true_partition = utils.get_true_partition(reco_info, ids=[uid for cluster in self.partitions[ip] for uid in cluster])
-            self.ccfs[ip] = utils.new_ccfs_that_need_better_names(self.partitions[ip], true_partition, reco_info, seed_unique_id=self.seed_unique_id)
+            partition = self.partitions[ip]
+            for cluster in partition:
+                for uid in cluster:
+                    if uid not in reco_ids:
+                        reco_ids[uid] = reco_info[uid]['reco_id']
+            self.ccfs[ip] = clustermetrics.ccfs(partition, None, reco_ids, seed_unique_id=self.seed_unique_id)  # None for true partition means use the reco id groups of the uids in this partition (i.e. what utils.get_true_partition() would give)
             self.we_have_a_ccf = True
 
     # ----------------------------------------------------------------------------------------
@@ -161,7 +245,7 @@ class ClusterPath(object):
             delta_str = '%.1f' % (self.logprobs[ip] - self.logprobs[ip-1])
         else:
             delta_str = ''
-        print '      %s  %-12.2f%-7s   %-5d  %4d' % (extrastr, self.logprobs[ip], delta_str, len(self.partitions[ip]), self.n_procs[ip]),
+        print '      %s  %-12.2f%-7s   %-5d  %4d' % (extrastr, self.logprobs[ip], delta_str, self.partitions.n_clusters(ip), self.n_procs[ip]),
 
         print '    ' + self.get_ccf_str(ip),
 
@@ -236,13 +320,14 @@ class ClusterPath(object):
         """ Return the parent clusters that were merged to form the <ipart>th partition. """
         if ipart == 0:
             raise Exception('get_parent_clusters got ipart of zero... that don\'t make no sense yo')
-        if len(self.partitions[ipart - 1]) <= len(self.partitions[ipart]):
+        if self.partitions.n_clusters(ipart - 1) <= self.partitions.n_clusters(ipart):
             return None  # this step isn't a merging step -- it's a synthetic rewinding step due to multiple processes
 
         parents = []
-        for cluster in self.partitions[ipart - 1]:  # find all clusters in the previous partition that aren't in the current one
-            if cluster not in self.partitions[ipart]:
-                parents.append(cluster)
+        current_clusters = set(self.partitions.encoded_partitions[ipart].tolist())  # compare cluster indices rather than decoded clusters
+        for icluster in self.partitions.encoded_partitions[ipart - 1].tolist():  # find all clusters in the previous partition that aren't in the current one
+            if icluster not in current_clusters:
+                parents.append(self.partitions.decode_cluster(icluster))
         assert len(parents) == 2  # there should've been two -- those're the two that were merged to form the new cluster
         return parents
 
@@ -271,31 +356,31 @@ class ClusterPath(object):
         if utils.getsuffix(outfname) != '.csv':
             raise Exception('unhandled file extension %s' % outfname)
         if partition_lines is None:
-            partition_lines = self.get_partition_lines(is_data, reco_info=reco_info, true_partition=true_partition, n_to_write=n_to_write, calc_missing_values=calc_missing_values)
+            partition_lines = self.get_partition_lines(is_data, reco_info=reco_info, true_partition=true_partition, n_to_write=n_to_write, calc_missing_values=calc_missing_values, partition_strs=True)
         with open(outfname, 'w') as outfile:
             writer = csv.DictWriter(outfile, self.get_headers(is_data))
             writer.writeheader()
             for row in partition_lines:
-                row['partition'] = ';'.join([':'.join(cluster) for cluster in row['partition']])
+                if not isinstance(row['partition'], basestring):
+                    row['partition'] = ';'.join([':'.join(cluster) for cluster in row['partition']])
                 if 'bad_clusters' in row:
                     row['bad_clusters'] = ';'.join(row['bad_clusters'])
                 writer.writerow(row)
 
     # ----------------------------------------------------------------------------------------
-    def get_partition_lines(self, is_data, reco_info=None, true_partition=None, n_to_write=None, calc_missing_values='none', path_index=None):
+    def get_partition_lines(self, is_data, reco_info=None, true_partition=None, n_to_write=None, calc_missing_values='none', path_index=None, partition_strs=False):  # if <partition_strs>, encode partitions directly to csv-style strings
         assert calc_missing_values in ['none', 'all', 'best']
         if reco_info is not None and calc_missing_values == 'all':
             self.calculate_missing_values(reco_info)
 
         headers = self.get_headers(is_data)
         lines = []
+        cluster_strs = {}
         for ipart in self.get_surrounding_partitions(n_partitions=n_to_write):
-            part = self.partitions[ipart]
-
             row = {'logprob' : self.logprobs[ipart],
-                   'n_clusters' : len(part),
+                   'n_clusters' : self.partitions.n_clusters(ipart),
                    'n_procs' : self.n_procs[ipart],
-                   'partition' : part}
+                   'partition' : self.partitions.get_partition_str(ipart, cluster_strs) if partition_strs else self.partitions[ipart]}
             if 'ccf_under' in headers:
                 if reco_info is not None and calc_missing_values == 'best' and ipart == self.i_best:
                     self.calculate_missing_values(reco_info, only_ip=ipart)
@@ -304,7 +389,7 @@ class ClusterPath(object):
             if 'n_true_clusters' in headers:
                 row['n_true_clusters'] = len(true_partition)
             if 'bad_clusters' in headers:
-                row['bad_clusters'] = self.get_bad_clusters(part, reco_info, true_partition)
+                row['bad_clusters'] = self.get_bad_clusters(self.partitions[ipart], reco_info, true_partition)
             if 'path_index' in headers:
                 row['path_index'] = path_index
                 row['logweight'] = self.logweights[ipart]
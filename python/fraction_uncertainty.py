@@ -1,46 +1,84 @@
-import cached_uncertainties
+import numpy
 from scipy.stats import beta
+try:
+    import cached_uncertainties  # precomputed values (not needed any more, now that err_list() calculates everything at once, but might as well use them if they're there)
+except ImportError:
+    cached_uncertainties = None
+
+vol = 2./3  # +/- 1 sigma
+cpr = 1.  # constant prior
+memo = {}  # (obs, total) : (lo, hi) for each pair that err_list() has already calculated
+
+# ----------------------------------------------------------------------------------------
+def calculate_errs(obs, total):
+    """ return arrays of lower and upper uncertainties on the ratios <obs> / <total> (which should be arrays with total > 0) """
+    obs, total = numpy.asarray(obs, dtype=float), numpy.asarray(total, dtype=float)
+    def call_ppf(lower_tail_prob, eff_obs, total):
+        return beta.ppf(lower_tail_prob, cpr + eff_obs, cpr + total - eff_obs)
+
+    frac = obs / total
+    zero = obs == 0
+    eff_obs = numpy.where(zero, 1., obs)  # for obs of 0, take the width from obs of 1
+    eff_lo = call_ppf((1. - vol)/2, eff_obs, total)
+    eff_hi = call_ppf((1. + vol)/2, eff_obs, total)
+    lo = numpy.where(zero, 0., eff_lo)
+    hi = numpy.where(zero, eff_hi - eff_lo, eff_hi)
+
+    one_sided = ~zero & (frac < lo)  # one-sided c.i. with 2/3 (0.95) the mass (probably doesn't happen much any more, now that obs == 0 is handled separately
+    if one_sided.any():
+        lo[one_sided] = 0.
+        hi[one_sided] = call_ppf(vol, obs[one_sided], total[one_sided])
+
+    high = frac > hi  # same deal if obs/total very large (probably one)
+    if high.any():
+        lo[high] = call_ppf(1. - vol, obs[high], total[high])  # I would imagine that this, also, needs to be changed (same as 0) but I don't want to do it right now
+        hi[high] = 1.
+
+    assert ((lo < frac) | (frac == 0.)).all()
+    assert ((frac < hi) | (frac == 1.)).all()
+    return lo, hi
+
+# ----------------------------------------------------------------------------------------
+def err_list(obs_list, total_list):
+    """ Return list of uncertainties (lo, hi) on the ratios obs / total for each pair in <obs_list> and <total_list>, calculating all the ones we haven't already seen in one (vectorized) call """
+    pairs = zip(obs_list, total_list)
+    for obs, total in pairs:
+        assert obs <= total
+        assert obs >= 0
+        assert total >= 0
+
+    new_pairs = set()
+    for pair in pairs:
+        if pair in memo or pair[1] == 0:
+            continue
+        if cached_uncertainties is not None:
+            key = str(pair[0]) + '/' + str(pair[1])
+            if key in cached_uncertainties.errs:
+                memo[pair] = cached_uncertainties.errs[key]
+                continue
+        new_pairs.add(pair)
+
+    if len(new_pairs) > 0:
+        new_pairs = sorted(new_pairs)
+        los, his = calculate_errs([o for o, _ in new_pairs], [t for _, t in new_pairs])
+        for pair, lo, hi in zip(new_pairs, los, his):
+            memo[pair] = (float(lo), float(hi))
+
+    return [memo[pair] if pair[1] != 0 else (0.0, 0.0) for pair in pairs]
 
 # ----------------------------------------------------------------------------------------
 def err(obs, total, use_cache=True):
     """ Return uncertainty on the ratio obs / total """
+    if use_cache:
+        return err_list([obs], [total])[0]
+
     assert obs <= total
     assert obs >= 0
     assert total >= 0
-
     if total == 0.0:
         return (0.0, 0.0)
-
-    key = str(obs) + '/' + str(total)
-    if use_cache and key in cached_uncertainties.errs:
-        return cached_uncertainties.errs[key]
-
-    frac = float(obs) / total
-    vol = 2./3  # +/- 1 sigma
-    cpr = 1.  # constant prior
-    def call_ppf(lower_tail_prob, eff_obs, total):
-        return beta.ppf(lower_tail_prob, cpr + eff_obs, cpr + total - eff_obs)
-
-    if obs == 0:
-        lo = 0.
-        eff_lo = call_ppf((1. - vol)/2, 1, total)  # take the width from obs of 1
-        eff_hi = call_ppf((1. + vol)/2, 1, total)
-        hi = eff_hi - eff_lo
-    else:
-        lo = call_ppf((1. - vol)/2, obs, total)
-        if frac < lo:
-            lo = 0.
-            hi = call_ppf(vol, obs, total)  # one-sided c.i. with 2/3 (0.95) the mass (probably doesn't happen much any more, now that obs == 0 is handled separately
-        else:
-            hi = call_ppf((1. + vol)/2, obs, total)
-
-    if frac > hi:  # same deal if obs/total very large (probably one)
-        lo = call_ppf(1. - vol, obs, total)  # I would imagine that this, also, needs to be changed (same as 0) but I don't want to do it right now
-        hi = 1.
-
-    assert lo < frac or frac == 0.0
-    assert frac < hi or frac == 1.0
-    return (lo, hi)
+    los, his = calculate_errs([obs], [total])
+    return (float(los[0]), float(his[0]))
 
 # ----------------------------------------------------------------------------------------
 def chk():  # check current version output against cached values
@@ -1,9 +1,10 @@
-import itertools
 import os
 import sys
 import math
 import csv
 import time
+import numpy
+import heapq
 
 import utils
 from clusterpath import ClusterPath
@@ -27,49 +28,62 @@ class Glomerator(object):
         if debug:
             print '  max %d per cluster' % max_per_cluster
 
-        distances = {}  # cache the calculated fractional hamming distances
-
-        # ----------------------------------------------------------------------------------------
-        def get_clusters_to_merge():
-            smallest_min_distance, clusters_to_merge = None, None
-            n_skipped = 0
-            for clust_a, clust_b in itertools.combinations(clusters, 2):  # find the two clusters which contain the pair of sequences which are closest in hamming fraction (skipping cluster pairs that would make a cluster that's too big)
-                if len(clust_a) + len(clust_b) > max_per_cluster and not glomerate.merge_whatever_you_got:  # merged cluster would be too big, so look for smaller (albeit further-apart) things to merge
-                    n_skipped += 1
+        # single-linkage agglomeration using a priority queue of cluster pairs (rather than rescanning all pairs for every merge)
+        # NOTE ties are broken the same way as the original all-pairs scan, i.e. in order of each cluster's position in the list of clusters, which is the same as the order in which they were created
+        distances = utils.hamming_fraction_matrix(naive_seqs.values())  # fractional hamming distances between clusters (initially, between every pair of naive seqs), indexed by slot. When we merge two clusters, the merged cluster takes over the first one's slot
+        members = list(clusters)  # cluster in each slot (None once the slot's dead)
+        stamps = range(len(clusters))  # creation order of the cluster in each slot
+        next_stamp = len(clusters)
+        islots, jslots = numpy.triu_indices(len(clusters), k=1)
+        candidates = zip(distances[islots, jslots].tolist(), islots.tolist(), jslots.tolist(), islots.tolist(), jslots.tolist())  # (distance, stamp a, stamp b, slot a, slot b), where a was created before b
+        heapq.heapify(candidates)
+        too_big_candidates = []  # pairs we skipped because the merged cluster would be too big (which can't change, since clusters only get bigger)
+        merge_whatever_you_got = False  # merge the best pair, even if together they'll be to big
+        n_live_clusters = len(clusters)
+        while n_live_clusters > n_clusters:
+            if debug:
+                print '    current ', ' '.join([str(len(cl)) for cl in members if cl is not None])
+            clusters_to_merge = None
+            while len(candidates) > 0:
+                candfo = heapq.heappop(candidates)
+                _, stamp_a, stamp_b, islot, jslot = candfo
+                if stamps[islot] != stamp_a or stamps[jslot] != stamp_b:  # one or both of them has since been merged into something else
+                    continue
+                if len(members[islot]) + len(members[jslot]) > max_per_cluster and not merge_whatever_you_got:  # merged cluster would be too big, so look for smaller (albeit further-apart) things to merge
+                    too_big_candidates.append(candfo)
                     continue
-                min_distance = None  # find the smallest hamming distance between any two sequences in the two clusters
-                for query_a in clust_a:
-                    for query_b in clust_b:
-                        joint_key = query_a + ';' + query_b  #';'.join([query_a, query_b])
-                        if joint_key not in distances:
-                            distances[joint_key] = utils.hamming_fraction(naive_seqs[query_a], naive_seqs[query_b])
-                            distances[query_b + ';' + query_a] = distances[joint_key]  # also add with key in reverse order, in case we run into the pair that way later on
-                        if min_distance is None or distances[joint_key] < min_distance:
-                            min_distance = distances[joint_key]
-                if smallest_min_distance is None or min_distance < smallest_min_distance:
-                    smallest_min_distance = min_distance
-                    clusters_to_merge = (clust_a, clust_b)
-
-            if debug and n_skipped > 0:
-                print '      skipped: %d ' % n_skipped
-
-            return clusters_to_merge
+                clusters_to_merge = (islot, jslot)
+                break
 
-        # ----------------------------------------------------------------------------------------
-        def glomerate():
-            if debug:
-                print '    current ', ' '.join([str(len(cl)) for cl in clusters])
-            clusters_to_merge = get_clusters_to_merge()
             if clusters_to_merge is None:  # if we didn't find a suitable pair
                 if debug:
                     print '    didn\'t find shiznitz'
-                glomerate.merge_whatever_you_got = True  # next time through, merge whatever's best regardless of size
-            else:
-                if debug:
-                    print '    merging', len(clusters_to_merge[0]), len(clusters_to_merge[1])
-                clusters.append(clusters_to_merge[0] + clusters_to_merge[1])
-                clusters.remove(clusters_to_merge[0])
-                clusters.remove(clusters_to_merge[1])
+                if merge_whatever_you_got:  # shouldn't be able to happen, since there's always at least two clusters left
+                    raise Exception('ran out of clusters to merge')
+                merge_whatever_you_got = True  # next time through, merge whatever's best regardless of size
+                candidates = too_big_candidates
+                heapq.heapify(candidates)
+                too_big_candidates = []
+                continue
+
+            islot, jslot = clusters_to_merge
+            if debug:
+                print '    merging', len(members[islot]), len(members[jslot])
+            members[islot] = members[islot] + members[jslot]
+            members[jslot] = None
+            stamps[islot] = next_stamp
+            stamps[jslot] = None
+            new_distances = numpy.minimum(distances[islot], distances[jslot])  # single linkage
+            distances[islot, :] = new_distances
+            distances[:, islot] = new_distances
+            for kslot in range(len(members)):
+                if members[kslot] is None or kslot == islot:
+                    continue
+                heapq.heappush(candidates, (float(new_distances[kslot]), stamps[kslot], next_stamp, kslot, islot))
+            next_stamp += 1
+            n_live_clusters -= 1
+
+        clusters = [members[islot] for islot in sorted([i for i in range(len(members)) if members[i] is not None], key=lambda i: stamps[i])]
 
         # ----------------------------------------------------------------------------------------
         def homogenize():
@@ -88,13 +102,6 @@ class Glomerator(object):
             if debug:
                 print '    sorted ', ' '.join([str(len(cl)) for cl in clusters])
 
-        # ----------------------------------------------------------------------------------------
-        # da bizniz
-        glomerate.merge_whatever_you_got = False  # merge the best pair, even if together they'll be to big
-
-        while len(clusters) > n_clusters:
-            glomerate()
-        
         if len(clusters) > 1:  # homogenize if partition is non-trivial
             clusters.sort(key=len)
 
@@ -234,7 +241,7 @@ class Glomerator(object):
             if smc_particles > 1:
                 self.paths[ipath].set_synthetic_logweight_history(self.reco_info)
             if debug:
-                print '  merged path %d with %d glomeration steps and %d final clusters' % (ipath, len(self.paths[ipath].partitions), len(self.paths[ipath].partitions[-1]))
+                print '  merged path %d with %d glomeration steps and %d final clusters' % (ipath, len(self.paths[ipath].partitions), self.paths[ipath].partitions.n_clusters(-1))
                 self.paths[ipath].print_partitions(self.reco_info)
 
         if smc_particles == 1:  # XX: ...whereas if we're *not* doing smc, we have to add the previous histories *afterward*, since the previous histories are all in one piece
@@ -269,6 +276,7 @@ class Glomerator(object):
     # ----------------------------------------------------------------------------------------
     def read_cached_agglomeration(self, infnames, smc_particles=1, previous_info=None, debug=False):
         """ Read the partitions output by bcrham. If <all_partitions> is specified, add the info to it """
+        # NOTE <infnames> are the (small, per-proc) partition output files -- the hmm cache file (naive seqs and logprobs) is merged separately in PartitionDriver.merge_subprocess_files(), and read with the sqlite index in PartitionDriver.get_cached_hmm_naive_seqs()
         start = time.time()
         fileinfos = []
         for fname in infnames:
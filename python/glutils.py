@@ -9,6 +9,8 @@ import numpy
 import glob
 from collections import OrderedDict
 import csv
+import json
+import hashlib
 from subprocess import check_call, Popen, PIPE
 
 import utils
@@ -16,6 +18,8 @@ import indelutils
 
 # ----------------------------------------------------------------------------------------
 glfo_dir = 'germline-sets'  # always put germline info into a subdir with this name
+cached_glfo_dir_refcounts = {}  # content-hashed glfo dir : number of current users (see get_cached_glfo_dir())
+parsed_glfos = {}  # read_glfo() args plus file stats : glfo (so in-process rereads of an unchanged dir only cost a deepcopy)
 
 # setting defaults here so that bin/test-germline-inference.py and bin/partis don't have to both have defaults in them
 default_n_genes_per_region = '42:18:6'
@@ -509,6 +513,13 @@ def read_glfo(gldir, locus, only_genes=None, skip_pseudogenes=True, skip_orfs=Tr
         else:
             raise Exception('germline set directory \'%s\' does not exist (maybe --parameter-dir is corrupted, maybe crashed while writing parameters?)' % (gldir + '/' + locus))
 
+    memo_key = None
+    if template_glfo is None and not debug:  # can't (easily) key on <template_glfo>, and if we're debugging we want to see the output
+        file_stats = tuple((fn, st.st_ino, st.st_mtime, st.st_size) for fn in glfo_fnames(gldir, locus) if os.path.exists(fn) for st in [os.stat(fn)])  # so we notice if the files get rewritten
+        memo_key = (os.path.realpath(gldir), locus, None if only_genes is None else tuple(sorted(only_genes)), skip_pseudogenes, skip_orfs, remove_orfs, remove_bad_genes, file_stats)
+        if memo_key in parsed_glfos:
+            return copy.deepcopy(parsed_glfos[memo_key])  # callers modify their glfos all the time, so they each need their own copy
+
     if debug:
         print '  reading %s locus glfo from %s' % (locus, gldir)
     glfo = {'locus' : locus, 'functionalities' : {}}
@@ -549,6 +560,9 @@ def read_glfo(gldir, locus, only_genes=None, skip_pseudogenes=True, skip_orfs=Tr
                 print '   (%s)' % ' '.join([utils.color_gene(g) for g in sorted(orfs_removed['v'])]),
             print ''
 
+    if memo_key is not None:
+        parsed_glfos[memo_key] = copy.deepcopy(glfo)
+
     return glfo
 
 # ----------------------------------------------------------------------------------------
@@ -988,6 +1002,42 @@ def remove_glfo_files(gldir, locus):
     if len(os.listdir(gldir)) == 0:  # if there aren't any other locus dirs in here, remove the parent dir as well
         os.rmdir(gldir)
 
+# ----------------------------------------------------------------------------------------
+def get_glfo_hash(glfo):  # hash of everything in <glfo> that write_glfo() writes to disk
+    glstr = json.dumps({k : glfo[k] for k in ['locus', 'seqs'] + [c + '-positions' for c in utils.conserved_codons[glfo['locus']].values()]}, sort_keys=True)
+    return hashlib.md5(glstr).hexdigest()
+
+# ----------------------------------------------------------------------------------------
+def get_cached_glfo_dir(base_dir, glfo, debug=False):
+    """
+    Return a glfo dir (in <base_dir>) for <glfo> whose name is a hash of its contents, writing it only if we haven't already written this germline set.
+    Each call should be matched by a call to release_cached_glfo_dir(). Dirs stick around (for reuse) after their last user releases them, until remove_cached_glfo_dirs().
+    """
+    gldir = base_dir + '/' + get_glfo_hash(glfo)
+    if gldir not in cached_glfo_dir_refcounts or not os.path.exists(gldir + '/' + glfo['locus']):  # second clause is in case someone else removed it out from under us
+        write_glfo(gldir, glfo, debug=debug)
+        cached_glfo_dir_refcounts[gldir] = 0
+    elif debug:
+        print '  reusing cached glfo dir %s' % gldir
+    cached_glfo_dir_refcounts[gldir] += 1
+    return gldir
+
+# ----------------------------------------------------------------------------------------
+def release_cached_glfo_dir(gldir):
+    if cached_glfo_dir_refcounts.get(gldir, 0) < 1:
+        raise Exception('tried to release glfo dir %s that isn\'t in use' % gldir)
+    cached_glfo_dir_refcounts[gldir] -= 1
+
+# ----------------------------------------------------------------------------------------
+def remove_cached_glfo_dirs(base_dir, locus):  # remove all the (unused) cached glfo dirs in <base_dir>
+    for gldir in [d for d in cached_glfo_dir_refcounts if os.path.dirname(d) == base_dir]:
+        if cached_glfo_dir_refcounts[gldir] > 0:
+            raise Exception('glfo dir %s still has %d user%s' % (gldir, cached_glfo_dir_refcounts[gldir], utils.plural(cached_glfo_dir_refcounts[gldir])))
+        remove_glfo_files(gldir, locus)
+        del cached_glfo_dir_refcounts[gldir]
+    if os.path.exists(base_dir) and len(os.listdir(base_dir)) == 0:
+        os.rmdir(base_dir)
+
 # ----------------------------------------------------------------------------------------
 def get_alleles_per_gene_weights(n_alleles_per_gene):  # given desired mean alleles per gene, figure out the required probability for 1 and 2 alleles
     if n_alleles_per_gene == 1.:
@@ -201,6 +201,10 @@ class Hist(object):
             if debug:
                 print ib, self.bin_contents[ib], float(h2.bin_contents[ib])
             self.bin_contents[ib] += h2.bin_contents[ib]
+            if self.sum_weights_squared is not None and h2.sum_weights_squared is not None:
+                self.sum_weights_squared[ib] += h2.sum_weights_squared[ib]
+            if self.errors is not None and h2.errors is not None:
+                self.errors[ib] = math.sqrt(self.errors[ib]**2 + h2.errors[ib]**2)  # add in quadrature (for unweighted fills, same as if we'd filled one hist with everything)
 
     # ----------------------------------------------------------------------------------------
     def write(self, outfname):
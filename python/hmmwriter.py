@@ -9,6 +9,8 @@ import csv
 import time
 import copy
 import numpy
+import json
+import hashlib
 
 import utils
 import glutils
@@ -223,6 +225,97 @@ class HMM(object):
         state.check()
         self.states.append(state)
 
+fingerprint_fname = 'fingerprints.csv'  # in the hmm dir: hash of the inputs for each gene's yaml, so we only rewrite the ones whose inputs have changed
+parsed_parameter_csvs = {}  # (fname, file stats, gene column) : {gene : list of lines} (gene is None for files that don't have <gene column>), so each parameter csv is only parsed once for all genes (and, if it's filled before forking, for all processes)
+input_md5s = {}  # memoized md5s of (parts of) the input files (see get_hmm_fingerprint())
+
+# ----------------------------------------------------------------------------------------
+def get_file_key(fname):  # includes file stats so we notice if the file gets rewritten
+    fstat = os.stat(fname)
+    return (fname, fstat.st_ino, fstat.st_mtime, fstat.st_size)
+
+# ----------------------------------------------------------------------------------------
+def get_parameter_lines(fname, gene_column, genes):
+    """ Return the lines in parameter csv <fname> for <genes> (or all the lines, if it doesn't have a <gene_column>), and the md5 of those lines. """
+    key = (get_file_key(fname), gene_column)
+    if key not in parsed_parameter_csvs:
+        lines_by_gene = {}
+        with open(fname, 'r') as infile:
+            reader = csv.DictReader(infile)
+            has_gene_column = reader.fieldnames is not None and gene_column in reader.fieldnames
+            for line in reader:
+                lkey = line[gene_column] if has_gene_column else None
+                if lkey not in lines_by_gene:
+                    lines_by_gene[lkey] = []
+                lines_by_gene[lkey].append(line)
+        parsed_parameter_csvs[key] = lines_by_gene
+    lines_by_gene = parsed_parameter_csvs[key]
+    genekey = None if None in lines_by_gene else tuple(genes)
+    if genekey is None:
+        lines = lines_by_gene[None]
+    else:
+        lines = [l for g in genes for l in lines_by_gene.get(g, [])]
+    if (key, genekey) not in input_md5s:
+        input_md5s[(key, genekey)] = hashlib.md5(json.dumps(lines, sort_keys=True)).hexdigest()
+    return lines, input_md5s[(key, genekey)]
+
+# ----------------------------------------------------------------------------------------
+def get_file_md5(fname):
+    if not os.path.exists(fname):
+        return None
+    key = get_file_key(fname)
+    if key not in input_md5s:
+        with open(fname) as infile:
+            input_md5s[key] = hashlib.md5(infile.read()).hexdigest()
+    return input_md5s[key]
+
+# ----------------------------------------------------------------------------------------
+def clear_parameter_cache():
+    parsed_parameter_csvs.clear()
+    input_md5s.clear()
+
+# ----------------------------------------------------------------------------------------
+def get_insertions(region):
+    return {'v' : ['fv'], 'd' : ['vd'], 'j' : ['dj', 'jf']}[region]
+
+# ----------------------------------------------------------------------------------------
+def get_hmm_fingerprint(indir, gene, glfo, args):
+    """ Return a hash of everything that goes into <gene>'s hmm (i.e. that HmmWriter reads), so we can skip rewriting hmms whose inputs haven't changed. """
+    region = utils.get_region(gene)
+    source_fnames = [os.path.dirname(os.path.abspath(__file__)) + '/' + m + '.py' for m in ['hmmwriter', 'paramutils']]  # if the code changes, we need to rewrite everything
+    inputs = [get_file_md5(fn) for fn in source_fnames]
+    inputs += [gene, glfo['seqs'][region][gene], args.locus, args.min_observations_per_gene, args.no_per_base_mfreqs]
+    inputs += [glfo[c + '-positions'].get(gene) for _, c in sorted(utils.conserved_codons[args.locus].items())]
+    if region == 'v':  # fv insertion length depends on all the v genes' cysteine positions
+        inputs.append(sorted(glfo['cyst-positions'][g] for g in glfo['seqs']['v']))
+    elif region == 'j':  # ...and jf on all the j genes' tryp-to-end lengths
+        inputs.append(sorted(len(glfo['seqs']['j'][g]) - glfo['tryp-positions'][g] for g in glfo['seqs']['j']))
+    if gene != glutils.dummy_d_genes[args.locus]:
+        for column in [e + '_del' for e in utils.all_erosions if e[0] == region] + [i + '_insertion' for i in get_insertions(region)]:
+            inputs.append(get_parameter_lines(indir + '/' + utils.get_parameter_fname(column=column, deps=utils.column_dependencies[column]), region + '_gene', [gene])[1])
+        inputs += [get_file_md5(indir + '/' + i + '_insertion_content.csv') for i in get_insertions(region) if i in utils.boundaries]
+        inputs.append(get_file_md5(indir + '/mute-freqs/' + utils.sanitize_name(gene) + '.csv'))
+    inputs += [get_file_md5(indir + '/' + region + '_gene-probs.csv'), get_file_md5(indir + '/all-mean-mute-freqs.csv')]
+    return hashlib.md5(json.dumps(inputs)).hexdigest()
+
+# ----------------------------------------------------------------------------------------
+def read_fingerprints(hmm_dir):
+    fingerprints = {}
+    if os.path.exists(hmm_dir + '/' + fingerprint_fname):
+        with open(hmm_dir + '/' + fingerprint_fname) as ffile:
+            reader = csv.DictReader(ffile)
+            for line in reader:
+                fingerprints[line['gene']] = line['fingerprint']
+    return fingerprints
+
+# ----------------------------------------------------------------------------------------
+def write_fingerprints(hmm_dir, fingerprints):
+    with open(hmm_dir + '/' + fingerprint_fname, 'w') as ffile:
+        writer = csv.DictWriter(ffile, ['gene', 'fingerprint'])
+        writer.writeheader()
+        for gene in sorted(fingerprints):
+            writer.writerow({'gene' : gene, 'fingerprint' : fingerprints[gene]})
+
 # ----------------------------------------------------------------------------------------
 class HmmWriter(object):
     def __init__(self, base_indir, outdir, gene_name, glfo, args, debug=False):
@@ -256,14 +349,7 @@ class HmmWriter(object):
         self.outdir = outdir
         self.smallest_entry_index = -1  # keeps track of the first state that has a chance of being entered from init -- we want to start writing (with add_internal_state) from there
 
-        self.insertions = []
-        if self.region == 'v':
-            self.insertions.append('fv')
-        elif self.region == 'd':
-            self.insertions.append('vd')
-        elif self.region == 'j':
-            self.insertions.append('dj')
-            self.insertions.append('jf')
+        self.insertions = get_insertions(self.region)
 
         assert len(utils.ambiguous_bases) == 1 and utils.ambiguous_bases[0] == 'N'  # maybe need to update some stuff below if this changes
 
@@ -406,24 +492,20 @@ class HmmWriter(object):
                 eprobs[erosion][0] = 1.  # always erode zero bases
                 continue
             deps = utils.column_dependencies[erosion + '_del']
-            with open(self.indir + '/' + utils.get_parameter_fname(column=erosion + '_del', deps=deps), 'r') as infile:
-                reader = csv.DictReader(infile)
-                for line in reader:
-                    # first see if we want to use this line (if <region>_gene isn't in the line, this erosion doesn't depend on gene version)
-                    if self.region + '_gene' in line and line[self.region + '_gene'] not in approved_genes:  # NOTE you'll need to change this if you want it to depend on another region's genes
-                        continue
-                    # then skip nonsense erosions that're too long for this gene, but were ok for another
-                    if int(line[erosion + '_del']) >= len(self.germline_seq):
-                        continue
-
-                    # then add in this erosion's counts
-                    n_eroded = int(line[erosion + '_del'])
-                    if n_eroded not in eprobs[erosion]:
-                        eprobs[erosion][n_eroded] = 0.0
-                    eprobs[erosion][n_eroded] += float(line['count'])
-
-                    if self.region + '_gene' in line:
-                        genes_used.add(line[self.region + '_gene'])
+            lines, _ = get_parameter_lines(self.indir + '/' + utils.get_parameter_fname(column=erosion + '_del', deps=deps), self.region + '_gene', approved_genes)  # only the lines for <approved_genes>, if <region>_gene is in the file (otherwise this erosion doesn't depend on gene version) NOTE you'll need to change this if you want it to depend on another region's genes
+            for line in lines:
+                # skip nonsense erosions that're too long for this gene, but were ok for another
+                if int(line[erosion + '_del']) >= len(self.germline_seq):
+                    continue
+
+                # then add in this erosion's counts
+                n_eroded = int(line[erosion + '_del'])
+                if n_eroded not in eprobs[erosion]:
+                    eprobs[erosion][n_eroded] = 0.0
+                eprobs[erosion][n_eroded] += float(line['count'])
+
+                if self.region + '_gene' in line:
+                    genes_used.add(line[self.region + '_gene'])
 
             if len(eprobs[erosion]) == 0:
                 raise Exception('didn\'t read any %s erosion probs from %s' % (erosion, self.indir + '/' + utils.get_parameter_fname(column=erosion + '_del', deps=deps)))
@@ -472,22 +554,17 @@ class HmmWriter(object):
                 icontentprobs[insertion] = {n : 0.25 for n in utils.nukes}
                 continue
             deps = utils.column_dependencies[insertion + '_insertion']
-            with open(self.indir + '/' + utils.get_parameter_fname(column=insertion + '_insertion', deps=deps), 'r') as infile:
-                reader = csv.DictReader(infile)
-                for line in reader:
-                    # first see if we want to use this line (if <region>_gene isn't in the line, this erosion doesn't depend on gene version)
-                    if self.region + '_gene' in line and line[self.region + '_gene'] not in approved_genes:  # NOTE you'll need to change this if you want it to depend on another region's genes
-                        continue
-
-                    # then add in this insertion's counts
-                    n_inserted = 0
-                    n_inserted = int(line[insertion + '_insertion'])
-                    if n_inserted not in iprobs[insertion]:
-                        iprobs[insertion][n_inserted] = 0.0
-                    iprobs[insertion][n_inserted] += float(line['count'])
-
-                    if self.region + '_gene' in line:
-                        genes_used.add(line[self.region + '_gene'])
+            lines, _ = get_parameter_lines(self.indir + '/' + utils.get_parameter_fname(column=insertion + '_insertion', deps=deps), self.region + '_gene', approved_genes)  # only the lines for <approved_genes>, if <region>_gene is in the file (otherwise this insertion doesn't depend on gene version) NOTE you'll need to change this if you want it to depend on another region's genes
+            for line in lines:
+                # add in this insertion's counts
+                n_inserted = 0
+                n_inserted = int(line[insertion + '_insertion'])
+                if n_inserted not in iprobs[insertion]:
+                    iprobs[insertion][n_inserted] = 0.0
+                iprobs[insertion][n_inserted] += float(line['count'])
+
+                if self.region + '_gene' in line:
+                    genes_used.add(line[self.region + '_gene'])
 
             if len(iprobs[insertion]) == 0:
                 raise Exception('didn\'t read any %s insertion probs from %s' % (insertion, self.indir + '/' + utils.get_parameter_fname(column=insertion + '_insertion', deps=deps)))
@@ -252,7 +252,7 @@ def run_sklearn_mds(n_components, n_clusters, seqfos, seed, reco_info=None, regi
     # converted_seqs = [convert(x['seq']) for x in seqfos]
     # similarities = scipy.spatial.distance.pdist(converted_seqs, 'hamming')
     # similarities = scipy.spatial.distance.squareform(similarities)
-    similarities = scipy.spatial.distance.squareform([utils.hamming_fraction(seqfos[i]['seq'], seqfos[j]['seq']) for i in range(len(seqfos)) for j in range(i + 1, len(seqfos))])
+    similarities = utils.hamming_fraction_matrix([sfo['seq'] for sfo in seqfos])
 
     print '  mds'
     random_state = numpy.random.RandomState(seed=seed)
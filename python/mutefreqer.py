@@ -2,12 +2,25 @@ import sys
 import multiprocessing
 import csv
 import os
+import copy
+import numpy
 
 from hist import Hist
 import utils
 import glutils
 # import paramutils
 
+nuke_index_table = numpy.full(256, -2, dtype=numpy.int8)  # map from each (ascii) character to its index in utils.nukes, or -1 for ambiguous bases (-2 for anything else)
+nuke_index_table[[ord(n) for n in utils.nukes]] = range(len(utils.nukes))
+nuke_index_table[[ord(n) for n in utils.ambiguous_bases]] = -1
+
+# ----------------------------------------------------------------------------------------
+def get_nuke_indices(seq):
+    indices = nuke_index_table[numpy.frombuffer(str(seq), dtype=numpy.uint8)]
+    if (indices == -2).any():
+        raise Exception('unexpected character in sequence %s' % seq)
+    return indices
+
 # ----------------------------------------------------------------------------------------
 class MuteFreqer(object):
     def __init__(self, glfo, exclusions, calculate_uncertainty=True):
@@ -15,7 +28,8 @@ class MuteFreqer(object):
         self.exclusions = exclusions
         self.calculate_uncertainty = calculate_uncertainty
 
-        self.counts, self.freqs = {}, {}  # per-gene, per-position counts/rates
+        self.counts, self.freqs = {}, {}  # per-gene counts (array with a row for each germline position and a column for each of utils.nukes) and per-gene, per-position rates
+        self.gl_nukes = {}  # per-gene array with the index in utils.nukes of the germline base at each position (-1 if we haven't seen the position yet)
         self.n_bins, self.xmin, self.xmax = 40, 0., 0.4
         self.mean_rates = {n : Hist(self.n_bins, self.xmin, self.xmax, xtitle='mut freq', ytitle='freq', title='full seq' if n == 'all' else n.upper())
                            for n in ['all', 'cdr3'] + utils.regions}  # kind of annoying that it's 'all' here, but '' in plotconfig.rstrings (and therefore in performanceplotter) but it's too much trouble to change to '' here
@@ -26,7 +40,6 @@ class MuteFreqer(object):
         self.per_gene_mean_rates = {}
 
         self.finalized = False
-        self.n_cached, self.n_not_cached = 0, 0
 
         self.subplotdirs = ['overall', ] + ['per-gene/' + r for r in utils.regions] + ['per-gene-per-position/' + r for r in utils.regions]  # + ['per-gene-per-position-per-base/' + r for r in utils.regions]
 
@@ -52,12 +65,12 @@ class MuteFreqer(object):
             # then do per-gene and per-gene-per-position freqs
             gene = singlefo[region + '_gene']
             if gene not in self.counts:
-                self.counts[gene] = {}
+                gene_length = len(self.glfo['seqs'][region][gene])
+                self.counts[gene] = numpy.zeros((gene_length, len(utils.nukes)), dtype=numpy.int64)
+                self.gl_nukes[gene] = numpy.full(gene_length, -1, dtype=numpy.int8)
                 self.per_gene_mean_rates[gene] = Hist(self.n_bins, self.xmin, self.xmax, xtitle='mut freq', ytitle='freq', title=gene)
             self.per_gene_mean_rates[gene].fill(regional_freq)
 
-            gcts = self.counts[gene]  # shorthand name
-
             assert len(singlefo[region + '_qr_seqs']) == 1  # don't really need this anymore since we're using utils.synthesize_single_seq_line(), but it's nice to have some explicit check immediatley before using [0] below
             germline_seq = singlefo[region + '_gl_seq']
             query_seq = singlefo[region + '_qr_seqs'][0]
@@ -65,54 +78,71 @@ class MuteFreqer(object):
 
             istart = self.exclusions[region][0]
             istop = len(germline_seq) - self.exclusions[region][1]
-            for ipos in range(istart, istop):  # NOTE this is similar to the stuff in allelefinder, except in allelefinder we need every single sequence to be the same length (so they go in the correct [comparable?] bin), whereas here we do not
-                igl = ipos + int(singlefo[region + '_5p_del'])  # account for left-side deletions in the indexing
-
-                if germline_seq[ipos] in utils.ambiguous_bases or query_seq[ipos] in utils.ambiguous_bases:  # skip if either germline or query sequence is ambiguous at this position
-                    continue
-
-                if igl not in gcts:  # if we have not yet observed this position in a query sequence, initialize it
-                    gcts[igl] = {n : 0 for n in utils.nukes + ['total', ]}
-                    gcts[igl]['gl_nuke'] = germline_seq[ipos]
+            if istop <= istart:
+                continue
+            # NOTE this is similar to the stuff in allelefinder, except in allelefinder we need every single sequence to be the same length (so they go in the correct [comparable?] bin), whereas here we do not
+            gl_indices = get_nuke_indices(germline_seq[istart : istop])
+            qr_indices = get_nuke_indices(query_seq[istart : istop])
+            unambiguous = (gl_indices >= 0) & (qr_indices >= 0)  # skip positions at which either germline or query sequence is ambiguous
+            igls = numpy.arange(istart, istop)[unambiguous] + int(singlefo[region + '_5p_del'])  # account for left-side deletions in the indexing
+            self.counts[gene][igls, qr_indices[unambiguous]] += 1  # each position appears at most once, so we don't need numpy.add.at()
+            unset = self.gl_nukes[gene][igls] < 0
+            self.gl_nukes[gene][igls[unset]] = gl_indices[unambiguous][unset]
 
-                gcts[igl]['total'] += 1
-                gcts[igl][query_seq[ipos]] += 1  # note that if <query_seq[ipos]> isn't among <utils.nukes>, this will toss a key error
+    # ----------------------------------------------------------------------------------------
+    def merge(self, other):
+        """ add the counts from <other> (e.g. from a different process) to ours """
+        assert not self.finalized and not other.finalized
+        for gene in other.counts:
+            if gene not in self.counts:
+                self.counts[gene] = other.counts[gene].copy()
+                self.gl_nukes[gene] = other.gl_nukes[gene].copy()
+                self.per_gene_mean_rates[gene] = copy.deepcopy(other.per_gene_mean_rates[gene])
+                continue
+            self.counts[gene] += other.counts[gene]
+            unset = self.gl_nukes[gene] < 0
+            self.gl_nukes[gene][unset] = other.gl_nukes[gene][unset]
+            self.per_gene_mean_rates[gene].add(other.per_gene_mean_rates[gene])
+        for rstr in self.mean_rates:
+            self.mean_rates[rstr].add(other.mean_rates[rstr])
+            self.mean_n_muted[rstr].add(other.mean_n_muted[rstr])
 
     # ----------------------------------------------------------------------------------------
-    def get_uncertainty(self, obs, total):
+    def get_uncertainties(self, obs_list, total_list):  # list of (lo, hi) for each (obs, total) pair
+        if not self.calculate_uncertainty:  # it's kinda slow (well, it used to be, before we calculated them all at once)
+            return [(0., 1.) for _ in obs_list]
         import fraction_uncertainty
-        if self.calculate_uncertainty:  # it's kinda slow
-            errs = fraction_uncertainty.err(obs, total)
-            # if errs[2]:
-            #     self.n_cached += 1
-            # else:
-            #     self.n_not_cached += 1
-        else:
-            errs = 0., 1.
-
-        return errs[0], errs[1]
+        return fraction_uncertainty.err_list(obs_list, total_list)
 
     # ----------------------------------------------------------------------------------------
     def finalize(self):
         """ convert from counts to mut freqs """
         assert not self.finalized
 
+        # first collect the (obs, total) pair for each base (and for the overall mutation freq) at each position, so we can get all the uncertainties at once
+        obs_list, total_list = [], []
+        observed_positions = {}
         for gene in self.counts:
-            freqs = {position : {} for position in self.counts[gene]}
-            for position in sorted(self.counts[gene].keys()):
-                n_conserved, n_mutated = 0, 0
-                for nuke in utils.nukes:
-                    ncount, total = self.counts[gene][position][nuke], self.counts[gene][position]['total']
-                    nuke_freq = float(ncount) / total
-                    freqs[position][nuke] = nuke_freq
-                    freqs[position][nuke + '_lo_err'], freqs[position][nuke + '_hi_err'] = self.get_uncertainty(ncount, total)
-                    if nuke == self.counts[gene][position]['gl_nuke']:
-                        n_conserved += ncount
-                    else:
-                        n_mutated += ncount  # sum over A,C,G,T
-                freqs[position]['freq'] = float(n_mutated) / total
-                freqs[position]['freq_lo_err'], freqs[position]['freq_hi_err'] = self.get_uncertainty(n_mutated, total)
-
+            gcounts = self.counts[gene]
+            totals = gcounts.sum(axis=1)
+            observed_positions[gene] = [int(p) for p in numpy.flatnonzero(totals)]  # positions at which we saw at least one unambiguous base
+            for position in observed_positions[gene]:
+                total = int(totals[position])
+                n_mutated = total - int(gcounts[position, self.gl_nukes[gene][position]])  # sum over A,C,G,T that aren't the germline base
+                obs_list += [int(c) for c in gcounts[position]] + [n_mutated]
+                total_list += [total for _ in range(len(utils.nukes) + 1)]
+        errs = self.get_uncertainties(obs_list, total_list)
+
+        # then fill in the freqs (in the same order)
+        ipair = 0
+        for gene in self.counts:
+            freqs = {}
+            for position in observed_positions[gene]:
+                freqs[position] = {}
+                for nuke in utils.nukes + ['freq']:  # 'freq' is the overall mutation freq
+                    freqs[position][nuke] = float(obs_list[ipair]) / total_list[ipair]
+                    freqs[position][nuke + '_lo_err'], freqs[position][nuke + '_hi_err'] = errs[ipair]
+                    ipair += 1
             self.freqs[gene] = freqs
 
         for hist in self.mean_rates.values():
@@ -184,14 +214,14 @@ class MuteFreqer(object):
             nuke_header = [n + xtra for n in utils.nukes for xtra in ('', '_obs', '_lo_err', '_hi_err')]
             writer = csv.DictWriter(outfile, ('position', 'mute_freq', 'lo_err', 'hi_err') + tuple(nuke_header))
             writer.writeheader()
-            for position in sorted(gcounts.keys()):
+            for position in sorted(freqs.keys()):
                 row = {'position':position,
                        'mute_freq':freqs[position]['freq'],
                        'lo_err':freqs[position]['freq_lo_err'],
                        'hi_err':freqs[position]['freq_hi_err']}
                 for nuke in utils.nukes:
                     row[nuke] = freqs[position][nuke]
-                    row[nuke + '_obs'] = gcounts[position][nuke]
+                    row[nuke + '_obs'] = gcounts[position, utils.nukes.index(nuke)]
                     row[nuke + '_lo_err'] = freqs[position][nuke + '_lo_err']
                     row[nuke + '_hi_err'] = freqs[position][nuke + '_hi_err']
                 writer.writerow(row)
@@ -55,10 +55,8 @@ class ParameterCounter(object):
         """ increment parameters that differ for each sequence within the clonal family """
         self.mute_total += 1
         self.mfreqer.increment(info, iseq)
-        for nuke in info['seqs'][iseq]:
-            if nuke in utils.ambiguous_bases:
-                continue
-            self.counts['seq_content'][nuke] += 1
+        for nuke in utils.nukes:
+            self.counts['seq_content'][nuke] += info['seqs'][iseq].count(nuke)
 
     # ----------------------------------------------------------------------------------------
     def increment_per_family_params(self, info):
@@ -78,10 +76,20 @@ class ParameterCounter(object):
             self.counts[column][index] += 1
 
         for bound in utils.boundaries:
-            for nuke in info[bound + '_insertion']:
-                if nuke in utils.ambiguous_bases:
-                    continue
-                self.counts[bound + '_insertion_content'][nuke] += 1
+            for nuke in utils.nukes:
+                self.counts[bound + '_insertion_content'][nuke] += info[bound + '_insertion'].count(nuke)
+
+    # ----------------------------------------------------------------------------------------
+    def merge(self, other):
+        """ add the counts from <other> (e.g. from a different process) to ours """
+        self.reco_total += other.reco_total
+        self.mute_total += other.mute_total
+        for column in other.counts:
+            for index, count in other.counts[column].iteritems():
+                if index not in self.counts[column]:
+                    self.counts[column][index] = 0
+                self.counts[column][index] += count
+        self.mfreqer.merge(other.mfreqer)
 
     # ----------------------------------------------------------------------------------------
     def clean_plots(self, plotdir):
@@ -152,7 +160,8 @@ class ParameterCounter(object):
 
         if os.path.exists(base_outdir + '/' + glutils.glfo_dir):
             glutils.remove_glfo_files(base_outdir + '/' + glutils.glfo_dir, self.glfo['locus'])  # NOTE I think this will fail if I ever start having multiple loci in one dir
-        utils.prep_dir(base_outdir, subdirs=('hmms', 'mute-freqs', glutils.glfo_dir), wildlings=('*.csv', '*.yaml', '*.fasta'))  # it's kind of hackey to specify the /hmms dir here, but as soon as we write the parameters below, the previous yamels are out of date, so it's pretty much necessary
+        utils.set_aside_existing_hmms(base_outdir)  # as soon as we write the parameters below, the previous yamels are out of date, so move them out of the way (PartitionDriver.write_hmms() reuses any whose inputs didn't change)
+        utils.prep_dir(base_outdir, subdirs=('mute-freqs', glutils.glfo_dir), wildlings=('*.csv', '*.yaml', '*.fasta'))
 
         self.mfreqer.write(base_outdir + '/mute-freqs', mean_freq_outfname=base_outdir + '/REGION-mean-mute-freqs.csv')  # REGION is replace by each region in the three output files)
         genes_with_counts = [g[0] for r in utils.regions for g in self.counts[r + '_gene'].keys()]
@@ -7,6 +7,7 @@ import math
 import os
 import glob
 import csv
+import sqlite3
 csv.field_size_limit(sys.maxsize)  # make sure we can write very large csv fields
 import random
 from collections import OrderedDict
@@ -14,6 +15,7 @@ from subprocess import Popen, check_call, PIPE, CalledProcessError, check_output
 import copy
 import multiprocessing
 import operator
+import heapq
 import traceback
 
 import utils
@@ -50,10 +52,11 @@ class PartitionDriver(object):
         self.reco_info = reco_info
 
         utils.prep_dir(self.args.workdir)
-        self.my_gldir = self.args.workdir + '/' + glutils.glfo_dir
+        self.glfo_base_dir = self.args.workdir + '/' + glutils.glfo_dir  # content-hashed glfo dirs (shared with sw) go in here
+        self.my_gldir = None  # set to the current glfo's dir (in <self.glfo_base_dir>) while bcrham is running
         if args.infname is not None:
             if self.args.sw_cachefname is None:
-                self.sw_cache_path = self.args.parameter_dir + '/sw-cache-' + repr(abs(hash(''.join(self.input_info.keys()))))  # remain suffix-agnostic
+                self.sw_cache_path = self.args.parameter_dir + '/sw-cache'  # remain suffix-agnostic (NOTE entries are keyed per-query, so this can be shared among different input files, see waterer.read_cachefile())
             else:
                 self.sw_cache_path = utils.getprefix(self.args.sw_cachefname)
 
@@ -61,6 +64,9 @@ class PartitionDriver(object):
         self.duplicates = {}
         self.bcrham_proc_info = None
         self.timing_info = []  # it would be really nice to clean up both this and bcrham_proc_info
+        self.bcrham_cost_exponent = 1.5  # bcrham time for a cluster is modeled as (n seqs)^<exponent> * (seq length), with the exponent recalibrated after each multi-proc step (see calibrate_bcrham_cost_model())
+        self.split_cost_info = None  # (n seqs, seq length) for each cluster that split_input() sent to each proc
+        self.bcrham_workers = None  # persistent bcrham processes that we reuse for each clustering step (None if we're not using them)
         self.istep = None  # stupid hack to get around network file system issues (see self.subworkidr()
         self.subworkdirs = []  # arg. same stupid hack
 
@@ -73,6 +79,8 @@ class PartitionDriver(object):
 
         self.hmm_infname = self.args.workdir + '/hmm_input.csv'
         self.hmm_cachefname = self.args.workdir + '/hmm_cached_info.csv'
+        self.hmm_cache_dbfname = self.args.workdir + '/hmm_cached_info.db'  # sqlite index of the singleton naive seqs in <self.hmm_cachefname> (see update_hmm_cache_index())
+        self.hmm_cache_index = None
         self.hmm_outfname = self.args.workdir + '/hmm_output.csv'
 
         if self.args.outfname is not None:
@@ -102,6 +110,7 @@ class PartitionDriver(object):
         for tmpaction in actions:
             self.current_action = tmpaction  # NOTE gets changed on the fly in one or two places below (which is kind of hackey, but I can't figure out a way to improve on it. Bottom line is that the control flow for different actions is really complicated)
             self.action_fcns[tmpaction]()
+        glutils.remove_cached_glfo_dirs(self.glfo_base_dir, self.args.locus)  # germline set dirs are kept around between sw and hmm runs in case the germline set doesn't change
 
     # ----------------------------------------------------------------------------------------
     def clean(self):
@@ -128,6 +137,7 @@ class PartitionDriver(object):
             os.remove(lockfname)
         if os.path.exists(self.hmm_cachefname):
             os.remove(self.hmm_cachefname)
+        self.reset_hmm_cache_index()
 
         for subd in self.subworkdirs:
             if os.path.exists(subd):  # if there was only one proc for this step, it'll have already been removed
@@ -271,32 +281,36 @@ class PartitionDriver(object):
             self.write_output(annotations.values(), hmm_failures)
 
     # ----------------------------------------------------------------------------------------
-    def parse_existing_annotations(self, annotation_lines, ignore_args_dot_queries=False, process_csv=False):
+    def iter_existing_annotations(self, keyed_lines, ignore_args_dot_queries=False, process_csv=False):  # yield the (key, line) pairs from <keyed_lines> that pass the command line restrictions (<key> is whatever the caller wants to keep track of each line with)
         n_queries_read = 0
-        failed_query_strs = set()
-        annotations = OrderedDict()
-        for line in annotation_lines:
+        n_failed = 0
+        for key, line in keyed_lines:
             if process_csv:
                 utils.process_input_line(line)
-            uidstr = ':'.join(line['unique_ids'])
             if ('invalid' in line and line['invalid']) or line['v_gene'] == '':  # first way is the new way, but we have to check the empty-v-gene way too for old files
-                failed_query_strs.add(uidstr)
+                n_failed += 1
                 continue
             if self.args.queries is not None and not ignore_args_dot_queries:  # second bit is because when printing subcluster naive seqs, we want to read all the ones that have any overlap with self.args.queries, not just the exact cluster of self.args.queries
                 if len(set(self.args.queries) & set(line['unique_ids'])) == 0:  # actually make sure this is the precise set of queries we want (note that --queries and line['unique_ids'] are both ordered, and this ignores that... oh, well, sigh.)
                     continue
             if self.args.reco_ids is not None and line['reco_id'] not in self.args.reco_ids:
                 continue
-            utils.add_implicit_info(self.glfo, line)
-            annotations[uidstr] = line
+            yield key, line
 
             n_queries_read += 1
             if self.args.n_max_queries > 0 and n_queries_read >= self.args.n_max_queries:
                 break
 
-        if len(failed_query_strs) > 0:
-            print '\n%d failed queries' % len(failed_query_strs)
+        if n_failed > 0:
+            print '\n%d failed queries' % n_failed
 
+    # ----------------------------------------------------------------------------------------
+    def parse_existing_annotations(self, annotation_lines, ignore_args_dot_queries=False, process_csv=False):
+        annotations = OrderedDict()
+        for _, line in self.iter_existing_annotations(((None, l) for l in annotation_lines), ignore_args_dot_queries=ignore_args_dot_queries, process_csv=process_csv):
+            line = utils.LazyLine(line)
+            utils.add_implicit_info(self.glfo, line)
+            annotations[':'.join(line['unique_ids'])] = line
         return annotations
 
     # ----------------------------------------------------------------------------------------
@@ -310,17 +324,19 @@ class PartitionDriver(object):
         self.print_subcluster_naive_seqs(self.args.queries)
 
     # ----------------------------------------------------------------------------------------
-    def print_results(self, cpath, annotations):  # NOTE this duplicates code that already prints annotations (in self.read_annotation_output()) and partitions (in self.partition())
+    def print_results(self, cpath, annotation_sizes, get_annotation):  # NOTE this duplicates code that already prints annotations (in self.read_annotation_output()) and partitions (in self.partition())
+        # <annotation_sizes> is an ordered dict from some key for each annotation to its number of sequences, and get_annotation(key) returns the actual annotation, so we only need one in memory at a time
         if cpath is not None:
             print utils.color('green', 'partitions:')
             cpath.print_partitions(abbreviate=self.args.abbreviate, reco_info=self.reco_info, highlight_cluster_indices=self.args.cluster_indices)
 
-        if len(annotations) > 0:
+        if len(annotation_sizes) > 0:
             print utils.color('green', 'annotations:')
-            sorted_annotations = sorted(annotations.values(), key=lambda l: len(l['unique_ids']), reverse=True)
+            sorted_keys = sorted(annotation_sizes, key=lambda k: annotation_sizes[k], reverse=True)
             if self.args.cluster_indices is not None:
-                sorted_annotations = [sorted_annotations[iclust] for iclust in self.args.cluster_indices]
-            for line in sorted_annotations:
+                sorted_keys = [sorted_keys[iclust] for iclust in self.args.cluster_indices]
+            for key in sorted_keys:
+                line = get_annotation(key)
                 label = ''
                 if self.args.infname is not None and self.reco_info is not None:
                     utils.print_true_events(self.simglfo, self.reco_info, line, extra_str='  ')
@@ -352,7 +368,15 @@ class PartitionDriver(object):
         elif utils.getsuffix(outfname) == '.yaml':  # new way
             # NOTE replaces <self.glfo>, which is definitely what we want (that's the point of putting glfo in the yaml file), but it's still different behavior than if reading a csv
             assert self.glfo is None  # make sure bin/partis successfully figured out that we would be reading the glfo from the yaml output file
-            self.glfo, annotation_lines, cpath = utils.read_yaml_output(outfname, n_max_queries=self.args.n_max_queries, dont_add_implicit_info=True, seed_unique_id=self.args.seed_unique_id)  # add implicit info below, so we can skip some of 'em
+            header, events = utils.open_yaml_output(outfname)  # NOTE original-format files are loaded all at once here
+            self.glfo = header['germline-info']
+            cpath = ClusterPath(seed_unique_id=self.args.seed_unique_id)
+            if len(header['partitions']) > 0:
+                cpath.readlines(header['partitions'])
+            if tmpact in ['view-output', 'view-annotations', 'view-partitions'] and utils.is_streaming_yaml(header):  # for record-per-line files, we only need to keep the file offset of each annotation that we're going to print
+                events.close()
+                return self.print_streaming_yaml_results(outfname, cpath, ignore_args_dot_queries=ignore_args_dot_queries)
+            annotation_lines = utils.iter_yaml_annotations(self.glfo, events, n_max_queries=self.args.n_max_queries, dont_add_implicit_info=True)  # add implicit info below, so we can skip some of 'em (and we iterate over them so we don't need to keep all the ones we skip in memory)
         else:
             raise Exception('unhandled annotation file suffix %s' % outfname)
 
@@ -363,10 +387,26 @@ class PartitionDriver(object):
             partplotter.plot(self.args.plotdir + '/partitions', partition=cpath.partitions[cpath.i_best], annotations=annotations)
 
         if tmpact in ['view-output', 'view-annotations', 'view-partitions']:
-            self.print_results(cpath, annotations)
+            self.print_results(cpath, OrderedDict((uidstr, len(line['unique_ids'])) for uidstr, line in annotations.items()), annotations.__getitem__)
 
         return annotations, cpath
 
+    # ----------------------------------------------------------------------------------------
+    def print_streaming_yaml_results(self, outfname, cpath, ignore_args_dot_queries=False):  # same as the end of read_existing_output(), but for each annotation we only keep its offset in the file, and reread it when it's time to print it
+        def read_events():  # apply --n-max-queries to the number of sequences read, like utils.iter_yaml_annotations() (iter_existing_annotations() then also applies it to the number of annotations that we keep)
+            n_queries_read = 0
+            for offset, line in utils.iter_streaming_yaml_events(outfname):
+                yield offset, line
+                n_queries_read += len(line['unique_ids'])
+                if self.args.n_max_queries > 0 and n_queries_read >= self.args.n_max_queries:
+                    break
+        annotation_sizes = OrderedDict()  # file offset : number of sequences
+        for offset, line in self.iter_existing_annotations(read_events(), ignore_args_dot_queries=ignore_args_dot_queries):
+            annotation_sizes[offset] = len(line['unique_ids'])
+        with open(outfname) as yamlfile:
+            self.print_results(cpath, annotation_sizes, lambda offset: utils.read_streaming_yaml_event(yamlfile, self.glfo, offset))
+        return None, cpath
+
     # ----------------------------------------------------------------------------------------
     def partition(self):
         """ Partition sequences in <self.input_info> into clonally related lineages """
@@ -418,7 +458,7 @@ class PartitionDriver(object):
         seeded_cpath = ClusterPath(seed_unique_id=self.args.seed_unique_id)
         seeded_cpath.add_partition(seeded_partition, -1., 1)
         print '      removed %d sequences in unseeded clusters,' % len(self.unseeded_seqs),
-        print 'split %d seeded clusters into %d singletons, and merged these into %d clusters with identical naive seqs' % (len(seeded_clusters), len(seeded_singleton_set), len(seeded_cpath.partitions[seeded_cpath.i_best_minus_x]))
+        print 'split %d seeded clusters into %d singletons, and merged these into %d clusters with identical naive seqs' % (len(seeded_clusters), len(seeded_singleton_set), seeded_cpath.partitions.n_clusters(seeded_cpath.i_best_minus_x))
 
         return seeded_cpath
 
@@ -433,7 +473,7 @@ class PartitionDriver(object):
 
     # ----------------------------------------------------------------------------------------
     def scale_n_procs_for_new_n_clusters(self, initial_nseqs, initial_nprocs, cpath):
-        new_n_clusters = len(cpath.partitions[cpath.i_best_minus_x])  # when removing small clusters, this is the number of clusters, not the number of sequences, but it's maybe still ok
+        new_n_clusters = cpath.partitions.n_clusters(cpath.i_best_minus_x)  # when removing small clusters, this is the number of clusters, not the number of sequences, but it's maybe still ok
         int_initial_seqs_per_proc = max(1, int(float(initial_nseqs) / initial_nprocs))
         new_n_procs = max(1, int(float(new_n_clusters) / int_initial_seqs_per_proc))
         if new_n_clusters > 20:
@@ -503,44 +543,46 @@ class PartitionDriver(object):
             print 'merging shared clusters'
             cpath.print_partitions()
 
-        # find every pair of clusters that has some overlap
-        cluster_groups = []
+        # union-find (disjoint set) over cluster indices, where we join any two clusters that share a uid
+        parents = range(len(partition))  # each cluster's parent in the disjoint set forest (roots are their own parents)
+        def find_root(iclust):
+            while parents[iclust] != iclust:
+                parents[iclust] = parents[parents[iclust]]  # path halving
+                iclust = parents[iclust]
+            return iclust
+
         if debug:
-            print ' making cluster_groups'
+            print ' joining clusters'
+        first_clusters = {}  # uid : index of first cluster in which we saw it
         for iclust in range(len(partition)):
-            for jclust in range(iclust + 1, len(partition)):
-                if len(set(partition[iclust]) & set(partition[jclust])) > 0:
-                    if debug:
-                        print '  %d %d' % (iclust, jclust)
-                    cluster_groups.append(set([iclust, jclust]))
-
-        # merge these pairs of clusters into groups
-        while True:
-            no_more_merges = True
-            for cp1, cp2 in itertools.combinations(cluster_groups, 2):
-                if len(cp1 & cp2) > 0:
+            for uid in partition[iclust]:
+                if uid not in first_clusters:
+                    first_clusters[uid] = iclust
+                    continue
+                iroot, jroot = find_root(first_clusters[uid]), find_root(iclust)
+                if iroot != jroot:
                     if debug:
-                        print '  merging %s and %s' % (cp1, cp2)
-                    cluster_groups.append(cp1 | cp2)
-                    cluster_groups.remove(cp1)
-                    cluster_groups.remove(cp2)
-                    no_more_merges = False
-                    break  # we've modified it now, so we have to go back and remake the iterator
-            if no_more_merges:
-                break
+                        print '  %d %d' % (first_clusters[uid], iclust)
+                    parents[max(iroot, jroot)] = min(iroot, jroot)  # always make the earlier cluster the root
 
-        # actually merge the groups of clusters
-        new_clusters = []
-        for cgroup in cluster_groups:
-            new_clusters.append(list(set([uid for iclust in cgroup for uid in partition[iclust]])))
-        if debug:
-            print ' removing'
-        for iclust in sorted([i for cgroup in cluster_groups for i in cgroup], reverse=True):
-            if debug:
-                print '    %d' % iclust
-            partition.pop(iclust)
-        for nclust in new_clusters:
-            partition.append(nclust)
+        # collect the groups of clusters with the same root
+        cluster_groups = OrderedDict()  # root index : indices of clusters in its group (ordered by root index, since roots are always the first cluster in their group)
+        for iclust in range(len(partition)):
+            iroot = find_root(iclust)
+            if iroot not in cluster_groups:
+                cluster_groups[iroot] = []
+            cluster_groups[iroot].append(iclust)
+
+        # actually merge the groups of clusters (clusters that didn't share anything with anybody stay in the same order, and merged clusters go at the end)
+        unmerged_clusters, new_clusters = [], []
+        for cgroup in cluster_groups.values():
+            if len(cgroup) == 1:
+                unmerged_clusters.append(partition[cgroup[0]])
+            else:
+                if debug:
+                    print '  merging %s' % ' '.join(str(i) for i in cgroup)
+                new_clusters.append(list(set([uid for iclust in cgroup for uid in partition[iclust]])))
+        cpath.partitions[cpath.i_best] = unmerged_clusters + new_clusters  # NOTE <partition> is a copy, so modifying it in place wouldn't change <cpath>
 
         if debug:
             cpath.print_partitions()
@@ -549,8 +591,8 @@ class PartitionDriver(object):
     def are_we_finished_clustering(self, n_procs, cpath):
         if n_procs == 1:
             return True
-        elif self.args.n_final_clusters is not None and len(cpath.partitions[cpath.i_best]) <= self.args.n_final_clusters:  # NOTE I *think* I want the best, not best-minus-x here (hardish to be sure a.t.m., since I'm not really using the minus-x part right now)
-            print '  stopping with %d (<= %d) clusters' % (len(cpath.partitions[cpath.i_best]), self.args.n_final_clusters)
+        elif self.args.n_final_clusters is not None and cpath.partitions.n_clusters(cpath.i_best) <= self.args.n_final_clusters:  # NOTE I *think* I want the best, not best-minus-x here (hardish to be sure a.t.m., since I'm not really using the minus-x part right now)
+            print '  stopping with %d (<= %d) clusters' % (cpath.partitions.n_clusters(cpath.i_best), self.args.n_final_clusters)
             return True
         elif self.args.max_cluster_size is not None and max([len(c) for c in cpath.partitions[cpath.i_best]]) > self.args.max_cluster_size:  # NOTE I *think* I want the best, not best-minus-x here (hardish to be sure a.t.m., since I'm not really using the minus-x part right now)
             print '   --max-cluster-size (partitiondriver): stopping with a cluster of size %d (> %d)' % (max([len(c) for c in cpath.partitions[cpath.i_best]]), self.args.max_cluster_size)
@@ -582,15 +624,20 @@ class PartitionDriver(object):
         cpath, initial_nseqs = self.get_initial_cpath(n_procs)
         n_proc_list = []
         self.istep = 0
+        if self.args.batch_system is None and not self.args.no_persistent_bcrham:
+            self.bcrham_workers = []
         start = time.time()
         while n_procs > 0:
-            print '%d clusters with %d proc%s' % (len(cpath.partitions[cpath.i_best_minus_x]), n_procs, utils.plural(n_procs))  # NOTE that a.t.m. i_best and i_best_minus_x are usually the same, since we're usually not calculating log probs of partitions (well, we're trying to avoid calculating any extra log probs, which means we usually don't know the log prob of the entire partition)
+            print '%d clusters with %d proc%s' % (cpath.partitions.n_clusters(cpath.i_best_minus_x), n_procs, utils.plural(n_procs))  # NOTE that a.t.m. i_best and i_best_minus_x are usually the same, since we're usually not calculating log probs of partitions (well, we're trying to avoid calculating any extra log probs, which means we usually don't know the log prob of the entire partition)
             cpath, _, _ = self.run_hmm('forward', self.sub_param_dir, n_procs=n_procs, partition=cpath.partitions[cpath.i_best_minus_x], shuffle_input=True)  # it would be nice to not just annihilate the old <cpath> here, and keep around some number of partitions over multiple n-procs cycles (but I think this would require write some amount of cluster path merging code)
             n_proc_list.append(n_procs)
             if self.are_we_finished_clustering(n_procs, cpath):
                 break
             n_procs, cpath = self.prepare_next_iteration(n_proc_list, cpath, initial_nseqs)
             self.istep += 1
+        if self.bcrham_workers is not None:
+            utils.stop_persistent_workers(self.bcrham_workers)
+            self.bcrham_workers = None
 
         if self.args.max_cluster_size is not None:
             print '   --max-cluster-size (partitiondriver): merging shared clusters'
@@ -670,14 +717,16 @@ class PartitionDriver(object):
                 utils.write_linearham_seqs(self.args.outfname, best_annotations.values())
 
         if self.args.write_additional_cluster_annotations is not None:  # remove the clusters that aren't actually in the best partition (we need them for partition plotting)
-            keys_to_remove = [uidstr for uidstr in best_annotations if uidstr.split(':') not in cpath.partitions[cpath.i_best]]
+            best_clusters = set(tuple(c) for c in cpath.partitions[cpath.i_best])  # NOTE don't index cpath.partitions inside the loop, since each access decodes (and copies) the whole partition
+            keys_to_remove = [uidstr for uidstr in best_annotations if tuple(uidstr.split(':')) not in best_clusters]
             for uidstr in keys_to_remove:
                 del best_annotations[uidstr]
-            if len(best_annotations) != len(cpath.partitions[cpath.i_best]):
-                if len(best_annotations) < len(cpath.partitions[cpath.i_best]):  # if <best_annotations> is too short, it should be because there was a failed annotation
+            n_best_clusters = cpath.partitions.n_clusters(cpath.i_best)
+            if len(best_annotations) != n_best_clusters:
+                if len(best_annotations) < n_best_clusters:  # if <best_annotations> is too short, it should be because there was a failed annotation
                     print '    %s read fewer cluster annotations than there are clusters in the best partition (should be accounted for above)' % utils.color('yellow', 'warning')
                 else:
-                    raise Exception('something went wrong when removing extra clusters from best_annotations (%d vs %d)' % (len(best_annotations), len(cpath.partitions[cpath.i_best])))
+                    raise Exception('something went wrong when removing extra clusters from best_annotations (%d vs %d)' % (len(best_annotations), n_best_clusters))
 
         if os.path.exists(self.hmm_infname):
             os.remove(self.hmm_infname)
@@ -685,21 +734,66 @@ class PartitionDriver(object):
 
         return best_annotations
 
+    # ----------------------------------------------------------------------------------------
+    def reset_hmm_cache_index(self):
+        if self.hmm_cache_index is not None:
+            self.hmm_cache_index['db'].close()
+            self.hmm_cache_index = None
+        if os.path.exists(self.hmm_cache_dbfname):
+            os.remove(self.hmm_cache_dbfname)
+
+    # ----------------------------------------------------------------------------------------
+    def update_hmm_cache_index(self, chunk_size=10000):
+        """
+        Add any singleton naive seqs that've been appended to the hmm cache file since we last looked to an sqlite index (keyed by uid), so we don't have to reread the whole (potentially huge) cache file every time we want some naive seqs.
+        NOTE this relies on the cache file only getting appended to, except when bcrham runs with one proc (in which case run_hmm() resets the index). We also rebuild the index if the file gets shorter or is replaced.
+        """
+        if self.hmm_cache_index is not None:
+            if not os.path.exists(self.hmm_cachefname) or os.stat(self.hmm_cachefname).st_ino != self.hmm_cache_index['inode'] or os.path.getsize(self.hmm_cachefname) < self.hmm_cache_index['offset']:
+                self.reset_hmm_cache_index()
+        if not os.path.exists(self.hmm_cachefname):
+            return
+        if self.hmm_cache_index is None:
+            if os.path.exists(self.hmm_cache_dbfname):  # left over from a crashed run
+                os.remove(self.hmm_cache_dbfname)
+            self.hmm_cache_index = {'db' : sqlite3.connect(self.hmm_cache_dbfname), 'inode' : os.stat(self.hmm_cachefname).st_ino, 'offset' : 0, 'header' : None}
+            self.hmm_cache_index['db'].execute('create table naive_seqs (unique_ids text primary key, naive_seq text)')
+
+        hcfo = self.hmm_cache_index
+        def add_lines(lines):
+            rows = [(line['unique_ids'], line['naive_seq']) for line in csv.DictReader(lines, fieldnames=hcfo['header']) if ':' not in line['unique_ids']]  # if it's a cache file left over from a previous partitioning, there'll be clusters in it, too
+            hcfo['db'].executemany('insert or replace into naive_seqs values (?, ?)', rows)  # NOTE there can be multiple lines for the same uid, in which case the last one wins (same as when we used to read the whole file)
+        with open(self.hmm_cachefname) as cachefile:
+            cachefile.seek(hcfo['offset'])
+            new_lines = []
+            while True:
+                line = cachefile.readline()
+                if not line.endswith('\n'):  # end of file (an incomplete last line gets read next time)
+                    break
+                hcfo['offset'] += len(line)
+                if hcfo['header'] is None:
+                    hcfo['header'] = csv.reader([line]).next()
+                    continue
+                new_lines.append(line)
+                if len(new_lines) >= chunk_size:
+                    add_lines(new_lines)
+                    new_lines = []
+            add_lines(new_lines)
+        hcfo['db'].commit()
+
     # ----------------------------------------------------------------------------------------
     def get_cached_hmm_naive_seqs(self, queries=None):
         # would be nice to merge this with self.read_hmm_cachefile()
         expected_queries = self.sw_info['queries'] if queries is None else queries
         cached_naive_seqs = {}
-        with open(self.hmm_cachefname) as cachefile:
-            reader = csv.DictReader(cachefile)
-            for line in reader:
-                if ':' in line['unique_ids']:  # if it's a cache file left over from a previous partitioning, there'll be clusters in it, too
-                    continue
-                if line['unique_ids'] not in expected_queries:  # probably can only happen if self.args.persistent_cachefname is set
-                    continue
-                cached_naive_seqs[line['unique_ids']] = line['naive_seq']
-                if len(cached_naive_seqs) == len(expected_queries):  # already got everybody
-                    break
+        self.update_hmm_cache_index()
+        if self.hmm_cache_index is not None:
+            expected_query_list = list(expected_queries)
+            chunk_size = 500  # sqlite has a limit (999 by default) on the number of variables in a statement
+            for istart in range(0, len(expected_query_list), chunk_size):
+                uid_chunk = expected_query_list[istart : istart + chunk_size]
+                cursor = self.hmm_cache_index['db'].execute('select unique_ids, naive_seq from naive_seqs where unique_ids in (%s)' % ','.join('?' for _ in uid_chunk), uid_chunk)
+                cached_naive_seqs.update((str(uid), str(naive_seq)) for uid, naive_seq in cursor)
 
         if set(cached_naive_seqs) != set(expected_queries):  # probably not really necessary, but, eh
             extra = set(cached_naive_seqs) - set(expected_queries)
@@ -730,14 +824,10 @@ class PartitionDriver(object):
         print '    using hfrac bound for vsearch %.3f' % threshold
 
         partition = []
-        print '    running vsearch %d times (once for each cdr3 length class):' % len(all_naive_seqs),
-        for cdr3_length, sub_naive_seqs in all_naive_seqs.items():
-            sub_hash_partition = utils.run_vsearch('cluster', sub_naive_seqs, self.args.workdir + '/vsearch', threshold, vsearch_binary=self.args.vsearch_binary)
-            sub_uid_partition = [[uid for hashstr in hashcluster for uid in naive_seq_hashes[hashstr]] for hashcluster in sub_hash_partition]
-            partition += sub_uid_partition
-            print '.',
-            sys.stdout.flush()
-        print ''
+        print '    running vsearch %d times (once for each cdr3 length class)' % len(all_naive_seqs)
+        sub_hash_partitions = utils.run_vsearch_class_clusters(all_naive_seqs.values(), self.args.workdir + '/vsearch', threshold, n_procs=self.args.n_procs, vsearch_binary=self.args.vsearch_binary, print_time=True)  # runs the classes concurrently
+        for sub_hash_partition in sub_hash_partitions:
+            partition += [[uid for hashstr in hashcluster for uid in naive_seq_hashes[hashstr]] for hashcluster in sub_hash_partition]
 
         ccfs = [None, None]
         if not self.args.is_data:  # it's ok to always calculate this since it's only ever for one partition
@@ -799,7 +889,7 @@ class PartitionDriver(object):
         cmd_str += ' --outfile ' + csv_outfname
         cmd_str += ' --locus ' + self.args.locus
         cmd_str += ' --random-seed ' + str(self.args.seed)
-        if n_procs > 1:  # only cache vals for sequence sets with newly-calculated vals (initial cache file is copied to each subdir)
+        if n_procs > 1:  # only cache vals for sequence sets with newly-calculated vals (all procs read the initial cache file from the main workdir, and write new vals to their subdirs)
             cmd_str += ' --only-cache-new-vals'
 
         if self.args.dont_rescale_emissions:
@@ -884,6 +974,20 @@ class PartitionDriver(object):
         if max_bcrham_time > 0. and wait_time / max_bcrham_time > 1.5 and wait_time > 30.:  # if we were waiting for a lot longer than the slowest process took, and if it took long enough for us to care
             print '    spent much longer waiting for bcrham (%.1fs) than bcrham reported taking (max per-proc time %.1fs)' % (wait_time, max_bcrham_time)
 
+    # ----------------------------------------------------------------------------------------
+    def run_on_bcrham_workers(self, cmdfos):
+        """ run <cmdfos> on our persistent bcrham workers (so they only have to read each hmm once for all the clustering steps), starting/stopping workers so there's one per command, and return the commands that failed """
+        n_procs = len(cmdfos)
+        if len(self.bcrham_workers) > n_procs:  # stop the ones we don't need any more (so they don't sit around hogging memory)
+            utils.stop_persistent_workers(self.bcrham_workers[n_procs:])
+            self.bcrham_workers = self.bcrham_workers[:n_procs]
+        while len(self.bcrham_workers) < n_procs:
+            self.bcrham_workers.append(utils.start_persistent_worker(self.args.partis_dir + '/packages/ham/bcrham --server'))
+        failed_iprocs = utils.run_cmds_on_workers(cmdfos, self.bcrham_workers, debug='print' if self.args.debug else None)
+        if len(failed_iprocs) > 0:
+            print '    %s %d bcrham worker command%s failed (%d worker%s still alive), rerunning with new processes' % (utils.color('yellow', 'warning'), len(failed_iprocs), utils.plural(len(failed_iprocs)), len(self.bcrham_workers), utils.plural(len(self.bcrham_workers)))
+        return [cmdfos[iproc] for iproc in failed_iprocs]
+
     # ----------------------------------------------------------------------------------------
     def execute(self, cmd_str, n_procs):
         # ----------------------------------------------------------------------------------------
@@ -893,6 +997,8 @@ class PartitionDriver(object):
         def get_cmd_str(iproc):
             strlist = cmd_str.split()
             for istr in range(len(strlist)):
+                if strlist[istr] == self.hmm_cachefname and strlist[istr - 1] == '--input-cachefname':  # everybody reads the same (main) input cache file, rather than making a copy for each subdir
+                    continue
                 if strlist[istr] == self.hmm_infname or strlist[istr] == self.hmm_cachefname or strlist[istr] == self.hmm_outfname:
                     strlist[istr] = strlist[istr].replace(self.args.workdir, self.subworkdir(iproc, n_procs))
             return ' '.join(strlist)
@@ -907,8 +1013,12 @@ class PartitionDriver(object):
                    'outfname' : get_outfname(iproc),
                    'dbgfo' : self.bcrham_proc_info[iproc]}
                   for iproc in range(n_procs)]
-        utils.run_cmds(cmdfos, batch_system=self.args.batch_system, batch_options=self.args.batch_options, batch_config_fname=self.args.batch_config_fname, debug='print' if self.args.debug else None)
+        if self.bcrham_workers is not None:
+            cmdfos = self.run_on_bcrham_workers(cmdfos)  # returns the ones that failed
+        if len(cmdfos) > 0:
+            utils.run_cmds(cmdfos, batch_system=self.args.batch_system, batch_options=self.args.batch_options, batch_config_fname=self.args.batch_config_fname, debug='print' if self.args.debug else None)
         self.print_partition_dbgfo()
+        self.calibrate_bcrham_cost_model()
 
         self.check_wait_times(time.time()-start)
         sys.stdout.flush()
@@ -928,7 +1038,7 @@ class PartitionDriver(object):
             n_procs = self.args.n_procs
 
         self.prepare_for_hmm(algorithm, parameter_in_dir, partition, shuffle_input=shuffle_input)
-        glutils.write_glfo(self.my_gldir, self.glfo)
+        self.my_gldir = glutils.get_cached_glfo_dir(self.glfo_base_dir, self.glfo)  # only writes it if we haven't already written this germline set
 
         cmd_str = self.get_hmm_cmd_str(algorithm, self.hmm_infname, self.hmm_outfname, parameter_dir=parameter_in_dir, precache_all_naive_seqs=precache_all_naive_seqs, n_procs=n_procs)
 
@@ -938,8 +1048,11 @@ class PartitionDriver(object):
         exec_start = time.time()
         self.execute(cmd_str, n_procs)
         exec_time = time.time() - exec_start
+        if n_procs == 1 and self.current_action == 'partition':  # with one proc, bcrham rewrites the whole cache file (rather than us appending only the new vals), so the index's offset is no longer meaningful
+            self.reset_hmm_cache_index()
 
-        glutils.remove_glfo_files(self.my_gldir, self.args.locus)
+        glutils.release_cached_glfo_dir(self.my_gldir)
+        self.my_gldir = None
 
         cpath, annotations, hmm_failures = None, None, None
         if read_output:
@@ -1056,6 +1169,84 @@ class PartitionDriver(object):
         assert len(self.sw_info[qry]['padlefts']) == 1
         return self.sw_info[qry]['padlefts'][0] * utils.ambiguous_bases[0] + self.reco_info[qry]['naive_seq'] + self.sw_info[qry]['padrights'][0] * utils.ambiguous_bases[0]
 
+    # ----------------------------------------------------------------------------------------
+    def bcrham_cost(self, n_seqs, seq_len, exponent=None):  # rough (relative) bcrham run time for a cluster
+        return n_seqs**(self.bcrham_cost_exponent if exponent is None else exponent) * seq_len
+
+    # ----------------------------------------------------------------------------------------
+    def calibrate_bcrham_cost_model(self, min_time=1., debug=False):
+        """ choose the cost exponent for which bcrham's reported time per predicted cost is the most uniform across the procs from the step that just finished """
+        split_cost_info = self.split_cost_info
+        self.split_cost_info = None
+        if split_cost_info is None or len(split_cost_info) != len(self.bcrham_proc_info) or len(split_cost_info) < 3:
+            return
+        times = [procinfo['time']['bcrham'] if 'time' in procinfo else None for procinfo in self.bcrham_proc_info]
+        if None in times or max(times) < min_time:  # too quick to tell us much
+            return
+        best_exponent, best_spread = None, None
+        for exponent in numpy.arange(1., 3.01, 0.25):
+            predicted = [sum(self.bcrham_cost(n, l, exponent=exponent) for n, l in pcinfo) for pcinfo in split_cost_info]
+            ratios = [t / p for t, p in zip(times, predicted) if p > 0.]
+            if len(ratios) < 3:
+                return
+            spread = numpy.std(ratios) / numpy.mean(ratios)  # coefficient of variation (it'd be zero if the cost model were perfect)
+            if best_spread is None or spread < best_spread:
+                best_exponent, best_spread = exponent, spread
+        if debug or self.args.debug:
+            print '      bcrham cost exponent: %.2f --> %.2f' % (self.bcrham_cost_exponent, best_exponent)
+        self.bcrham_cost_exponent = best_exponent
+
+    # ----------------------------------------------------------------------------------------
+    def assign_clusters_to_procs(self, info, n_procs):
+        """
+        Return a list (over procs) of lists of indices in <info> (the input file lines) such that the procs have about the same predicted bcrham time.
+        When partitioning, clusters are first grouped by cdr3 length (since only clusters with the same cdr3 length can be merged), then each group is split into chunks no bigger than half a proc's fair share.
+        The chunks are then assigned largest-first to the least-loaded proc.
+        NOTE within each group, clusters stay in input file order, which write_to_single_input_file() shuffles between clustering steps. This is critical: it's what lets clusters that were in different procs (or chunks) at one step end up together at the next.
+        """
+        costinfo = []
+        for line in info:
+            n_seqs = line['names'].count(':') + 1
+            costinfo.append((n_seqs, (len(line['seqs']) - (n_seqs - 1)) / n_seqs))  # seqs are colon-separated
+        costs = [self.bcrham_cost(n, l) for n, l in costinfo]
+
+        groups = OrderedDict()  # clusters that we want to send to the same proc if we can
+        if self.current_action == 'partition':
+            for iquery, line in enumerate(info):
+                cdr3_length = line['cdr3_length']
+                if cdr3_length not in groups:
+                    groups[cdr3_length] = []
+                groups[cdr3_length].append(iquery)
+        else:
+            groups = OrderedDict((i, [i]) for i in range(len(info)))
+
+        max_chunk_cost = sum(costs) / float(2 * n_procs)  # chunks of up to half of a proc's fair share seem to be a decent compromise between keeping groups together and balancing the load
+        chunks = []  # list of (cost, indices)
+        for indices in groups.values():
+            chunk, chunk_cost = [], 0.
+            for iquery in indices:
+                if len(chunk) > 0 and chunk_cost + costs[iquery] > max_chunk_cost:
+                    chunks.append((chunk_cost, chunk))
+                    chunk, chunk_cost = [], 0.
+                chunk.append(iquery)
+                chunk_cost += costs[iquery]
+            if len(chunk) > 0:
+                chunks.append((chunk_cost, chunk))
+
+        proc_loads = [(0., iproc) for iproc in range(n_procs)]  # heap of (predicted cost, proc index)
+        proc_assignments = [[] for _ in range(n_procs)]
+        for cost, chunk in sorted(chunks, key=lambda c: c[0], reverse=True):
+            load, iproc = heapq.heappop(proc_loads)
+            proc_assignments[iproc] += chunk
+            heapq.heappush(proc_loads, (load + cost, iproc))
+        proc_assignments = [sorted(indices) for indices in proc_assignments]
+
+        if self.args.debug:
+            loads = [l for l, _ in proc_loads]
+            print '      split %d clusters into %d chunks for %d procs: predicted max/mean load %.2f' % (len(info), len(chunks), n_procs, max(loads) / numpy.mean(loads) if sum(loads) > 0. else 1.)
+        self.split_cost_info = [[costinfo[i] for i in indices] for indices in proc_assignments]
+        return proc_assignments
+
     # ----------------------------------------------------------------------------------------
     def split_input(self, n_procs, infname):
 
@@ -1089,12 +1280,6 @@ class PartitionDriver(object):
             return open(self.subworkdir(siproc, n_procs) + '/' + os.path.basename(infname), mode)
         def get_writer(sub_outfile):
             return csv.DictWriter(sub_outfile, reader.fieldnames, delimiter=' ')
-        def copy_cache_files(n_procs):
-            cmdfos = [{'cmd_str' : 'cp ' + self.hmm_cachefname + ' ' + self.subworkdir(iproc, n_procs) + '/',
-                       'workdir' : self.subworkdir(iproc, n_procs),
-                       'outfname' : self.subworkdir(iproc, n_procs) + '/' + os.path.basename(self.hmm_cachefname)}
-                      for iproc in range(n_procs)]
-            utils.run_cmds(cmdfos)
 
         # initialize output/cache files
         for iproc in range(n_procs):
@@ -1102,8 +1287,8 @@ class PartitionDriver(object):
             sub_outfile = get_sub_outfile(iproc, 'w')
             get_writer(sub_outfile).writeheader()
             sub_outfile.close()  # can't leave 'em all open the whole time 'cause python has the thoroughly unreasonable idea that one oughtn't to have thousands of files open at once
-        if self.current_action == 'partition' and os.path.exists(self.hmm_cachefname):  # copy cachefile to this subdir (first clause is just for so when we're getting cluster annotations we don't copy over the cache files)
-            copy_cache_files(n_procs)
+
+        proc_assignments = self.assign_clusters_to_procs(info, n_procs)
 
         seed_clusters_to_write = seeded_clusters.keys()  # the keys in <seeded_clusters> that we still need to write
         for iproc in range(n_procs):
@@ -1121,10 +1306,8 @@ class PartitionDriver(object):
                 else:  # if we don't have any more that we *need* to write (i.e. that have other seqs in them), just write the shortest one (which will frequently be a singleton)
                     writer.writerow(seeded_clusters[smallest_seed_cluster_str])
 
-            # then loop over the non-seeded clusters
-            for iquery in range(len(info)):
-                if iquery % n_procs != iproc:
-                    continue
+            # then write the non-seeded clusters that were assigned to this proc
+            for iquery in proc_assignments[iproc]:
                 writer.writerow(info[iquery])
             sub_outfile.close()
 
@@ -1236,28 +1419,50 @@ class PartitionDriver(object):
         sys.stdout.flush()
         start = time.time()
 
-        from hmmwriter import HmmWriter
+        import hmmwriter
         hmm_dir = parameter_dir + '/hmms'
+        previous_hmm_dir = utils.set_aside_existing_hmms(parameter_dir)  # we reuse any of the previous hmms whose inputs haven't changed
         utils.prep_dir(hmm_dir, '*.yaml')
         glutils.restrict_to_observed_genes(self.glfo, parameter_dir)  # this is kind of a weird place to put this... it would make more sense to read the glfo from the parameter dir, but I don't want to mess around with changing that a.t.m.
 
         if self.args.debug:
             print 'to %s' % parameter_dir + '/hmms',
 
-        if multiprocessing.cpu_count() * utils.memory_usage_fraction() > 0.8:  # already using a lot of memory, so don't to call multiprocessing, which will duplicate all the memory for each process
-            for region in utils.regions:
-                for gene in self.glfo['seqs'][region]:
-                    writer = HmmWriter(parameter_dir, hmm_dir, gene, self.glfo, self.args)
-                    writer.write()
-        else:
-            def write_single_hmm(gene):
-                writer = HmmWriter(parameter_dir, hmm_dir, gene, self.glfo, self.args)
+        # NOTE this also parses all the parameter csvs (once), so the procs below get them for free
+        genes = [g for r in utils.regions for g in self.glfo['seqs'][r]]
+        fingerprints = {g : hmmwriter.get_hmm_fingerprint(parameter_dir, g, self.glfo, self.args) for g in genes}
+        previous_fingerprints = hmmwriter.read_fingerprints(previous_hmm_dir)
+        genes_to_write = []  # genes whose inputs have changed (or are new)
+        for gene in genes:
+            previous_fname = previous_hmm_dir + '/' + utils.sanitize_name(gene) + '.yaml'
+            if previous_fingerprints.get(gene) == fingerprints[gene] and os.path.exists(previous_fname):
+                os.rename(previous_fname, hmm_dir + '/' + utils.sanitize_name(gene) + '.yaml')
+            else:
+                genes_to_write.append(gene)
+
+        def write_hmm_batch(genes):
+            for gene in genes:
+                writer = hmmwriter.HmmWriter(parameter_dir, hmm_dir, gene, self.glfo, self.args)
                 writer.write()
-            procs = [multiprocessing.Process(target=write_single_hmm, args=(gene,))
-                     for region in utils.regions for gene in self.glfo['seqs'][region]]
+        if len(genes_to_write) > 0 and multiprocessing.cpu_count() * utils.memory_usage_fraction() > 0.8:  # already using a lot of memory, so don't to call multiprocessing, which will duplicate all the memory for each process
+            write_hmm_batch(genes_to_write)
+        elif len(genes_to_write) > 0:
+            n_procs = min(utils.auto_n_procs(), len(genes_to_write))  # one proc per batch of genes, rather than per gene
+            procs = [multiprocessing.Process(target=write_hmm_batch, args=(genes_to_write[iproc::n_procs],)) for iproc in range(n_procs)]
+            batches = [(proc, genes_to_write[iproc::n_procs]) for iproc, proc in enumerate(procs)]
             utils.run_proc_functions(procs)  # uses all the cores (should only be for a little bit, though)
-
-        print '(%.1f sec)' % (time.time()-start)
+            for proc, batch_genes in batches:
+                if proc.exitcode != 0:  # don't want to think these are up to date next time
+                    for gene in batch_genes:
+                        del fingerprints[gene]
+
+        hmmwriter.write_fingerprints(hmm_dir, fingerprints)
+        if os.path.exists(previous_hmm_dir):
+            utils.prep_dir(previous_hmm_dir, wildlings='*')
+            os.rmdir(previous_hmm_dir)
+        hmmwriter.clear_parameter_cache()
+
+        print '(%d / %d unchanged) (%.1f sec)' % (len(genes) - len(genes_to_write), len(genes), time.time()-start)
         sys.stdout.flush()
 
     # ----------------------------------------------------------------------------------------
@@ -1572,6 +1777,7 @@ class PartitionDriver(object):
             for padded_line in reader:  # line coming from hmm output is N-padded such that all the seqs are the same length
 
                 utils.process_input_line(padded_line)
+                utils.compact_line(padded_line)
                 n_lines_read += 1
 
                 failed = self.check_did_bcrham_fail(padded_line, errorfo)
@@ -1592,6 +1798,7 @@ class PartitionDriver(object):
                 # if self.args.correct_boundaries and len(padded_line['unique_ids']) > 1:  # this does a decent job of correcting the multi-hmm's tendency to overestimate insertion and deletion lengths, but it also removes a significant portion of the multi-hmm's advantage in naive hamming distance
                 #     self.correct_multi_hmm_boundaries(padded_line)
 
+                padded_line = utils.LazyLine(padded_line)
                 try:
                     utils.add_implicit_info(self.glfo, padded_line, aligned_gl_seqs=self.aligned_gl_seqs, reset_indel_genes=True)
                 except:  # I really don't like just swallowing it, but it's crashing deep in the new[ish] indel code on an extraordinarily rare and I think super screwed up sequence, and I can't replicate it without running on the entire stupid huge sample
@@ -1765,6 +1972,6 @@ class PartitionDriver(object):
             annotation_fname = self.args.outfname if cpath is None else self.args.cluster_annotation_fname
             utils.write_annotations(annotation_fname, self.glfo, annotation_list, headers, failed_queries=failed_queries)
         elif utils.getsuffix(self.args.outfname) == '.yaml':
-            utils.write_annotations(self.args.outfname, self.glfo, annotation_list, headers, failed_queries=failed_queries, partition_lines=partition_lines)
+            utils.write_annotations(self.args.outfname, self.glfo, annotation_list, headers, failed_queries=failed_queries, partition_lines=partition_lines, streaming_yaml=self.args.streaming_yaml)
         else:
             raise Exception('unhandled annotation file suffix %s' % self.args.outfname)
@@ -973,7 +973,7 @@ def make_fraction_plot(hright, hwrong, plotdir, plotname, xlabel, ylabel, xbound
         wrong.pop(iv)
         yvals.pop(iv)
 
-    tmphilos = [sys.modules['fraction_uncertainty'].err(r, r + w) for r, w in zip(right, wrong)]
+    tmphilos = sys.modules['fraction_uncertainty'].err_list(right, [r + w for r, w in zip(right, wrong)])
     yerrs = [err[1] - err[0] for err in tmphilos]
     # print '%s' % region
     # for iv in range(len(xvals)):
@@ -1007,7 +1007,7 @@ def plot_gl_inference_fractions(plotdir, plotname, plotvals, labels, xlabel='',
 
     def get_single_vals(pv):
         yvals = [float(c) / t for c, t in zip(pv['ycounts'], pv['ytotals'])]  # total shouldn't be able to be zero
-        tmphilos = [fraction_uncertainty.err(c, t) for c, t in zip(pv['ycounts'], pv['ytotals'])]
+        tmphilos = fraction_uncertainty.err_list(pv['ycounts'], pv['ytotals'])
         yerrs = [err[1] - err[0] for err in tmphilos]
         print '  %s                    %s' % (xlabel, ylabel)
         for iv in range(len(pv['xvals'])):
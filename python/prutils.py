@@ -303,6 +303,6 @@ def print_seq_in_reco_event(original_line, iseq, extra_str='', label='', one_lin
         if set(line.keys()) != set(original_line.keys()):
             raise Exception('ack 1')
         for k in line:
-            if line[k] != original_line[k]:
+            if not utils.values_equal(line[k], original_line[k]):
                 print 'key %s differs:\n  %s\n  %s ' % (k, line[k], original_line[k])
                 raise Exception('')
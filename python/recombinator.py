@@ -47,7 +47,14 @@ class Recombinator(object):
         self.allele_prevalence_freqs = glutils.read_allele_prevalence_freqs(args.allele_prevalence_fname) if args.allele_prevalence_fname is not None else {}
         self.version_freq_table = self.read_vdj_version_freqs()  # list of the probabilities with which each VDJ combo (plus other rearrangement parameters) appears in data (none if rearranging from scratch)
         self.insertion_content_probs = self.read_insertion_content()  # dummy/uniform if rearranging from scratch
+        self.vdj_choices, self.vdj_cumulative_probs = None, None  # keys and cumulative probabilities from <self.version_freq_table> (so choose_vdj_combo() can do a binary search)
+        if self.version_freq_table is not None:
+            self.vdj_choices = self.version_freq_table.keys()
+            self.vdj_cumulative_probs = numpy.cumsum([self.version_freq_table[c] for c in self.vdj_choices])
+        self.insertion_cumulative_probs = {b : numpy.cumsum([self.insertion_content_probs[b][n] for n in utils.nukes]) for b in utils.boundaries}  # same thing for insert()
         self.all_mute_freqs = {}
+        self.substitution_models = {}  # eigen decomposition of the rate matrix for each region
+        self.gamma_rate_categories = {}
 
         # read shm info NOTE I'm not inferring the gtr parameters a.t.m., so I'm just (very wrongly) using the same ones for all individuals
         with open(self.args.gtrfname, 'r') as gtrfile:  # read gtr parameters
@@ -306,14 +313,9 @@ class Recombinator(object):
             vdj_choice = self.freqtable_index(self.get_scratchline())
         else:  # use real parameters from a directory
             iprob = numpy.random.uniform(0, 1)
-            sum_prob = 0.0
-            for tmpchoice in self.version_freq_table:  # assign each vdj choice a segment of the interval [0,1], and choose the one which contains <iprob>
-                sum_prob += self.version_freq_table[tmpchoice]
-                if iprob < sum_prob:
-                    vdj_choice = tmpchoice
-                    break
-
-            assert vdj_choice is not None  # shouldn't fall through to here
+            ichoice = numpy.searchsorted(self.vdj_cumulative_probs, iprob, side='right')  # each vdj choice gets a segment of the interval [0,1], and we choose the one which contains <iprob>
+            assert ichoice < len(self.vdj_choices)  # shouldn't fall off the end
+            vdj_choice = self.vdj_choices[ichoice]
 
         reco_event.set_vdj_combo(vdj_choice, self.glfo, debug=self.args.debug, mimic_data_read_length=self.args.mimic_data_read_length)
 
@@ -345,21 +347,10 @@ class Recombinator(object):
 
     # ----------------------------------------------------------------------------------------
     def insert(self, boundary, reco_event):
-        insert_seq_str = ''
-        probs = self.insertion_content_probs[boundary]
-        for _ in range(0, reco_event.insertion_lengths[boundary]):
-            iprob = numpy.random.uniform(0, 1)
-            sum_prob = 0.0
-            new_nuke = ''  # this is just to make sure I don't fall through the loop over nukes
-            for nuke in utils.nukes:  # assign each nucleotide a segment of the interval [0,1], and choose the one which contains <iprob>
-                sum_prob += probs[nuke]
-                if iprob < sum_prob:
-                    new_nuke = nuke
-                    break
-            assert new_nuke != ''
-            insert_seq_str += new_nuke
-
-        reco_event.insertions[boundary] = insert_seq_str
+        iprobs = numpy.random.uniform(0, 1, size=reco_event.insertion_lengths[boundary])  # same random numbers as calling it once for each position
+        inukes = numpy.searchsorted(self.insertion_cumulative_probs[boundary], iprobs, side='right')  # each nucleotide gets a segment of the interval [0,1], and we choose the one which contains each <iprob>
+        assert len(inukes) == 0 or max(inukes) < len(utils.nukes)
+        reco_event.insertions[boundary] = ''.join(utils.nukes[i] for i in inukes)
 
     # ----------------------------------------------------------------------------------------
     def erode_and_insert(self, reco_event):
@@ -377,8 +368,8 @@ class Recombinator(object):
             self.insert(boundary, reco_event)
 
     # ----------------------------------------------------------------------------------------
-    def write_mute_freqs(self, gene, seq, reco_event, reco_seq_fname):  # unsurprisingly, this function profiles out to be kind of a dumb way to do it, in terms of run time
-        """ Read position-by-position mute freqs from disk for <gene>, renormalize, then write to a file for bppseqgen. """
+    def get_mute_rates(self, gene, seq, reco_event):
+        """ Read position-by-position mute freqs from disk for <gene>, and renormalize to get a relative rate for each position in <seq>. """
         mute_freqs = self.get_mute_freqs(gene)
 
         rates = []  # list with a relative mutation rate for each position in <seq>
@@ -407,6 +398,13 @@ class Recombinator(object):
         assert utils.is_normed(total / float(len(seq)))
         assert len(rates) == len(seq)  # you just can't be too careful. what if gremlins ate a few while python wasn't looking?
 
+        return rates
+
+    # ----------------------------------------------------------------------------------------
+    def write_mute_freqs(self, gene, seq, reco_event, reco_seq_fname):  # unsurprisingly, this function profiles out to be kind of a dumb way to do it, in terms of run time
+        """ Write the starting sequence <seq> and (unless mutating from scratch) the relative rate for each position to a file for bppseqgen. """
+        rates = self.get_mute_rates(gene, seq, reco_event)
+
         # write the input file for bppseqgen, one base per line
         with open(reco_seq_fname, 'w') as reco_seq_file:
             # NOTE really not sure why this doesn't really [seems to require an "extra" column] work with csv.DictWriter, but it doesn't -- bppseqgen barfs (I think maybe it expects a different newline character? don't feel like working it out)
@@ -488,6 +486,92 @@ class Recombinator(object):
         os.rmdir(cmdfo['workdir'])
         return mutated_seqs
 
+    # ----------------------------------------------------------------------------------------
+    def get_substitution_model(self, region):
+        """ return eigen decomposition (eigenvalues, U, U^-1) of the rate matrix for <region>, i.e. the same model that we'd pass to bppseqgen, normalized to one substitution per site per unit branch length """
+        if region in self.substitution_models:
+            return self.substitution_models[region]
+
+        if self.args.mutate_from_scratch:  # JC69
+            exchangeabilities = numpy.ones((4, 4))
+            eq_freqs = numpy.array([0.25, 0.25, 0.25, 0.25])
+            rate_multiplier = 1.
+        else:  # GTR, using bio++'s parameterization (nucleotide order A C G T, same as utils.nukes): http://biopp.univ-montp2.fr/apidoc/bpp-phyl/html/classbpp_1_1GTR.html
+            pars = {p : float(v) for p, v in self.mute_models[region]['gtr'].items()}
+            a, b, c, d, e, f = [pars[p] for p in 'abcde'] + [1.]
+            exchangeabilities = numpy.array([[0., d, f, b],
+                                             [d, 0., e, a],
+                                             [f, e, 0., c],
+                                             [b, a, c, 0.]])
+            theta, theta1, theta2 = [pars[p] for p in ['theta', 'theta1', 'theta2']]  # gc content, A/(A+T), and G/(G+C)
+            eq_freqs = numpy.array([theta1 * (1. - theta), (1. - theta2) * theta, theta2 * theta, (1. - theta1) * (1. - theta)])
+            rate_multiplier = pars.get('rate', 1.)  # d and j have an extra overall rate parameter, which bio++ multiplies into the generator
+
+        qmatrix = exchangeabilities * eq_freqs  # q_ij = s_ij pi_j
+        numpy.fill_diagonal(qmatrix, 0.)
+        numpy.fill_diagonal(qmatrix, -qmatrix.sum(axis=1))
+        qmatrix /= -numpy.dot(eq_freqs, numpy.diag(qmatrix))  # normalize so the expected number of substitutions per unit time is 1
+        qmatrix *= rate_multiplier
+
+        # the model's reversible, so we can decompose the symmetrized matrix, which is more stable than decomposing <qmatrix> directly
+        sqrt_freqs = numpy.sqrt(eq_freqs)
+        eigenvalues, eigenvectors = numpy.linalg.eigh(qmatrix * sqrt_freqs[:, None] / sqrt_freqs[None, :])
+        self.substitution_models[region] = (eigenvalues, eigenvectors / sqrt_freqs[:, None], eigenvectors.T * sqrt_freqs[None, :])
+        return self.substitution_models[region]
+
+    # ----------------------------------------------------------------------------------------
+    def get_site_rates(self, seq, gene, reco_event, rng):
+        """ relative rate for each position in <seq>: per-position rates from data, or, if mutating from scratch, either flat or drawn from a discretized gamma (as bppseqgen would do) """
+        if not self.args.mutate_from_scratch:
+            return numpy.array(self.get_mute_rates(gene, seq, reco_event))
+        if self.args.flat_mute_freq:
+            return numpy.ones(len(seq))
+        region = utils.get_region(gene)
+        if region not in self.gamma_rate_categories:  # bio++ uses the mean rate within each of <n_categories> equal-probability bins
+            import scipy.stats
+            import scipy.special
+            n_categories = 4
+            alpha = float(self.mute_models[region]['gamma']['alpha'])
+            bounds = scipy.stats.gamma.ppf(numpy.linspace(0., 1., n_categories + 1), alpha, scale=1. / alpha)
+            cumulative_means = scipy.special.gammainc(alpha + 1., bounds * alpha)  # fraction of the mean that lies below each bound
+            self.gamma_rate_categories[region] = n_categories * numpy.diff(cumulative_means)
+        return self.gamma_rate_categories[region][rng.randint(len(self.gamma_rate_categories[region]), size=len(seq))]  # each site gets its own category
+
+    # ----------------------------------------------------------------------------------------
+    def evolve_seq(self, seq, treestr, gene, reco_event, rng):
+        """ in-process replacement for bppseqgen: evolve <seq> down the (newick) tree <treestr>, returning leaf sequences ordered as t1, t2, ... """
+        eigenvalues, umatrix, uinverse = self.get_substitution_model(utils.get_region(gene))
+        site_rates = self.get_site_rates(seq, gene, reco_event, rng)
+        nuke_indices = {n : i for i, n in enumerate(utils.nukes)}
+
+        def mutate_branch(parent_states, length):  # sample child states given parent states: P(t) = U exp(lambda r t) U^-1, but we only need the rows corresponding to the parent states
+            if length <= 0.:
+                return parent_states
+            exps = numpy.exp(numpy.outer(site_rates * length, eigenvalues))
+            probs = numpy.einsum('ik,kj->ij', umatrix[parent_states] * exps, uinverse)
+            numpy.clip(probs, 0., None, out=probs)  # tiny negative values from roundoff
+            cumprobs = numpy.cumsum(probs, axis=1)
+            draws = rng.uniform(size=len(parent_states)) * cumprobs[:, -1]
+            return numpy.minimum((draws[:, None] >= cumprobs).sum(axis=1), 3)
+
+        tree = treegenerator.get_btree(treestr)
+        mutated_seqs = {}
+        root_states = numpy.array([nuke_indices[n] for n in seq])
+        nodestack = [(node, root_states) for node in (tree.root.children if hasattr(tree, 'root') else tree.leaves)]  # the root's branch length is zero, but its child's isn't (and bppseqgen would also have included it, thanks to the dummy leaf)
+        while len(nodestack) > 0:
+            node, parent_states = nodestack.pop()
+            states = mutate_branch(parent_states, node.length)
+            if node.branchType == 'leaf':
+                mutated_seqs[node.numName.strip('\'')] = ''.join(utils.nukes[i] for i in states)
+            else:
+                nodestack += [(child, states) for child in node.children]
+
+        try:
+            mutated_seqs = [mutated_seqs['t' + str(iseq + 1)] for iseq in range(len(mutated_seqs))]
+        except KeyError as ke:
+            raise Exception('leaf name %s not as expected in tree %s' % (ke, treestr))
+        return mutated_seqs
+
     # ----------------------------------------------------------------------------------------
     def add_shm_indels(self, reco_event):
         # NOTE that it will eventually make sense to add shared indel mutation according to the chosen tree -- i.e., probably, with some probability apply an indel instead of a point mutation
@@ -541,27 +625,34 @@ class Recombinator(object):
         if self.args.debug:
             print '  chose tree with total height %f' % treegenerator.get_mean_height(chosen_tree)
             print '    regional trees rescaled to heights:  %s' % ('   '.join(['%s %.3f  (expected %.3f)' % (region, treegenerator.get_mean_height(scaled_trees[region]), regional_heights[region]) for region in utils.regions]))
-            print '    tree passed to bppseqgen:'
+            print '    chosen tree:'
             print treegenerator.get_ascii_tree(chosen_tree, extra_str='      ')
 
         n_leaves = treegenerator.get_n_leaves(chosen_tree)
-        cmdfos = []
         regional_naive_seqs = {}  # only used for tree checking
         for region in utils.regions:
             simstr = reco_event.eroded_seqs[region]
             if region == 'd':
                 simstr = reco_event.insertions['vd'] + simstr + reco_event.insertions['dj']
-            cmdfos.append(self.prepare_bppseqgen(simstr, scaled_trees[region], n_leaves, reco_event.genes[region], reco_event, seed=irandom))
             regional_naive_seqs[region] = simstr
 
-        utils.run_cmds([cfo for cfo in cmdfos if cfo is not None], sleep=False)  # shenanigan is to handle zero-length regional seqs
-
         mseqs = {}
-        for ireg in range(len(utils.regions)):  # NOTE kind of sketchy just using index in <utils.regions> (although it just depends on the loop immediately above a.t.m.)
-            if cmdfos[ireg] is None:
-                mseqs[utils.regions[ireg]] = ['' for _ in range(n_leaves)]  # return an empty string for each leaf node
-            else:
-                mseqs[utils.regions[ireg]] = self.read_bppseqgen_output(cmdfos[ireg], n_leaves)
+        if self.args.use_bppseqgen:
+            cmdfos = [self.prepare_bppseqgen(regional_naive_seqs[region], scaled_trees[region], n_leaves, reco_event.genes[region], reco_event, seed=irandom) for region in utils.regions]
+            utils.run_cmds([cfo for cfo in cmdfos if cfo is not None], sleep=False)  # shenanigan is to handle zero-length regional seqs
+            for ireg in range(len(utils.regions)):  # NOTE kind of sketchy just using index in <utils.regions> (although it just depends on the loop immediately above a.t.m.)
+                if cmdfos[ireg] is None:
+                    mseqs[utils.regions[ireg]] = ['' for _ in range(n_leaves)]  # return an empty string for each leaf node
+                else:
+                    mseqs[utils.regions[ireg]] = self.read_bppseqgen_output(cmdfos[ireg], n_leaves)
+        else:
+            rng = numpy.random.RandomState(irandom)  # separate generator, so we don't perturb the global numpy stream (which e.g. add_shm_indels() uses)
+            for region in utils.regions:
+                if len(regional_naive_seqs[region]) == 0:
+                    mseqs[region] = ['' for _ in range(n_leaves)]
+                else:
+                    mseqs[region] = self.evolve_seq(regional_naive_seqs[region], scaled_trees[region], reco_event.genes[region], reco_event, rng)
+                assert len(mseqs[region]) == n_leaves
 
         assert len(reco_event.final_seqs) == 0
 
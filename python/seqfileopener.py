@@ -108,9 +108,9 @@ def read_sequence_file(infname, is_data, n_max_queries=-1, args=None, simglfo=No
     if suffix in delimit_info:
         seqfile = open(infname)  # closes on function exit. no, this isn't the best way to do this
         reader = csv.DictReader(seqfile, delimiter=delimit_info[suffix])
-    elif suffix in ['.fa', '.fasta', '.fastx']:
-        reader = utils.read_fastx(infname, name_key='unique_ids', seq_key='input_seqs', add_info=False, sanitize=True, n_max_queries=n_max_queries,  # NOTE don't use istarstop kw arg here, 'cause it fucks with the istartstop treatment in the loop below
-                                  queries=(args.queries if (args is not None and not args.abbreviate) else None))  # NOTE also can't filter on args.queries here if we're also translating
+    elif infname == '-' or utils.get_uncompressed_suffix(infname) in utils.fastx_suffixes.keys() + ['.fastx']:  # NOTE streams the file (so e.g. --n-max-queries doesn't read any more than it needs)
+        reader = utils.iterate_fastx(infname, name_key='unique_ids', seq_key='input_seqs', add_info=False, sanitize=True, n_max_queries=n_max_queries,  # NOTE don't use istarstop kw arg here, 'cause it fucks with the istartstop treatment in the loop below
+                                     queries=(args.queries if (args is not None and not args.abbreviate) else None))  # NOTE also can't filter on args.queries here if we're also translating (and don't use allowed_chars, since we only want to check the alphabet of the seqs we keep, which we do below)
     elif suffix == '.yaml':
         yaml_glfo, reader, _ = utils.read_yaml_output(infname, n_max_queries=n_max_queries, synth_single_seqs=True, dont_add_implicit_info=True)  # not really sure that long term I want to synthesize single seq lines, but for backwards compatibility it's nice a.t.m.
         if not is_data:
@@ -184,7 +184,7 @@ def read_sequence_file(infname, is_data, n_max_queries=-1, args=None, simglfo=No
         if uid in input_info:
             raise Exception('found uid \'%s\' twice in input file %s' % (uid, infname))
 
-        if any(c not in utils.alphabet for c in inseq):
+        if not utils.alphabet.issuperset(inseq):  # only check the sequences we're actually keeping (i.e. not ones skipped by --istartstop, --queries, or --reco-ids)
             unexpected_chars = set([ch for ch in inseq if ch not in utils.alphabet])
             raise Exception('unexpected character%s %s (not among %s) in input sequence with id %s:\n  %s' % (utils.plural(len(unexpected_chars)), ', '.join([('\'%s\'' % ch) for ch in unexpected_chars]), utils.nukes + utils.ambiguous_bases, uid, inseq))
 
@@ -194,7 +194,7 @@ def read_sequence_file(infname, is_data, n_max_queries=-1, args=None, simglfo=No
         if not is_data:
             if 'v_gene' not in line:
                 raise Exception('simulation info not found in %s' % infname)
-            reco_info[uid] = copy.deepcopy(line)
+            reco_info[uid] = utils.LazyLine(copy.deepcopy(line))
             if simglfo is not None:
                 utils.add_implicit_info(simglfo, reco_info[uid])
 
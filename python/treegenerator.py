@@ -8,6 +8,7 @@ import random
 import json
 import numpy
 import math
+import heapq
 from cStringIO import StringIO
 import tempfile
 from subprocess import check_call
@@ -85,6 +86,71 @@ def rescale_tree(treestr, new_height, debug=False):
             raise Exception('tree not rescaled properly:   %.10f   %.10f    %e' % (leaf.height, new_height, (leaf.height - new_height) / new_height))
     return treestr
 
+# ----------------------------------------------------------------------------------------
+def get_newick(children, depths, root, root_length, names):
+    """ newick string for the tree in <children> (map from each internal node to its children), where <depths> are distances back from the leaves (the present), and the leaves are named with <names> """
+    substrs = {}
+    stack = [(root, False)]
+    while len(stack) > 0:  # post-order traversal (we don't recurse, since big trees can be very unbalanced)
+        node, expanded = stack.pop()
+        if node not in children:
+            substrs[node] = names[node]
+        elif not expanded:
+            stack.append((node, True))
+            stack += [(child, False) for child in children[node]]
+        else:
+            substrs[node] = '(%s)' % ','.join(['%s:%.15f' % (substrs.pop(child), depths[node] - depths[child]) for child in children[node]])
+    return '%s:%.15f;' % (substrs[root], root_length)
+
+# ----------------------------------------------------------------------------------------
+def simulate_bd_taxa_age(n_leaves, age, rng, birth_rate=1., death_rate=0.5):
+    """
+    Sample a birth-death tree with <n_leaves> extant leaves, conditioned on time <age> since the origin, i.e. the equivalent of TreeSim's sim.bd.taxa.age() with mrca=FALSE and complete sampling.
+    Conditioned on the origin time the n-1 speciation times are iid (Stadler 2011, Gernhard 2008), and a tree with uniformly-ordered leaves is given by putting the i-th speciation time between the i-th and (i+1)-th leaves (the coalescent point process).
+    """
+    assert birth_rate > death_rate
+    net_rate = birth_rate - death_rate
+    def cumulative(t):  # proportional to the cdf of each speciation time
+        return (1. - math.exp(-net_rate * t)) / (birth_rate - death_rate * math.exp(-net_rate * t))
+    yvals = rng.uniform(size=n_leaves - 1) * cumulative(age)
+    speciation_times = -numpy.log((1. - yvals * birth_rate) / (1. - yvals * death_rate)) / net_rate  # invert the cdf
+
+    # make the tree, with leaves 0 to n-1, and internal node n + i at depth speciation_times[i] between leaves i and i+1 (it's the cartesian tree of the speciation times)
+    children = {}
+    stack = []
+    for igap, depth in enumerate(speciation_times):
+        node, last_popped = n_leaves + igap, None
+        while len(stack) > 0 and speciation_times[stack[-1] - n_leaves] < depth:
+            last_popped = stack.pop()
+        children[node] = [last_popped if last_popped is not None else igap, igap + 1]
+        if len(stack) > 0:
+            children[stack[-1]][1] = node
+        stack.append(node)
+    depths = [0. for _ in range(n_leaves)] + list(speciation_times)
+    return get_newick(children, depths, stack[0], age - depths[stack[0]], ['t%d' % (il + 1) for il in range(n_leaves)])
+
+# ----------------------------------------------------------------------------------------
+def simulate_weibull_taxa(n_leaves, shape, rng):
+    """
+    Sample a tree with <n_leaves> extant leaves in which each lineage splits in two after a weibull-distributed (scale 1) waiting time, with no extinction, i.e. the equivalent of TreeSimGM's sim.taxa() with symmetric speciation.
+    Starting from a single lineage at time zero, we go forward until there are <n_leaves> lineages, then stop at a time chosen uniformly before the next speciation.
+    """
+    children, times = {}, {}
+    lineages = [(rng.weibull(shape), 0)]  # heap of (speciation time, node that the lineage leads to)
+    n_nodes = 1
+    while len(lineages) < n_leaves:
+        speciation_time, node = heapq.heappop(lineages)
+        times[node] = speciation_time
+        children[node] = [n_nodes, n_nodes + 1]
+        for child in children[node]:
+            heapq.heappush(lineages, (speciation_time + rng.weibull(shape), child))
+        n_nodes += 2
+    end_time = rng.uniform(max(times.values()), lineages[0][0])
+    names = {node : 't%d' % (il + 1) for il, node in enumerate(sorted(n for _, n in lineages))}
+    depths = {node : end_time - t for node, t in times.items()}
+    depths.update({node : 0. for node in names})
+    return get_newick(children, depths, 0, end_time - depths[0], names)
+
 # ----------------------------------------------------------------------------------------
 class TreeGenerator(object):
     def __init__(self, args, parameter_dir, seed):
@@ -150,40 +216,33 @@ class TreeGenerator(object):
                 raise Exception('not normalized %f' % check_sum)
 
     #----------------------------------------------------------------------------------------
-    def post_process_trees(self, treefname, lonely_leaves, ages):
+    def post_process_trees(self, treestrs, ages, treefname):
         """ 
         Each tree is written with branch length the mean branch length over the whole sequence
         So we need to add the length for each region afterward, so each line looks e.g. like
         (t2:0.003751736951,t1:0.003751736951):0.001248262937;v:0.98,d:1.8,j:0.87
         """
 
-        # first read the newick info for each tree
-        with open(treefname, 'r') as treefile:
-            treestrs = treefile.readlines()
-
-        # then add the single-leaf trees
-        for itree in range(len(ages)):
-            if lonely_leaves[itree]:
-                treestrs.insert(itree, 't1:%f;\n' % ages[itree])
         if len(treestrs) != len(ages):
-            raise Exception('expected %d trees, but read %d from %s' % (len(ages), len(treestrs), treefname))
+            raise Exception('expected %d trees, but got %d' % (len(ages), len(treestrs)))
 
-        # then rescale branch lengths (TreeSim lets you specify the number of leaves and the height at the same time, but TreeSimGM doesn't, and TreeSim's numbers are usually a little off anyway... so we rescale everybody)
+        # rescale branch lengths (TreeSim lets you specify the number of leaves and the height at the same time, but TreeSimGM doesn't, and TreeSim's numbers are usually a little off anyway... so we rescale everybody)
         for itree in range(len(ages)):
             treestrs[itree] = rescale_tree(treestrs[itree], ages[itree])
 
         # print some summary information
         if self.args.debug:
             if self.args.debug > 1:
-                print '        n-leaves       height'
-            heights, n_leaves = [], []  # just for debug printing
+                print '        n-leaves       height    external frac'
+            heights, n_leaves, external_fractions = [], [], []  # just for debug printing
             for itree in range(len(ages)):
                 tree = get_btree(treestrs[itree])
                 heights.append(sum([l.height for l in tree.leaves]) / len(tree.leaves))  # mean height -- should be the same for all of them though
                 n_leaves.append(len(tree.leaves))
+                external_fractions.append(sum([l.length for l in tree.leaves]) / sum([ln.length for ln in tree.Objects]))  # fraction of total tree length in leaf branches (a decent summary of tree shape to compare to TreeSim)
                 if self.args.debug > 1:
-                    print '       %5d         %8.6f' % (n_leaves[-1], heights[-1])
-            print '    mean over %d trees:   depth %.5f   n-leaves %.2f' % (len(heights), sum(heights) / len(heights), float(sum(n_leaves)) / len(n_leaves))
+                    print '       %5d         %8.6f     %5.3f' % (n_leaves[-1], heights[-1], external_fractions[-1])
+            print '    mean over %d trees:   depth %.5f   n-leaves %.2f   external frac %.3f' % (len(heights), sum(heights) / len(heights), float(sum(n_leaves)) / len(n_leaves), sum(external_fractions) / len(external_fractions))
 
         # then add the region-specific branch info as an extra string tacked onto the right of the newick tree (so the output file isn't newick any more, sigh)
         length_list = ['%s:%f' % (region, self.branch_lengths[region]['mean'] / self.branch_lengths['all']['mean']) for region in utils.regions]
@@ -225,10 +284,7 @@ class TreeGenerator(object):
             raise Exception('n leaf distribution %s not among allowed choices' % self.args.n_leaf_distribution)
 
     # ----------------------------------------------------------------------------------------
-    def generate_trees(self, seed, outfname):
-        if os.path.exists(outfname):
-            os.remove(outfname)
-
+    def run_treesim(self, seed, outfname, n_leaf_list, ages):  # run TreeSim (or TreeSimGM) in R, mostly for cross-checking simulate_bd_taxa_age() and simulate_weibull_taxa()
         # build command file, one (painful) tree at a time
         with tempfile.NamedTemporaryFile() as commandfile:
             pkgname = 'TreeSim'
@@ -236,15 +292,9 @@ class TreeGenerator(object):
                 pkgname += 'GM'
             commandfile.write('require(%s, quietly=TRUE)\n' % pkgname)
             commandfile.write('set.seed(' + str(seed)+ ')\n')
-            ages, lonely_leaves = [], []  # <lonely_leaves> keeps track of which trees should have only one leaf, so we can go back and add them later in the proper spots
-            for itree in range(self.args.n_trees):
-                n_leaves = self.choose_n_leaves()
-                age = self.choose_full_sequence_branch_length()
-                ages.append(age)
-                if n_leaves == 1:
-                    lonely_leaves.append(True)
+            for n_leaves, age in zip(n_leaf_list, ages):
+                if n_leaves == 1:  # we add these afterwards
                     continue
-                lonely_leaves.append(False)
 
                 # NOTE these simulation functions seem to assume that we want all the extant leaves to have the same height. Which is kind of weird. Maybe makes more sense at some point to change this.
                 params = {'n' : n_leaves, 'numbsim' : self.n_trees_each_run}
@@ -262,9 +312,40 @@ class TreeGenerator(object):
                 commandfile.write('write.tree(trees[[1]], \"' + outfname + '\", append=TRUE)\n')
 
             commandfile.flush()  # BEWARE if you forget this you are fucked
-            if lonely_leaves.count(True) == len(ages):  # if every tree has one leaf, we don't need to run R
+            if n_leaf_list.count(1) == len(n_leaf_list):  # if every tree has one leaf, we don't need to run R
                 open(outfname, 'w').close()
             else:
                 check_call('R --slave -f ' + commandfile.name, shell=True)
 
-        self.post_process_trees(outfname, lonely_leaves, ages)
+        with open(outfname) as treefile:
+            treestrs = [l.strip() for l in treefile.readlines()]
+        os.remove(outfname)
+        for itree in range(len(ages)):  # add the single-leaf trees in the proper spots
+            if n_leaf_list[itree] == 1:
+                treestrs.insert(itree, 't1:%f;' % ages[itree])
+        return treestrs
+
+    # ----------------------------------------------------------------------------------------
+    def generate_trees(self, seed, outfname):
+        if os.path.exists(outfname):
+            os.remove(outfname)
+
+        n_leaf_list, ages = [], []
+        for itree in range(self.args.n_trees):
+            n_leaf_list.append(self.choose_n_leaves())
+            ages.append(self.choose_full_sequence_branch_length())
+
+        if self.args.use_treesim:
+            treestrs = self.run_treesim(seed, outfname, n_leaf_list, ages)
+        else:
+            rng = numpy.random.RandomState(seed)
+            treestrs = []
+            for n_leaves, age in zip(n_leaf_list, ages):
+                if n_leaves == 1:
+                    treestrs.append('t1:%.15f;' % age)
+                elif self.args.root_mrca_weibull_parameter is None:
+                    treestrs.append(simulate_bd_taxa_age(n_leaves, age, rng))
+                else:
+                    treestrs.append(simulate_weibull_taxa(n_leaves, self.args.root_mrca_weibull_parameter, rng))  # gets rescaled to <age> in post_process_trees()
+
+        self.post_process_trees(treestrs, ages, outfname)
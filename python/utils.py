@@ -20,11 +20,18 @@ import copy
 import traceback
 import json
 import types
+import signal
+import select
+import errno
+import fcntl
+import gzip
+import bz2
 import collections
 import operator
 
 import indelutils
 import clusterpath
+import clustermetrics
 
 # ----------------------------------------------------------------------------------------
 def fsdir():
@@ -280,6 +287,9 @@ linekeys['extra'] = []
 linekeys['simu'] = ['reco_id', ]
 all_linekeys = set([k for cols in linekeys.values() for k in cols])
 
+# per-seq numeric keys that we keep as numpy arrays in memory (they're converted back to lists on output, by get_output_value())
+per_seq_array_dtypes = {'mut_freqs' : numpy.float64, 'n_mutations' : numpy.int32}
+
 # keys that are added by add_implicit_info()
 implicit_linekeys = set(['naive_seq', 'cdr3_length', 'codon_positions', 'lengths', 'regional_bounds', 'invalid', 'indel_reversed_seqs'] + \
                         [r + '_gl_seq' for r in regions] + \
@@ -352,7 +362,9 @@ def synthesize_single_seq_line(line, iseq):
     """ without modifying <line>, make a copy of it corresponding to a single-sequence event with the <iseq>th sequence """
     singlefo = {}
     for key in line:
-        if key in linekeys['per_seq']:
+        if isinstance(line[key], numpy.ndarray):
+            singlefo[key] = line[key][iseq : iseq + 1].copy()
+        elif key in linekeys['per_seq']:
             singlefo[key] = [copy.deepcopy(line[key][iseq]), ]
         else:
             singlefo[key] = copy.deepcopy(line[key])
@@ -370,6 +382,8 @@ def synthesize_multi_seq_line_from_reco_info(uids, reco_info):  # assumes you al
     for col in [c for c in linekeys['per_seq'] if c in multifo]:
         assert [len(reco_info[uid][col]) for uid in uids].count(1) == len(uids)  # make sure every uid's info for this column is of length 1
         multifo[col] = [copy.deepcopy(reco_info[uid][col][0]) for uid in uids]
+        if col in per_seq_array_dtypes:
+            multifo[col] = get_per_seq_array(col, multifo[col])
     return multifo
 
 # ----------------------------------------------------------------------------------------
@@ -950,6 +964,8 @@ def reset_effective_erosions_and_effective_insertions(glfo, padded_line, aligned
         print 'resetting effective erosions/insertions for %s' % ' '.join(padded_line['unique_ids'])
 
     line = {k : copy.deepcopy(padded_line[k]) for k in padded_line if k not in implicit_linekeys}
+    if isinstance(padded_line, LazyLine):
+        line = LazyLine(line)
 
     assert line['v_5p_del'] == 0  # just to be safe
     assert line['j_3p_del'] == 0
@@ -1046,6 +1062,12 @@ def add_qr_seqs(line):
     for region in regions:
         line[region + '_qr_seqs'] = [get_single_qr_seq(region, seq) for seq in line['seqs']]
 
+# ----------------------------------------------------------------------------------------
+def add_mutation_info(line):
+    hfracfo = [hamming_fraction(line['naive_seq'], mature_seq, also_return_distance=True) for mature_seq in line['seqs']]
+    line['mut_freqs'] = get_per_seq_array('mut_freqs', [hfrac for hfrac, _ in hfracfo])
+    line['n_mutations'] = get_per_seq_array('n_mutations', [n_mutations for _, n_mutations in hfracfo])
+
 # ----------------------------------------------------------------------------------------
 def is_functional_dbg_str(line, iseq):  # NOTE code duplication with is_functional(
     dbg_str_list = []
@@ -1135,6 +1157,188 @@ def add_linearham_info(sw_info, query_names, line):
         for gene in set(sw_info[query]['relpos']) - set(line['relpos']):  # loop over genes that haven't come up yet in previous queries (note that this takes <pos> from the first <name> that happens to have a match to <gene>)
             line['relpos'][gene] = sw_info[query]['relpos'][gene]
 
+# ----------------------------------------------------------------------------------------
+interned_value_keys = set([r + '_gene' for r in regions] + ['all_matches', 'genes'])  # keys whose values (including in nested lists and dicts) are gene names, which are repeated in lots of lines
+
+# ----------------------------------------------------------------------------------------
+def compact_value(val, intern_strs=False):
+    """
+    Return a version of <val> that takes less memory: unicode (e.g. from json.loads()) is converted to str (which is a quarter the size), and dict keys (and if <intern_strs>, all strings) are interned.
+    Lists and dicts are modified in place, since other things sometimes hold references to them (e.g. waterer's indel info).
+    """
+    if isinstance(val, unicode):
+        try:
+            val = str(val)
+        except UnicodeEncodeError:  # leave non-ascii strings alone
+            return val
+    if isinstance(val, str):
+        return intern(val) if intern_strs else val
+    elif isinstance(val, list):
+        for ival in range(len(val)):
+            val[ival] = compact_value(val[ival], intern_strs=intern_strs)
+    elif isinstance(val, dict):
+        for key in val.keys():  # popping and re-adding them in their original order keeps OrderedDicts in the same order
+            subval = val.pop(key)
+            val[compact_value(key, intern_strs=True)] = compact_value(subval, intern_strs=intern_strs or key in interned_value_keys)
+    return val
+
+# ----------------------------------------------------------------------------------------
+def compact_line(line):  # in-place version of compact_value() for an annotation <line> (a LazyLine's pending keys aren't touched, since they don't exist yet), which also converts the keys in <per_seq_array_dtypes> to numpy arrays
+    for key in dict.keys(line):
+        val = dict.pop(line, key)
+        if key in per_seq_array_dtypes:
+            val = get_per_seq_array(key, val)
+        dict.__setitem__(line, compact_value(key, intern_strs=True), compact_value(val, intern_strs=key in interned_value_keys))
+
+# ----------------------------------------------------------------------------------------
+def get_per_seq_array(key, vals):  # numpy array for per-seq numeric key <key> (an int32 array is 4 bytes per seq, vs 8 for the list pointer plus 24 for each int object), or <vals> unchanged if they aren't all numbers (e.g. empty strings in csv files)
+    try:
+        return numpy.array(vals, dtype=per_seq_array_dtypes[key])
+    except (ValueError, TypeError):
+        return vals
+
+# ----------------------------------------------------------------------------------------
+def get_output_value(val):  # convert numpy arrays (see <per_seq_array_dtypes>) back to lists, e.g. for json
+    return val.tolist() if isinstance(val, numpy.ndarray) else val
+
+# ----------------------------------------------------------------------------------------
+def values_equal(val1, val2):  # == that also works for numpy arrays (for which == is elementwise)
+    if isinstance(val1, numpy.ndarray) or isinstance(val2, numpy.ndarray):
+        return numpy.array_equal(val1, val2)
+    return val1 == val2
+
+# ----------------------------------------------------------------------------------------
+class LazyLine(dict):
+    """
+    Annotation dict for which add_implicit_info() defers the more expensive implicit info (regional query seqs, functional info, and mutation info) until the first time it's accessed.
+    Behaves like a plain dict, i.e. pending keys show up in key lookups and iteration over keys, while anything that needs all the values (items(), copying, pickling, comparison) first calculates everything.
+    NOTE in python 2, dict(lazyline) and <some_dict>.update(lazyline) read the underlying dict directly, so they silently skip any pending keys -- use copy.copy(lazyline) (or lazyline.copy()) instead.
+    """
+    __slots__ = ('pending', )  # no per-instance __dict__
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.pending = {}  # maps each key that hasn't yet been calculated to (keys, fcn, tmpline) for its group
+
+    # ----------------------------------------------------------------------------------------
+    def set_pending(self, keys, fcn, tmpline):  # <fcn> adds <keys> to (a shallow copy of) <tmpline>
+        for key in keys:
+            dict.pop(self, key, None)
+            self.pending[key] = (keys, fcn, tmpline)
+
+    # ----------------------------------------------------------------------------------------
+    def calculate(self, key):
+        pfo = self.pending[key]
+        keys, fcn, tmpline = pfo
+        tmpline = dict(tmpline)  # don't modify the one that's shared with the other groups
+        fcn(tmpline)
+        for k in keys:
+            if self.pending.get(k) is pfo:  # skip any that were set or deleted in the meantime
+                del self.pending[k]
+                dict.__setitem__(self, k, tmpline[k])
+
+    # ----------------------------------------------------------------------------------------
+    def calculate_all(self):
+        while len(self.pending) > 0:
+            self.calculate(next(iter(self.pending)))
+
+    def __missing__(self, key):
+        if key not in self.pending:
+            raise KeyError(key)
+        self.calculate(key)
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, val):
+        self.pending.pop(key, None)
+        dict.__setitem__(self, key, val)
+
+    def __delitem__(self, key):
+        if key in self.pending:
+            del self.pending[key]
+        else:
+            dict.__delitem__(self, key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.pending
+
+    def has_key(self, key):
+        return key in self
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key in self.pending:
+            self.calculate(key)
+        return dict.pop(self, key, *default)
+
+    def update(self, *args, **kwargs):
+        for key, val in dict(*args, **kwargs).items():
+            self[key] = val
+
+    def __iter__(self):
+        return itertools.chain(dict.__iter__(self), list(self.pending))
+
+    def iterkeys(self):
+        return iter(self)
+
+    def keys(self):
+        return list(self)
+
+    def __len__(self):
+        return dict.__len__(self) + len(self.pending)
+
+    def copy(self):
+        self.calculate_all()
+        return LazyLine(dict.items(self))
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        self.calculate_all()
+        return LazyLine(copy.deepcopy(dict.items(self), memo))
+
+    def __reduce__(self):  # for pickling (e.g. multiprocessing)
+        self.calculate_all()
+        return (LazyLine, (dict.items(self), ))
+
+    def __eq__(self, other):
+        self.calculate_all()
+        if isinstance(other, LazyLine):
+            other.calculate_all()
+        if not isinstance(other, dict) or set(dict.keys(self)) != set(dict.keys(other)):
+            return False
+        return all(values_equal(dict.__getitem__(self, k), dict.__getitem__(other, k)) for k in dict.keys(self))  # can't use dict.__eq__(), since some values are numpy arrays
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        self.calculate_all()
+        return dict.__repr__(self)
+
+    def items(self):
+        self.calculate_all()
+        return dict.items(self)
+
+    def iteritems(self):
+        self.calculate_all()
+        return dict.iteritems(self)
+
+    def values(self):
+        self.calculate_all()
+        return dict.values(self)
+
+    def itervalues(self):
+        self.calculate_all()
+        return dict.itervalues(self)
+
 # ----------------------------------------------------------------------------------------
 def add_implicit_info(glfo, line, aligned_gl_seqs=None, check_line_keys=False, reset_indel_genes=False):  # should turn on <check_line_keys> for a bit if you change anything
     """ Add to <line> a bunch of things that are initially only implicit. """
@@ -1195,18 +1399,24 @@ def add_implicit_info(glfo, line, aligned_gl_seqs=None, check_line_keys=False, r
     line['regional_bounds'] = {r : (start[r], end[r]) for r in regions}
 
     indelutils.deal_with_indel_stuff(line, reset_indel_genes=reset_indel_genes)
-    input_codon_positions = [indelutils.get_codon_positions_with_indels_reinstated(line, iseq, line['codon_positions']) for iseq in range(len(line['seqs']))]
     if 'indel_reversed_seqs' not in line:  # everywhere internally, we refer to 'indel_reversed_seqs' as simply 'seqs'. For interaction with outside entities, however (i.e. writing files) we use the more explicit 'indel_reversed_seqs'
         line['indel_reversed_seqs'] = line['seqs']
 
-    # add regional query seqs
-    add_qr_seqs(line)
-
-    add_functional_info(glfo['locus'], line, input_codon_positions)
-
-    hfracfo = [hamming_fraction(line['naive_seq'], mature_seq, also_return_distance=True) for mature_seq in line['seqs']]
-    line['mut_freqs'] = [hfrac for hfrac, _ in hfracfo]
-    line['n_mutations'] = [n_mutations for _, n_mutations in hfracfo]
+    # add regional query seqs, functional info, and mutation info (for a LazyLine, each group is only calculated when one of its keys is first accessed)
+    def add_input_functional_info(tmpline):
+        input_codon_positions = [indelutils.get_codon_positions_with_indels_reinstated(tmpline, iseq, tmpline['codon_positions']) for iseq in range(len(tmpline['seqs']))]
+        add_functional_info(glfo['locus'], tmpline, input_codon_positions)
+    lazy_groups = [([r + '_qr_seqs' for r in regions], add_qr_seqs),
+                   (functional_columns, add_input_functional_info),
+                   (['mut_freqs', 'n_mutations'], add_mutation_info)]
+    if isinstance(line, LazyLine):
+        tmpline = {k : line[k] for k in ['fv_insertion', 'vd_insertion', 'dj_insertion', 'jf_insertion', 'v_5p_del', 'naive_seq'] + [r + '_gl_seq' for r in regions]}  # immutable, so no need to copy
+        tmpline.update({'seqs' : list(line['seqs']), 'input_seqs' : list(line['input_seqs']), 'codon_positions' : dict(line['codon_positions']), 'indelfos' : [copy.deepcopy(ifo) if indelutils.has_indels(ifo) else indelutils.get_empty_indel() for ifo in line['indelfos']]})  # but these get modified in place (e.g. when padding seqs in waterer), so the groups would no longer correspond to the rest of the line
+        for keys, fcn in lazy_groups:
+            line.set_pending(keys, fcn, tmpline)
+    else:
+        for _, fcn in lazy_groups:
+            fcn(line)
 
     # set validity (alignment addition [below] can also set invalid)  # it would be nice to clean up this checking stuff
     line['invalid'] = False
@@ -1234,7 +1444,7 @@ def add_implicit_info(glfo, line, aligned_gl_seqs=None, check_line_keys=False, r
             raise Exception('added new keys that aren\'t in implicit_linekeys: %s' % ' '.join(new_keys - implicit_linekeys))
         for ikey in implicit_linekeys:  # make sure every key/value we added is either a) new or b) the same as it was before
             if ikey in initial_keys:
-                if pre_existing_implicit_info[ikey] != line[ikey]:
+                if not values_equal(pre_existing_implicit_info[ikey], line[ikey]):
                     print '%s pre-existing info for \'%s\' in %s\n    %s\n    doesn\'t match new info\n    %s' % (color('yellow', 'warning'), ikey, line['unique_ids'], pre_existing_implicit_info[ikey], line[ikey])
             else:
                 assert ikey in new_keys  # only really checks the logic of the previous few lines
@@ -1540,6 +1750,69 @@ def find_replacement_genes(param_dir, min_counts, gene_name=None, debug=False, a
     # print '    \nWARNING return default gene %s \'cause I couldn\'t find anything remotely resembling %s' % (color_gene(hackey_default_gene_versions[region]), color_gene(gene_name))
     # return hackey_default_gene_versions[region]
 
+# ----------------------------------------------------------------------------------------
+hamming_valid_lookup = numpy.ones(256, dtype=numpy.bool_)  # indexed by uint8 character code: False for characters that are skipped when calculating hamming distances (i.e. ambiguous bases and gaps)
+hamming_valid_lookup[[ord(c) for c in ambiguous_bases + gap_chars]] = False
+hamming_skip_chars = set(ambiguous_bases + gap_chars)  # same thing, for the pure-python loop in hamming_distance()
+hamming_min_numpy_length = 80  # hamming_distance() uses numpy for seqs at least this long (below this, the per-call overhead makes it slower than the plain loop)
+
+# ----------------------------------------------------------------------------------------
+def seqs_to_uint8(seqs):  # encode a list of equal-length sequences as a 2d uint8 array (one row per sequence)
+    if len(seqs) == 0:
+        return numpy.zeros((0, 0), dtype=numpy.uint8)
+    seqlen = len(seqs[0])
+    if any(len(s) != seqlen for s in seqs):
+        lengths = sorted(set(len(s) for s in seqs))
+        raise Exception('unequal length sequences (lengths: %s):\n  %s' % (' '.join(str(l) for l in lengths), '\n  '.join(seqs[:5])))
+    return numpy.frombuffer(''.join(str(s) for s in seqs), dtype=numpy.uint8).reshape(len(seqs), seqlen)  # str() is only there for unicode from json
+
+# ----------------------------------------------------------------------------------------
+def hamming_distances(seq, seqs, return_len_excluding_ambig=False):
+    """ one-vs-many: return numpy array of hamming distances between <seq> and each sequence in <seqs> (and, optionally, also the lengths excluding ambiguous bases and gaps) """
+    seq_array = seqs_to_uint8([seq])
+    seqs_array = seqs_to_uint8(seqs) if len(seqs) > 0 else numpy.zeros((0, len(seq)), dtype=numpy.uint8)
+    if seqs_array.shape[1] != seq_array.shape[1]:
+        raise Exception('unequal length sequences %d %d:\n  %s\n  %s' % (seq_array.shape[1], seqs_array.shape[1], seq, seqs[0]))
+    valid = hamming_valid_lookup[seqs_array] & hamming_valid_lookup[seq_array]
+    distances = ((seqs_array != seq_array) & valid).sum(axis=1)
+    if return_len_excluding_ambig:
+        return distances, valid.sum(axis=1)
+    else:
+        return distances
+
+# ----------------------------------------------------------------------------------------
+def hamming_distance_matrix(seqs_a, seqs_b=None, return_len_excluding_ambig=False):
+    """
+    many-vs-many: return 2d numpy array with the hamming distance between each sequence in <seqs_a> (rows) and each in <seqs_b> (columns, defaults to <seqs_a>).
+    Uses one-hot encodings and matrix multiplication, so for each pair we get the number of positions at which both are valid (non-ambiguous, non-gap) and the number of those at which they match.
+    """
+    array_a = seqs_to_uint8(seqs_a)
+    array_b = array_a if seqs_b is None else seqs_to_uint8(seqs_b)
+    if array_a.shape[1] != array_b.shape[1] and array_a.shape[0] > 0 and array_b.shape[0] > 0:
+        raise Exception('unequal length sequences %d %d:\n  %s\n  %s' % (array_a.shape[1], array_b.shape[1], seqs_a[0], seqs_b[0]))
+    valid_a, valid_b = hamming_valid_lookup[array_a], hamming_valid_lookup[array_b]
+    len_excluding_ambig = numpy.dot(valid_a.astype(numpy.float32), valid_b.astype(numpy.float32).T)  # float32 is exact for integers up to 2^24, and way faster than integer matrix multiplication
+    n_matches = numpy.zeros(len_excluding_ambig.shape, dtype=numpy.float32)
+    for char in numpy.unique(numpy.concatenate([array_a[valid_a], array_b[valid_b]])):
+        n_matches += numpy.dot((array_a == char).astype(numpy.float32), (array_b == char).astype(numpy.float32).T)
+    distances = numpy.rint(len_excluding_ambig - n_matches).astype(numpy.int64)
+    if return_len_excluding_ambig:
+        return distances, numpy.rint(len_excluding_ambig).astype(numpy.int64)
+    else:
+        return distances
+
+# ----------------------------------------------------------------------------------------
+def distances_to_fractions(distances, len_excluding_ambig):  # hamming fraction is zero if there's no non-ambiguous positions
+    return numpy.where(len_excluding_ambig > 0, distances / numpy.maximum(len_excluding_ambig, 1).astype(numpy.float64), 0.)
+
+# ----------------------------------------------------------------------------------------
+def hamming_fractions(seq, seqs):  # one-vs-many version of hamming_fraction()
+    return distances_to_fractions(*hamming_distances(seq, seqs, return_len_excluding_ambig=True))
+
+# ----------------------------------------------------------------------------------------
+def hamming_fraction_matrix(seqs_a, seqs_b=None):  # many-vs-many version of hamming_fraction()
+    return distances_to_fractions(*hamming_distance_matrix(seqs_a, seqs_b=seqs_b, return_len_excluding_ambig=True))
+
 # ----------------------------------------------------------------------------------------
 def hamming_distance(seq1, seq2, extra_bases=None, return_len_excluding_ambig=False, return_mutated_positions=False, align=False):
     if align:  # way the hell slower, of course
@@ -1552,18 +1825,26 @@ def hamming_distance(seq1, seq2, extra_bases=None, return_len_excluding_ambig=Fa
         else:
             return 0
 
-    skip_chars = set(ambiguous_bases + gap_chars)
-
-    distance, len_excluding_ambig = 0, 0
-    mutated_positions = []
-    for ich in range(len(seq1)):  # already made sure they're the same length
-        if seq1[ich] in skip_chars or seq2[ich] in skip_chars:
-            continue
-        len_excluding_ambig += 1
-        if seq1[ich] != seq2[ich]:
-            distance += 1
-            if return_mutated_positions:
-                mutated_positions.append(ich)
+    if len(seq1) < hamming_min_numpy_length:  # numpy's per-call overhead is bigger than the loop for short seqs (e.g. cdr3s)
+        distance, len_excluding_ambig = 0, 0
+        mutated_positions = []
+        for ich in range(len(seq1)):  # already made sure they're the same length
+            if seq1[ich] in hamming_skip_chars or seq2[ich] in hamming_skip_chars:
+                continue
+            len_excluding_ambig += 1
+            if seq1[ich] != seq2[ich]:
+                distance += 1
+                if return_mutated_positions:
+                    mutated_positions.append(ich)
+    else:
+        array_1, array_2 = seqs_to_uint8([seq1]), seqs_to_uint8([seq2])  # it'd be faster to call hamming_distances() or hamming_distance_matrix() directly if you have more than one pair
+        valid = hamming_valid_lookup[array_1[0]] & hamming_valid_lookup[array_2[0]]
+        mutated = (array_1[0] != array_2[0]) & valid
+        distance = int(mutated.sum())
+        if return_len_excluding_ambig:
+            len_excluding_ambig = int(valid.sum())
+        if return_mutated_positions:
+            mutated_positions = numpy.flatnonzero(mutated).tolist()
 
     if return_len_excluding_ambig and return_mutated_positions:
         return distance, len_excluding_ambig, mutated_positions
@@ -1574,15 +1855,6 @@ def hamming_distance(seq1, seq2, extra_bases=None, return_len_excluding_ambig=Fa
     else:
         return distance
 
-    # seems like it'd maybe be faster, but it's twice as slow:
-    # assert len(ambiguous_bases) == 1  # would just have to update the below if it's longer
-    # ambig_base = ambiguous_bases[0]
-    # if return_len_excluding_ambig:
-    #     spairs = [(ch1, ch2) for ch1, ch2 in zip(seq1, seq2) if ambig_base not in ch1 + ch2]
-    #     return sum(ch1 != ch2 for ch1, ch2 in spairs), len(spairs)
-    # else:
-    #     return sum(ch1 != ch2 for ch1, ch2 in zip(seq1, seq2) if ambig_base not in ch1 + ch2)
-
 # ----------------------------------------------------------------------------------------
 def hamming_fraction(seq1, seq2, extra_bases=None, also_return_distance=False):  # NOTE use hamming_distance() to get the positions (yeah, I should eventually add it here as well)
     distance, len_excluding_ambig = hamming_distance(seq1, seq2, extra_bases=extra_bases, return_len_excluding_ambig=True)
@@ -1858,7 +2130,7 @@ def get_line_for_output(headers, info, glfo=None):
                 if key in io_column_configs['lists-of-lists']:
                     outfo[key] = copy.deepcopy(info[key])
                 else:
-                    outfo[key] = info[key]
+                    outfo[key] = get_output_value(info[key])
             else:
                 add_extra_column(key, info, outfo, glfo=glfo)
 
@@ -1932,22 +2204,23 @@ def merge_csvs(outfname, csv_list, cleanup=True):
 # ----------------------------------------------------------------------------------------
 def merge_yamls(outfname, yaml_list, headers, cleanup=True):
     """ NOTE copy of merge_csvs(), which is (apparently) a copy of merge_hmm_outputs in partitiondriver, I should really combine the two functions """
-    merged_annotation_list = []
-    ref_glfo = None
+    # events are passed one at a time from each input file to the output file, so (at least for record-per-line input files) we never have more than one of them in memory
+    ref_header, ref_events = open_yaml_output(yaml_list[0])  # need the first file's header before we start writing, so hold on to its events (rather than reopening it) so it's only read once, and its file gets closed when we finish iterating over them
     n_event_list = []
-    for infname in yaml_list:
-        glfo, annotation_list, cpath = read_yaml_output(infname, dont_add_implicit_info=True)
-        n_event_list.append(len(annotation_list))
-        if len(cpath.partitions) > 0:  # only used for simulation file merging a.t.m. (which obviously only have one partition [the right one], so they don't need to write the partitions)
-            raise Exception('can\'t yet handle partition merging (use glomerator.py)')
-        if ref_glfo is None:
-            ref_glfo = glfo
-        if glfo != ref_glfo:
-            raise Exception('can only merge files with identical germline info')
-        merged_annotation_list += annotation_list
-        if cleanup:
-            os.remove(infname)
-            os.rmdir(os.path.dirname(infname))
+    def merged_annotations():
+        for ifile, infname in enumerate(yaml_list):
+            header, events = (ref_header, ref_events) if ifile == 0 else open_yaml_output(infname)
+            if len(header['partitions']) > 0:  # only used for simulation file merging a.t.m. (which obviously only have one partition [the right one], so they don't need to write the partitions)
+                raise Exception('can\'t yet handle partition merging (use glomerator.py)')
+            if header['germline-info'] != ref_header['germline-info']:
+                raise Exception('can only merge files with identical germline info')
+            n_event_list.append(0)
+            for line in iter_yaml_annotations(header['germline-info'], events, dont_add_implicit_info=True):
+                n_event_list[-1] += 1
+                yield line
+            if cleanup:
+                os.remove(infname)
+                os.rmdir(os.path.dirname(infname))
 
     if getsuffix(outfname) != '.yaml':
         raise Exception('wrong function for %s' % outfname)
@@ -1955,7 +2228,7 @@ def merge_yamls(outfname, yaml_list, headers, cleanup=True):
     if not os.path.exists(outdir):
         os.makedirs(outdir)
 
-    write_annotations(outfname, ref_glfo, merged_annotation_list, headers)
+    write_annotations(outfname, ref_header['germline-info'], merged_annotations(), headers, streaming_yaml=is_streaming_yaml(ref_header))  # write the same format as the input files
 
     return n_event_list
 
@@ -2221,6 +2494,48 @@ def auto_n_procs():  # for running on the local machine
         n_procs = int(float(n_procs) / 2.)
     return n_procs
 
+# ----------------------------------------------------------------------------------------
+# wake up as soon as any child process exits, rather than polling in a loop: we install a (do-nothing) SIGCHLD handler, and have the signal module write a byte to a pipe, which we can then select() on
+def start_child_exit_wakeup():
+    try:
+        rfd, wfd = os.pipe()
+        for fd in (rfd, wfd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        old_wakeup_fd = signal.set_wakeup_fd(wfd)  # raises ValueError if we're not in the main thread
+    except ValueError:
+        os.close(rfd)
+        os.close(wfd)
+        return None  # fall back to polling
+    old_handler = signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.siginterrupt(signal.SIGCHLD, False)  # restart interrupted system calls (the byte in the pipe is enough to wake up select())
+    return {'rfd' : rfd, 'wfd' : wfd, 'old_wakeup_fd' : old_wakeup_fd, 'old_handler' : old_handler}
+
+# ----------------------------------------------------------------------------------------
+def wait_for_child_exit(wakeupfo, timeout=5.):  # NOTE may return before any child has exited (e.g. on timeout or other signals), so caller needs to check
+    if wakeupfo is None:
+        time.sleep(0.05)
+        return
+    try:
+        select.select([wakeupfo['rfd']], [], [], timeout)
+    except select.error as err:
+        if err.args[0] != errno.EINTR:
+            raise
+    try:
+        while len(os.read(wakeupfo['rfd'], 4096)) > 0:  # empty the pipe
+            pass
+    except OSError as err:
+        if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+
+# ----------------------------------------------------------------------------------------
+def stop_child_exit_wakeup(wakeupfo):
+    if wakeupfo is None:
+        return
+    signal.signal(signal.SIGCHLD, wakeupfo['old_handler'] if wakeupfo['old_handler'] is not None else signal.SIG_DFL)
+    signal.set_wakeup_fd(wakeupfo['old_wakeup_fd'])
+    os.close(wakeupfo['rfd'])
+    os.close(wakeupfo['wfd'])
+
 # ----------------------------------------------------------------------------------------
 def run_proc_functions(procs, n_procs=None, debug=False):  # <procs> is a list of multiprocessing.Process objects
     if n_procs is None:
@@ -2228,12 +2543,17 @@ def run_proc_functions(procs, n_procs=None, debug=False):  # <procs> is a list o
     if debug:
         print '    running %d proc fcns with %d procs' % (len(procs), n_procs)
         sys.stdout.flush()
-    while True:
-        while len(procs) > 0 and len(multiprocessing.active_children()) < n_procs:
-            procs[0].start()
-            procs.pop(0)
-        if len(multiprocessing.active_children()) == 0 and len(procs) == 0:
-            break
+    wakeupfo = start_child_exit_wakeup()
+    try:
+        while True:
+            while len(procs) > 0 and len(multiprocessing.active_children()) < n_procs:  # active_children() also joins any that have finished
+                procs[0].start()
+                procs.pop(0)
+            if len(multiprocessing.active_children()) == 0 and len(procs) == 0:
+                break
+            wait_for_child_exit(wakeupfo)
+    finally:
+        stop_child_exit_wakeup(wakeupfo)
 
 # ----------------------------------------------------------------------------------------
 def run_cmd(cmdfo, batch_system=None, batch_options=None):
@@ -2273,26 +2593,145 @@ def run_cmd(cmdfo, batch_system=None, batch_options=None):
     return proc
 
 # ----------------------------------------------------------------------------------------
-def run_cmds(cmdfos, sleep=True, batch_system=None, batch_options=None, batch_config_fname=None, debug=None, ignore_stderr=False, n_max_tries=None):  # set sleep to False if your commands are going to run really really really quickly
+def reap_proc(proc):  # if <proc> has finished, set its return code and return its resource usage (otherwise return None)
+    try:
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+    except OSError as err:  # someone else already reaped it
+        if err.errno != errno.ECHILD:
+            raise
+        if proc.poll() is None:
+            proc.returncode = 1  # no way to find out what happened, so treat it as a failure
+        return {'cpu' : None}
+    if pid == 0:  # still running
+        return None
+    proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)  # same convention as subprocess
+    return {'cpu' : rusage.ru_utime + rusage.ru_stime}
+
+# ----------------------------------------------------------------------------------------
+def run_cmds(cmdfos, sleep=True, batch_system=None, batch_options=None, batch_config_fname=None, debug=None, ignore_stderr=False, n_max_tries=None, n_max_procs=None):  # set sleep to False if your commands are going to run really really really quickly
+    """
+    Run the commands in <cmdfos>, retrying failures up to <n_max_tries> times, and with at most <n_max_procs> running at once (default: all of them).
+    Wall and cpu time (summed over tries) for each command end up in cmdfo['time'] (cpu time is of the local process, i.e. not very meaningful with a batch system).
+    """
     if n_max_tries is None:
         n_max_tries = 1 if batch_system is None else 3
     prepare_cmds(cmdfos, batch_system=batch_system, batch_options=batch_options, batch_config_fname=batch_config_fname)
-    procs, n_tries = [], []
+    procs, n_tries, start_times = [None for _ in cmdfos], [0 for _ in cmdfos], [None for _ in cmdfos]
+    for cmdfo in cmdfos:
+        cmdfo['time'] = {'wall' : 0., 'cpu' : 0.}
+    queued = list(range(len(cmdfos)))
+    running = set()
     per_proc_sleep_time = 0.01 / len(cmdfos)
-    for iproc in range(len(cmdfos)):
-        procs.append(run_cmd(cmdfos[iproc], batch_system=batch_system, batch_options=batch_options))
-        n_tries.append(1)
-        if sleep:
-            time.sleep(per_proc_sleep_time)
-    while procs.count(None) != len(procs):  # we set each proc to None when it finishes
-        for iproc in range(len(cmdfos)):
-            if procs[iproc] is None:  # already finished
+    wakeupfo = start_child_exit_wakeup()  # install this before starting any of them, so we don't miss any exits
+    try:
+        while len(queued) > 0 or len(running) > 0:
+            while len(queued) > 0 and (n_max_procs is None or len(running) < n_max_procs):
+                iproc = queued.pop(0)
+                procs[iproc] = run_cmd(cmdfos[iproc], batch_system=batch_system, batch_options=batch_options)
+                n_tries[iproc] = 1
+                start_times[iproc] = time.time()
+                running.add(iproc)
+                if sleep:
+                    time.sleep(per_proc_sleep_time)
+            wait_for_child_exit(wakeupfo)
+            for iproc in sorted(running):
+                usage = reap_proc(procs[iproc])
+                if usage is None:  # still running
+                    continue
+                cmdfos[iproc]['time']['wall'] += time.time() - start_times[iproc]
+                if usage['cpu'] is not None and cmdfos[iproc]['time']['cpu'] is not None:
+                    cmdfos[iproc]['time']['cpu'] += usage['cpu']
+                else:
+                    cmdfos[iproc]['time']['cpu'] = None
+                finish_process(iproc, procs, n_tries, cmdfos[iproc], n_max_tries, dbgfo=cmdfos[iproc]['dbgfo'], batch_system=batch_system, batch_options=batch_options, debug=debug, ignore_stderr=ignore_stderr)  # restarts it (in the same slot) if it failed
+                if procs[iproc] is None:  # succeeded
+                    running.remove(iproc)
+                else:
+                    start_times[iproc] = time.time()
+            sys.stdout.flush()
+    finally:
+        stop_child_exit_wakeup(wakeupfo)
+
+    if debug is not None and len(cmdfos) > 0:
+        wall_times = [cfo['time']['wall'] for cfo in cmdfos]
+        cpu_times = [cfo['time']['cpu'] for cfo in cmdfos if cfo['time']['cpu'] is not None]
+        print '      %d proc%s   wall time: %.1f max  %.1f mean   cpu time: %s' % (len(cmdfos), plural(len(cmdfos)), max(wall_times), numpy.mean(wall_times), ('%.1f total' % sum(cpu_times)) if len(cpu_times) > 0 else '?')
+
+# ----------------------------------------------------------------------------------------
+def start_persistent_worker(cmd_str):  # start a process that runs one command per line from its stdin (see run_cmds_on_workers())
+    proc = subprocess.Popen(cmd_str.split(), stdin=subprocess.PIPE, stdout=subprocess.PIPE)  # NOTE stdout is unbuffered, so readline() after select() won't leave anything hanging around in a buffer
+    return {'proc' : proc, 'cmd_str' : cmd_str}
+
+# ----------------------------------------------------------------------------------------
+def stop_persistent_workers(workers):
+    for worker in workers:
+        try:
+            worker['proc'].stdin.close()  # workers exit when they see the end of their input
+        except IOError:
+            pass
+    for worker in workers:
+        worker['proc'].wait()
+    del workers[:]
+
+# ----------------------------------------------------------------------------------------
+def run_cmds_on_workers(cmdfos, workers, debug=None, ignore_stderr=False):
+    """
+    Like run_cmds(), but rather than starting a new process for each command, send each to an idle worker from start_persistent_worker().
+    The request for each command is the line '<stdout file> <stderr file> <cmd str without its first word>', to which the worker replies 'done <exit status>' when it's finished.
+    Returns the indices in <cmdfos> of commands that failed (so the caller can rerun them with run_cmds()), and removes any workers that died from <workers>.
+    """
+    prepare_cmds(cmdfos)
+    for cmdfo in cmdfos:
+        cmdfo['time'] = {'wall' : 0., 'cpu' : None}  # cpu time of the worker isn't split up by command
+    workers[:] = [w for w in workers if w['proc'].poll() is None]
+    queued = list(range(len(cmdfos)))
+    idle = list(workers)
+    running = {}  # map from worker's stdout fd to (worker, iproc, start time)
+    failed = []
+    while len(queued) > 0 or len(running) > 0:
+        while len(queued) > 0 and len(idle) > 0:
+            iproc, worker = queued.pop(0), idle.pop(0)
+            cmdfo = cmdfos[iproc]
+            if not os.path.exists(cmdfo['logdir']):
+                os.makedirs(cmdfo['logdir'])
+            try:
+                worker['proc'].stdin.write('%s/out %s/err %s\n' % (cmdfo['logdir'], cmdfo['logdir'], ' '.join(cmdfo['cmd_str'].split()[1:])))
+                worker['proc'].stdin.flush()
+            except IOError:  # it died since the last command
+                workers.remove(worker)
+                queued.insert(0, iproc)
+                continue
+            running[worker['proc'].stdout.fileno()] = (worker, iproc, time.time())
+        if len(running) == 0:  # all the workers died
+            failed += queued
+            break
+        try:
+            readable, _, _ = select.select(list(running), [], [])
+        except select.error as err:
+            if err.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd in readable:
+            worker, iproc, start_time = running.pop(fd)
+            cmdfo = cmdfos[iproc]
+            cmdfo['time']['wall'] += time.time() - start_time
+            reply = worker['proc'].stdout.readline().split()
+            if len(reply) == 0:  # it died in the middle of the command
+                worker['proc'].wait()
+                workers.remove(worker)
+                failed.append(iproc)
                 continue
-            if procs[iproc].poll() is not None:  # it just finished
-                finish_process(iproc, procs, n_tries, cmdfos[iproc], n_max_tries, dbgfo=cmdfos[iproc]['dbgfo'], batch_system=batch_system, batch_options=batch_options, debug=debug, ignore_stderr=ignore_stderr)
+            idle.append(worker)
+            if reply != ['done', '0'] or not os.path.exists(cmdfo['outfname']):
+                failed.append(iproc)
+                continue
+            process_out_err(extra_str='' if len(cmdfos) == 1 else str(iproc), dbgfo=cmdfo['dbgfo'], logdir=cmdfo['logdir'], debug=debug, ignore_stderr=ignore_stderr)
         sys.stdout.flush()
-        if sleep:
-            time.sleep(per_proc_sleep_time)
+
+    if debug is not None and len(cmdfos) > 0:
+        wall_times = [cfo['time']['wall'] for cfo in cmdfos]
+        print '      %d command%s on %d worker%s   wall time: %.1f max  %.1f mean' % (len(cmdfos), plural(len(cmdfos)), len(workers), plural(len(workers)), max(wall_times), numpy.mean(wall_times))
+    return sorted(failed)
 
 # ----------------------------------------------------------------------------------------
 def pad_lines(linestr, padwidth=8):
@@ -2565,44 +3004,7 @@ def new_ccfs_that_need_better_names(partition, true_partition, reco_info, seed_u
     if seed_unique_id is None:
         check_intersection_and_complement(partition, true_partition)
     reco_ids = {uid : reco_info[uid]['reco_id'] for cluster in partition for uid in cluster}  # just a teensy lil' optimization
-    uids = set([uid for cluster in partition for uid in cluster])
-    clids = get_cluster_ids(uids, partition)  # map of {uid : (index of cluster in <partition> in which that uid occurs)} (well, list of indices, in case there's duplicates)
-
-    def get_clonal_fraction(uid, inferred_cluster):
-        """ Return the fraction of seqs in <uid>'s inferred cluster which are really clonal. """
-        n_clonal = 0
-        for tmpid in inferred_cluster:  # NOTE this includes the case where tmpid equal to uid
-            if reco_ids[tmpid] == reco_ids[uid]:  # reminder (see event.py) reco ids depend only on rearrangement parameters, i.e. two different rearrangement events with the same rearrangement parameters have the same reco id
-                n_clonal += 1
-        return float(n_clonal) / len(inferred_cluster)
-
-    def get_fraction_present(inferred_cluster, true_cluster):
-        """ Return the fraction of the true clonemates in <true_cluster> which appear in <inferred_cluster>. """
-        n_present = 0
-        for tmpid in true_cluster:  # NOTE this includes the case where tmpid equal to uid
-            if tmpid in inferred_cluster:
-                n_present += 1
-        return float(n_present) / len(true_cluster)
-
-    mean_clonal_fraction, mean_fraction_present = 0., 0.
-    n_uids = 0
-    for true_cluster in true_partition:
-        if seed_unique_id is not None and seed_unique_id not in true_cluster:
-            continue
-        for uid in true_cluster:
-            if seed_unique_id is not None and uid != seed_unique_id:
-                continue
-            if len(clids[uid]) != 1:
-                print 'WARNING %s in multiple clusters' % uid
-            inferred_cluster = partition[clids[uid][0]]  # we only look at the first cluster in which it appears
-            mean_clonal_fraction += get_clonal_fraction(uid, inferred_cluster)
-            mean_fraction_present += get_fraction_present(inferred_cluster, true_cluster)
-            n_uids += 1
-
-    if n_uids > 1e6:
-        raise Exception('you should start worrying about numerical precision if you\'re going to run on this many queries')
-
-    return mean_clonal_fraction / n_uids, mean_fraction_present / n_uids
+    return clustermetrics.ccfs(partition, true_partition, reco_ids, seed_unique_id=seed_unique_id)  # converts to integer label arrays, so it's linear rather than quadratic in cluster size
 
 # ----------------------------------------------------------------------------------------
 def correct_cluster_fractions(partition, true_partition, debug=False):
@@ -2657,13 +3059,6 @@ def correct_cluster_fractions(partition, true_partition, debug=False):
 # ----------------------------------------------------------------------------------------
 def partition_similarity_matrix(meth_a, meth_b, partition_a, partition_b, n_biggest_clusters, debug=False):
     """ Return matrix whose ij^th entry is the size of the intersection between <partition_a>'s i^th biggest cluster and <partition_b>'s j^th biggest """
-    def intersection_size(cl_1, cl_2):
-        isize = 0
-        for uid in cl_1:
-            if uid in cl_2:
-                isize += 1
-        return isize
-
     # n_biggest_clusters = 10
     def sort_within_clusters(part):
         for iclust in range(len(part)):
@@ -2676,18 +3071,19 @@ def partition_similarity_matrix(meth_a, meth_b, partition_a, partition_b, n_bigg
     a_clusters = sorted(sorted(partition_a), key=len, reverse=True)[ : n_biggest_clusters]  # i.e. the n biggest clusters
     b_clusters = sorted(sorted(partition_b), key=len, reverse=True)[ : n_biggest_clusters]
 
+    imatrix = clustermetrics.intersection_matrix(a_clusters, b_clusters).tolist()
     smatrix = []
     pair_info = []  # list of full pair info (e.g. [0.8, ick)
     max_pair_info = 5
-    for clust_a in a_clusters:
+    for iclust_a, clust_a in enumerate(a_clusters):
         # if debug:
         #     print clust_a
         smatrix.append([])
-        for clust_b in b_clusters:
+        for iclust_b, clust_b in enumerate(b_clusters):
             # norm_factor = 1.  # don't normalize
             norm_factor = 0.5 * (len(clust_a) + len(clust_b))  # mean size
             # norm_factor = min(len(clust_a), len(clust_b))  # smaller size
-            intersection = intersection_size(clust_a, clust_b)
+            intersection = imatrix[iclust_a][iclust_b]
             isize = float(intersection) / norm_factor
             # if debug:
             #     print '    %.2f  %5d   %5d %5d' % (isize, intersection, len(clust_a), len(clust_b))
@@ -2744,28 +3140,17 @@ def check_intersection_and_complement(part_a, part_b):
 
 # ----------------------------------------------------------------------------------------
 def get_cluster_list_for_sklearn(part_a, part_b):
-    # convert from partition format {cl_1 : [seq_a, seq_b], cl_2 : [seq_c]} to [cl_1, cl_1, cl_2]
-    # NOTE this will be really slow for larger partitions
-
-    # first make sure that <part_a> has every uid in <part_b> (the converse is checked below)
-    for jclust in range(len(part_b)):
-        for uid in part_b[jclust]:
-            find_uid_in_partition(uid, part_a)  # raises exception if not found
-
-    # then make the cluster lists
-    clusts_a, clusts_b = [], []
-    for iclust in range(len(part_a)):
-        for uid in part_a[iclust]:
-            clusts_a.append(iclust)
-            clusts_b.append(find_uid_in_partition(uid, part_b))
-
-    return clusts_a, clusts_b
+    # convert from partition format {cl_1 : [seq_a, seq_b], cl_2 : [seq_c]} to [cl_1, cl_1, cl_2] (raises exception if the partitions don't have the same uids)
+    clusts_a, clusts_b = clustermetrics.get_cluster_labels(part_a, part_b)
+    return clusts_a.tolist(), clusts_b.tolist()
 
 # ----------------------------------------------------------------------------------------
 def adjusted_mutual_information(partition_a, partition_b):
-    return -1.  # not using it any more, and it's really slow
-    # clusts_a, clusts_b = get_cluster_list_for_sklearn(partition_a, partition_b)
-    # return sklearn.metrics.cluster.adjusted_mutual_info_score(clusts_a, clusts_b)
+    return clustermetrics.adjusted_mutual_information(partition_a, partition_b)  # used to be really slow (and return -1), but now it's vectorized
+
+# ----------------------------------------------------------------------------------------
+def adjusted_rand_index(partition_a, partition_b):
+    return clustermetrics.adjusted_rand_index(partition_a, partition_b)
 
 # ----------------------------------------------------------------------------------------
 def add_missing_uids_as_singletons_to_inferred_partition(partition_with_missing_uids, true_partition=None, all_ids=None, debug=True):
@@ -3036,6 +3421,22 @@ def intexterpolate(x1, y1, x2, y2, x):
     #         print '%f x + %f = %f' % (m, b, m*x + b)
     return m * x + b
 
+# ----------------------------------------------------------------------------------------
+def set_aside_existing_hmms(parameter_dir):
+    """
+    Move <parameter_dir>/hmms out of the way (since it's about to be out of date), but keep it around so PartitionDriver.write_hmms() can reuse any hmms whose inputs turn out not to have changed.
+    Returns the set-aside dir. If there's already a set-aside dir (i.e. we crashed, or we haven't written the new hmms yet), that one wins, and any current hmms are removed.
+    """
+    hmm_dir = parameter_dir + '/hmms'
+    previous_hmm_dir = parameter_dir + '/hmms-previous'
+    if os.path.exists(hmm_dir):
+        if os.path.exists(previous_hmm_dir):
+            prep_dir(hmm_dir, wildlings='*')
+            os.rmdir(hmm_dir)
+        else:
+            os.rename(hmm_dir, previous_hmm_dir)
+    return previous_hmm_dir
+
 # ----------------------------------------------------------------------------------------
 def find_genes_that_have_hmms(parameter_dir):
     yamels = glob.glob(parameter_dir + '/hmms/*.yaml')
@@ -3165,95 +3566,162 @@ def collapse_naive_seqs_with_hashes(naive_seq_list, sw_info):
     return naive_seq_map, naive_seq_hashes
 
 # ----------------------------------------------------------------------------------------
-def read_fastx(fname, name_key='name', seq_key='seq', add_info=True, sanitize=False, queries=None, n_max_queries=-1, istartstop=None, ftype=None, n_random_queries=None):  # Bio.SeqIO takes too goddamn long to import
-    if ftype is None:
-        suffix = getsuffix(fname)
-        if suffix == '.fa' or suffix == '.fasta':
-            ftype = 'fa'
-        elif suffix == '.fq' or suffix == '.fastq':
-            ftype = 'fq'
-        else:
-            raise Exception('unhandled file type: %s' % suffix)
+compressed_suffixes = {'.gz' : gzip.GzipFile, '.bz2' : bz2.BZ2File}
+fastx_suffixes = {'.fa' : 'fa', '.fasta' : 'fa', '.fq' : 'fq', '.fastq' : 'fq'}
+fastx_read_chunk_size = 2**20  # number of (uncompressed) bytes to read from fasta/fastq files at a time
 
-    finfo = []
-    iline = -1  # index of the query/seq that we're currently reading in the fasta
-    n_fasta_queries = 0  # number of queries so far added to <finfo> (I guess I could just use len(finfo) at this point)
-    missing_queries = set(queries) if queries is not None else None
-    already_printed_forbidden_character_warning = False
-    with open(fname) as fastafile:
-        startpos = None
-        while True:
-            if startpos is not None:  # rewind since the last time through we had to look to see when the next header line appeared
-                fastafile.seek(startpos)
-            headline = fastafile.readline()
-            if not headline:
-                break
-            if headline.strip() == '':  # skip a blank line
-                headline = fastafile.readline()
+# ----------------------------------------------------------------------------------------
+def get_uncompressed_suffix(fname):  # e.g. '.fa' for 'seqs.fa.gz'
+    if getsuffix(fname) in compressed_suffixes:
+        fname = os.path.splitext(fname)[0]
+    return getsuffix(fname)
+
+# ----------------------------------------------------------------------------------------
+def open_input_file(fname):  # <fname> of '-' means stdin, and gzip or bz2 compression is figured out from the suffix
+    if fname == '-':
+        return sys.stdin
+    suffix = getsuffix(fname)
+    if suffix in compressed_suffixes:
+        return compressed_suffixes[suffix](fname)
+    return open(fname)
 
+# ----------------------------------------------------------------------------------------
+def get_fastx_entries(fastafile, fname, ftype=None, chunk_size=None):
+    """
+    Read <fastafile> <chunk_size> bytes at a time, yielding for each chunk a list of the (headline, seqline) pairs that were completed by that chunk.
+    If <ftype> isn't set (e.g. for stdin, or unrecognized suffixes), it's figured out from the first header line.
+    """
+    if chunk_size is None:
+        chunk_size = fastx_read_chunk_size
+    remainder = ''
+    headline, seqlines = None, []  # fasta: header and sequence lines of the entry we're in the middle of; fastq: the lines we've read so far for the current entry
+    while True:
+        chunk = fastafile.read(chunk_size)
+        lines = (remainder + chunk).split('\n')
+        remainder = lines.pop() if chunk else ''  # last line may be incomplete (unless we're at the end of the file)
+        entries = []
+        for line in lines:
+            if ftype is None:  # first line we've seen
+                if line.strip() == '':
+                    continue
+                ftype = {'>' : 'fa', '@' : 'fq'}.get(line[0])
+                if ftype is None:
+                    raise Exception('couldn\'t figure out file type of %s from first line:\n    %s' % (fname, line))
             if ftype == 'fa':
-                if headline[0] != '>':
-                    raise Exception('invalid fasta header line in %s:\n    %s' % (fname, headline))
-                headline = headline.lstrip('>')
-
-                seqlines = []
-                nextline = fastafile.readline()
-                while True:
-                    if not nextline:
-                        break
-                    if nextline[0] == '>':
-                        break
-                    else:
-                        startpos = fastafile.tell()  # i.e. very line that doesn't begin with '>' increments <startpos>
-                    seqlines.append(nextline)
-                    nextline = fastafile.readline()
-                seqline = ''.join([l.strip() for l in seqlines]) if len(seqlines) > 0 else None
-            elif ftype == 'fq':
-                if headline[0] != '@':
-                    raise Exception('invalid fastq header line in %s:\n    %s' % (fname, headline))
-                headline = headline.lstrip('@')
-
-                seqline = fastafile.readline()  # NOTE .fq with multi-line entries isn't supported, since delimiter characters are allowed to occur within the quality string
-                plusline = fastafile.readline().strip()
-                if plusline[0] != '+':
-                    raise Exception('invalid fastq quality header in %s:\n    %s' % (fname, plusline))
-                qualityline = fastafile.readline()
+                if line.strip() == '':  # skip blank lines
+                    continue
+                if line[0] == '>':
+                    if headline is not None:
+                        entries.append((headline, ''.join(seqlines)))
+                    headline, seqlines = line[1:], []
+                elif headline is None:
+                    raise Exception('invalid fasta header line in %s:\n    %s' % (fname, line))
+                else:
+                    seqlines.append(line.strip())
+            elif ftype == 'fq':  # NOTE .fq with multi-line entries isn't supported, since delimiter characters are allowed to occur within the quality string
+                if len(seqlines) == 0:
+                    if line.strip() == '':  # skip blank lines between entries
+                        continue
+                    if line[0] != '@':
+                        raise Exception('invalid fastq header line in %s:\n    %s' % (fname, line))
+                elif len(seqlines) == 2 and line.strip()[:1] != '+':
+                    raise Exception('invalid fastq quality header in %s:\n    %s' % (fname, line))
+                seqlines.append(line)
+                if len(seqlines) == 4:
+                    entries.append((seqlines[0][1:], seqlines[1].strip()))
+                    seqlines = []
             else:
                 raise Exception('unhandled ftype %s' % ftype)
+        if not chunk:  # end of file, so finish off whatever entry we're in the middle of
+            if ftype == 'fa' and headline is not None:
+                entries.append((headline, ''.join(seqlines)))
+            elif ftype == 'fq' and len(seqlines) > 1:
+                entries.append((seqlines[0][1:], seqlines[1].strip()))
+        if len(entries) > 0:
+            yield entries
+        if not chunk:
+            break
 
-            if not seqline:
-                break
+# ----------------------------------------------------------------------------------------
+def check_alphabet(seqfos, seq_key, name_key, fname, allowed_chars):  # check all the sequences in <seqfos> at once (we only look at them one by one if there's a problem)
+    deletechars = ''.join(allowed_chars)
+    if ''.join(sfo[seq_key] for sfo in seqfos).translate(None, deletechars) == '':
+        return
+    for sfo in seqfos:
+        unexpected_chars = set(sfo[seq_key].translate(None, deletechars))
+        if len(unexpected_chars) > 0:
+            raise Exception('unexpected character%s %s (not among %s) in input sequence with id %s in %s:\n  %s' % (plural(len(unexpected_chars)), ', '.join([('\'%s\'' % ch) for ch in unexpected_chars]), sorted(allowed_chars), sfo[name_key], fname, sfo[seq_key]))
 
-            iline += 1
-            if istartstop is not None:
-                if iline < istartstop[0]:
-                    continue
-                elif iline >= istartstop[1]:
-                    continue
+# ----------------------------------------------------------------------------------------
+def iterate_fastx(fname, name_key='name', seq_key='seq', add_info=True, sanitize=False, queries=None, n_max_queries=-1, istartstop=None, ftype=None, allowed_chars=None, chunk_size=None):
+    """
+    Stream sequences from a (possibly gzip- or bz2-compressed) fasta or fastq file (or from stdin if <fname> is '-'), without reading any more of the file than we need to.
+    If <allowed_chars> is set, raise an exception for sequences with characters that aren't in it.
+    """
+    if ftype is None and fname != '-':
+        ftype = fastx_suffixes.get(get_uncompressed_suffix(fname))  # if we don't recognize the suffix, we figure it out from the first line
 
-            infostrs = [s3.strip() for s1 in headline.split(' ') for s2 in s1.split('\t') for s3 in s2.split('|')]  # NOTE the uid is left untranslated in here
-            uid = infostrs[0]
-            if sanitize and any(fc in uid for fc in forbidden_characters):
-                if not already_printed_forbidden_character_warning:
-                    print '  %s: found a forbidden character (one of %s) in sequence id \'%s\'. This means we\'ll be replacing each of these forbidden characters with a single letter from their name (in this case %s). If this will cause problems you should replace the characters with something else beforehand.' % (color('yellow', 'warning'), ' '.join(["'" + fc + "'" for fc in forbidden_characters]), uid, uid.translate(forbidden_character_translations))
-                    already_printed_forbidden_character_warning = True
-                uid = uid.translate(forbidden_character_translations)
+    iline = -1  # index of the query/seq that we're currently reading in the fasta
+    n_fasta_queries = 0  # number of queries so far yielded
+    missing_queries = set(queries) if queries is not None else None
+    already_printed_forbidden_character_warning = False
+    fastafile = open_input_file(fname)
+    try:
+        for entries in get_fastx_entries(fastafile, fname, ftype=ftype, chunk_size=chunk_size):
+            finfo = []
+            finished = False
+            for headline, seqline in entries:
+                if seqline == '':
+                    finished = True
+                    break
 
-            if queries is not None:
-                if uid not in queries:
-                    continue
-                missing_queries.remove(uid)
+                iline += 1
+                if istartstop is not None:
+                    if iline < istartstop[0]:
+                        continue
+                    elif iline >= istartstop[1]:
+                        finished = True
+                        break
 
-            seqfo = {name_key : uid, seq_key : seqline.strip().upper()}
-            if add_info:
-                seqfo['infostrs'] = infostrs
-            finfo.append(seqfo)
+                infostrs = [s3.strip() for s1 in headline.split(' ') for s2 in s1.split('\t') for s3 in s2.split('|')]  # NOTE the uid is left untranslated in here
+                uid = infostrs[0]
+                if sanitize and any(fc in uid for fc in forbidden_characters):
+                    if not already_printed_forbidden_character_warning:
+                        print '  %s: found a forbidden character (one of %s) in sequence id \'%s\'. This means we\'ll be replacing each of these forbidden characters with a single letter from their name (in this case %s). If this will cause problems you should replace the characters with something else beforehand.' % (color('yellow', 'warning'), ' '.join(["'" + fc + "'" for fc in forbidden_characters]), uid, uid.translate(forbidden_character_translations))
+                        already_printed_forbidden_character_warning = True
+                    uid = uid.translate(forbidden_character_translations)
 
-            n_fasta_queries += 1
-            if n_max_queries > 0 and n_fasta_queries >= n_max_queries:
-                break
-            if queries is not None and len(missing_queries) == 0:
+                if queries is not None:
+                    if uid not in queries:
+                        continue
+                    missing_queries.discard(uid)
+
+                seqfo = {name_key : uid, seq_key : seqline.upper()}
+                if add_info:
+                    seqfo['infostrs'] = infostrs
+                finfo.append(seqfo)
+
+                n_fasta_queries += 1
+                if n_max_queries > 0 and n_fasta_queries >= n_max_queries:
+                    finished = True
+                    break
+                if queries is not None and len(missing_queries) == 0:
+                    finished = True
+                    break
+
+            if allowed_chars is not None and len(finfo) > 0:
+                check_alphabet(finfo, seq_key, name_key, fname, allowed_chars)
+            for seqfo in finfo:
+                yield seqfo
+            if finished:
                 break
+    finally:
+        if fastafile is not sys.stdin:
+            fastafile.close()
+
+# ----------------------------------------------------------------------------------------
+def read_fastx(fname, name_key='name', seq_key='seq', add_info=True, sanitize=False, queries=None, n_max_queries=-1, istartstop=None, ftype=None, n_random_queries=None):  # Bio.SeqIO takes too goddamn long to import
+    finfo = list(iterate_fastx(fname, name_key=name_key, seq_key=seq_key, add_info=add_info, sanitize=sanitize, queries=queries, n_max_queries=n_max_queries, istartstop=istartstop, ftype=ftype))
 
     if n_random_queries is not None:
         finfo = numpy.random.choice(finfo, n_random_queries, replace=False)
@@ -3399,35 +3867,13 @@ def read_vsearch_search_file(fname, userfields, seqs, glfo, region, get_annotati
     return {'gene-counts' : gene_counts, 'annotations' : annotations, 'failures' : failed_queries}
 
 # ----------------------------------------------------------------------------------------
-def run_vsearch(action, seqs, workdir, threshold, match_mismatch='2:-4', no_indels=False, minseqlength=None, consensus_fname=None, msa_fname=None, glfo=None, print_time=False, vsearch_binary=None, get_annotations=False):  # '2:-4' is the default vsearch match:mismatch, but I'm setting it here in case vsearch changes it in the future
-    # single-pass, greedy, star-clustering algorithm with
-    #  - add the target to the cluster if the pairwise identity with the centroid is higher than global threshold <--id>
-    #  - pairwise identity definition <--iddef> defaults to: number of (matching columns) / (alignment length - terminal gaps)
-    #  - the search process sorts sequences in decreasing order of number of k-mers in common
-    #    - the search process stops after --maxaccept matches (default 1), and gives up after --maxreject non-matches (default 32)
-    #    - If both are zero, it searches the whole database
-    #    - I do not remember why I set both to zero. I just did a quick test, and on a few thousand sequences, it seems to be somewhat faster with the defaults, and a tiny bit less accurate.
-    region = 'v'
-    userfields = [  # all 1-indexed (note: only used for 'search')
-        'query',
-        'target',
-        'qilo',  # first pos of query that aligns to target (1-indexed), skipping initial gaps (e.g. 1 if first pos aligns, 4 if fourth pos aligns but first three don't)
-        'qihi',  # last pos of same (1-indexed)
-        'tilo',  # same, but pos of target that aligns to query (1-indexed)
-        'tihi',  # last pos of same (1-indexed)
-        'ids',
-        'caln',  # cigar string
-    ]
-
-    start = time.time()
-    prep_dir(workdir)
-    infname = workdir + '/input.fa'
-
-    # write input
+def write_vsearch_input(infname, seqs):
     with open(infname, 'w') as fastafile:
         for name, seq in seqs.items():
             fastafile.write('>' + name + '\n' + seq + '\n')
 
+# ----------------------------------------------------------------------------------------
+def get_vsearch_cmd_base(vsearch_binary, threshold, match_mismatch='2:-4', no_indels=False, minseqlength=None):  # the options that are the same for clustering and searching (see run_vsearch())
     # figure out which vsearch binary to use
     if vsearch_binary is None:
         vsearch_binary = os.path.dirname(os.path.realpath(__file__)).replace('/python', '') + '/bin'
@@ -3438,7 +3884,6 @@ def run_vsearch(action, seqs, workdir, threshold, match_mismatch='2:-4', no_inde
         else:
             raise Exception('%s no vsearch binary in bin/ for platform \'%s\' (you can specify your own full vsearch path with --vsearch-binary)' % (color('red', 'error'), platform.system()))
 
-    # build command
     cmd = vsearch_binary
     cmd += ' --id ' + str(1. - threshold)  # reject if identity lower than this
     match, mismatch = [int(m) for m in match_mismatch.split(':')]
@@ -3451,6 +3896,78 @@ def run_vsearch(action, seqs, workdir, threshold, match_mismatch='2:-4', no_inde
     cmd += ' --gapopen %dI/%dE' % (gap_open, 2)  # default: (20 internal)/(2 terminal)
     if minseqlength is not None:
         cmd += ' --minseqlength %d' % minseqlength
+    return cmd
+
+# ----------------------------------------------------------------------------------------
+def run_vsearch_class_clusters(seq_classes, workdir, threshold, n_procs=None, vsearch_binary=None, print_time=False):
+    """
+    Cluster each of the {name : seq} dicts in <seq_classes> separately (i.e. sequences in different classes never end up in the same cluster), and return a list with the partition for each class.
+    Rather than running vsearch on one class after another, we run up to <n_procs> of them at once. They're queued largest first, so the slots end up with balanced batches of classes (i.e.
+    the big ones don't get stuck waiting at the end), and each class gets a number of vsearch threads proportional to its share of the sequences (the many small ones just get one).
+    """
+    start = time.time()
+    if n_procs is None:
+        n_procs = auto_n_procs()
+    n_cores = multiprocessing.cpu_count()
+    n_total_seqs = sum(len(seqs) for seqs in seq_classes)
+    prep_dir(workdir)
+    cmdfos = []
+    iclasses = sorted([ic for ic in range(len(seq_classes)) if len(seq_classes[ic]) > 0], key=lambda ic: len(seq_classes[ic]), reverse=True)
+    for iclass in iclasses:
+        subworkdir = '%s/class-%d' % (workdir, iclass)
+        prep_dir(subworkdir)
+        write_vsearch_input(subworkdir + '/input.fa', seq_classes[iclass])
+        cmd = get_vsearch_cmd_base(vsearch_binary, threshold)
+        cmd += ' --cluster_fast ' + subworkdir + '/input.fa'
+        cmd += ' --uc ' + subworkdir + '/vsearch-clusters.txt'
+        cmd += ' --threads %d' % min(n_cores, max(1, int(round(float(n_cores) * len(seq_classes[iclass]) / n_total_seqs))))
+        cmd += ' --quiet'
+        cmdfos.append({'cmd_str' : cmd, 'outfname' : subworkdir + '/vsearch-clusters.txt', 'workdir' : subworkdir})
+
+    if len(cmdfos) > 0:
+        run_cmds(cmdfos, sleep=False, n_max_procs=n_procs)
+
+    partitions = [[] for _ in seq_classes]
+    for iclass, cmdfo in zip(iclasses, cmdfos):
+        partitions[iclass] = read_vsearch_cluster_file(cmdfo['outfname'])
+        for fname in [cmdfo['workdir'] + '/input.fa', cmdfo['outfname']]:
+            os.remove(fname)
+        os.rmdir(cmdfo['workdir'])
+    os.rmdir(workdir)
+
+    if print_time:
+        print '      vsearch: clustered %d sequences in %d class%s (%d at a time) in %.1f sec' % (n_total_seqs, len(cmdfos), 'es' if len(cmdfos) != 1 else '', min(n_procs, len(cmdfos)), time.time() - start)
+
+    return partitions
+
+# ----------------------------------------------------------------------------------------
+def run_vsearch(action, seqs, workdir, threshold, match_mismatch='2:-4', no_indels=False, minseqlength=None, consensus_fname=None, msa_fname=None, glfo=None, print_time=False, vsearch_binary=None, get_annotations=False):  # '2:-4' is the default vsearch match:mismatch, but I'm setting it here in case vsearch changes it in the future
+    # single-pass, greedy, star-clustering algorithm with
+    #  - add the target to the cluster if the pairwise identity with the centroid is higher than global threshold <--id>
+    #  - pairwise identity definition <--iddef> defaults to: number of (matching columns) / (alignment length - terminal gaps)
+    #  - the search process sorts sequences in decreasing order of number of k-mers in common
+    #    - the search process stops after --maxaccept matches (default 1), and gives up after --maxreject non-matches (default 32)
+    #    - If both are zero, it searches the whole database
+    #    - I do not remember why I set both to zero. I just did a quick test, and on a few thousand sequences, it seems to be somewhat faster with the defaults, and a tiny bit less accurate.
+    region = 'v'
+    userfields = [  # all 1-indexed (note: only used for 'search')
+        'query',
+        'target',
+        'qilo',  # first pos of query that aligns to target (1-indexed), skipping initial gaps (e.g. 1 if first pos aligns, 4 if fourth pos aligns but first three don't)
+        'qihi',  # last pos of same (1-indexed)
+        'tilo',  # same, but pos of target that aligns to query (1-indexed)
+        'tihi',  # last pos of same (1-indexed)
+        'ids',
+        'caln',  # cigar string
+    ]
+
+    start = time.time()
+    prep_dir(workdir)
+    infname = workdir + '/input.fa'
+    write_vsearch_input(infname, seqs)
+
+    # build command
+    cmd = get_vsearch_cmd_base(vsearch_binary, threshold, match_mismatch=match_mismatch, no_indels=no_indels, minseqlength=minseqlength)
     if action == 'cluster':
         outfname = workdir + '/vsearch-clusters.txt'
         cmd += ' --cluster_fast ' + infname
@@ -3645,7 +4162,7 @@ def write_linearham_seqs(outfname, annotation_list):
                 fastafile.write('>' + annotation['unique_ids'][j] + '\n' + annotation['indel_reversed_seqs'][j] + '\n')
 
 # ----------------------------------------------------------------------------------------
-def write_annotations(fname, glfo, annotation_list, headers, synth_single_seqs=False, failed_queries=None, partition_lines=None):
+def write_annotations(fname, glfo, annotation_list, headers, synth_single_seqs=False, failed_queries=None, partition_lines=None, streaming_yaml=False):  # <annotation_list> can be any iterable
     if os.path.exists(fname):
         os.remove(fname)
     elif not os.path.exists(os.path.dirname(os.path.abspath(fname))):
@@ -3655,7 +4172,7 @@ def write_annotations(fname, glfo, annotation_list, headers, synth_single_seqs=F
         assert partition_lines is None
         write_csv_annotations(fname, headers, annotation_list, synth_single_seqs=synth_single_seqs, glfo=glfo, failed_queries=failed_queries)
     elif getsuffix(fname) == '.yaml':
-        write_yaml_output(fname, headers, glfo=glfo, annotation_list=annotation_list, synth_single_seqs=synth_single_seqs, failed_queries=failed_queries, partition_lines=partition_lines)
+        write_yaml_output(fname, headers, glfo=glfo, annotation_list=annotation_list, synth_single_seqs=synth_single_seqs, failed_queries=failed_queries, partition_lines=partition_lines, streaming=streaming_yaml)
     else:
         raise Exception('unhandled file extension %s' % getsuffix(fname))
 
@@ -3683,52 +4200,116 @@ def get_yamlfo_for_output(line, headers, glfo=None):
     transfer_indel_info(line, yamlfo)
     for key in [k for k in headers if k not in yamlfo]:
         if key in line:
-            yamlfo[key] = line[key]
+            yamlfo[key] = get_output_value(line[key])
         else:
             add_extra_column(key, line, yamlfo, glfo=glfo)
     return yamlfo
 
 # ----------------------------------------------------------------------------------------
-def write_yaml_output(fname, headers, glfo=None, annotation_list=None, synth_single_seqs=False, failed_queries=None, partition_lines=None):
+# There are two yaml (well, json, which is a subset of yaml) output formats:
+#   - original: one big json object (with keys 'version-info', 'germline-info', 'partitions', and 'events') on a single line
+#   - record-per-line (version 0.2, "streaming"): the first line has everything but the events, then each subsequent line is one event. This can be written and read without ever having all the events in memory.
+# Both are written incrementally, and both can be read by the functions below (the original format just has to be loaded all at once). Use convert_yaml_output() to switch between them.
+streaming_yaml_version = 0.2
+
+def is_streaming_yaml(header):
+    return header['version-info']['partis-yaml'] >= streaming_yaml_version
+
+# ----------------------------------------------------------------------------------------
+def write_yaml_records(yamlfile, glfo, partition_lines, yamlfos, streaming=False):  # <yamlfos> is an iterable over already-converted (i.e. by get_yamlfo_for_output()) events
+    header = {'version-info' : {'partis-yaml' : streaming_yaml_version if streaming else 0.1},
+              'germline-info' : glfo,
+              'partitions' : partition_lines}
+    # import yaml
+    # yaml.dump(yamldata, yamlfile, width=500, Dumper=yaml.CDumper)  # slower, but easier to read by hand for debugging
+    # NOTE json is way tf faster than full yaml (only lost information is ordering in ordered dicts, but that's only per-gene support and germline info, neither of whose order we care much about)
+    if streaming:
+        yamlfile.write(json.dumps(header) + '\n')
+        for yamlfo in yamlfos:
+            yamlfile.write(json.dumps(yamlfo) + '\n')
+    else:  # same as json.dump()ing the whole dict, but we write the events as we go
+        headstr = json.dumps(header)
+        yamlfile.write(headstr[:-1] + ', "events": [')  # chop off the closing brace
+        for ievt, yamlfo in enumerate(yamlfos):
+            yamlfile.write((', ' if ievt > 0 else '') + json.dumps(yamlfo))
+        yamlfile.write(']}')
+
+# ----------------------------------------------------------------------------------------
+def write_yaml_output(fname, headers, glfo=None, annotation_list=None, synth_single_seqs=False, failed_queries=None, partition_lines=None, streaming=False):
     if annotation_list is None:
         annotation_list = []
     if partition_lines is None:
         partition_lines = []
 
-    version_info = {'partis-yaml' : 0.1}
-    yaml_annotations = [get_yamlfo_for_output(l, headers, glfo=glfo) for l in annotation_list]
+    yaml_annotations = (get_yamlfo_for_output(l, headers, glfo=glfo) for l in annotation_list)
     if failed_queries is not None:
-        yaml_annotations += failed_queries
-    yamldata = {'version-info' : version_info,
-                'germline-info' : glfo,
-                'partitions' : partition_lines,
-                'events' : yaml_annotations}
+        yaml_annotations = itertools.chain(yaml_annotations, failed_queries)
     with open(fname, 'w') as yamlfile:
-        # import yaml
-        # yaml.dump(yamldata, yamlfile, width=500, Dumper=yaml.CDumper)  # slower, but easier to read by hand for debugging
-        json.dump(yamldata, yamlfile) #, sort_keys=True, indent=4)  # way tf faster than full yaml (only lost information is ordering in ordered dicts, but that's only per-gene support and germline info, neither of whose order we care much about)
+        write_yaml_records(yamlfile, glfo, partition_lines, yaml_annotations, streaming=streaming)
+
+# ----------------------------------------------------------------------------------------
+def open_yaml_output(fname):
+    """ return the header info (everything but the events) from yaml output file <fname>, and an iterator over its (unprocessed) events (for record-per-line files the events are read as you iterate) """
+    yamlfile = open(fname)
+    try:
+        header = json.loads(yamlfile.readline())
+    except ValueError:  # not all on one line, e.g. written by hand or with json.dump(..., indent=4)
+        yamlfile.seek(0)
+        header = json.load(yamlfile)
+    if 'events' in header:  # original format
+        yamlfile.close()
+        return header, iter(header.pop('events'))
+
+    def event_iter():
+        with yamlfile:
+            for line in yamlfile:
+                if line.strip() != '':
+                    yield json.loads(line)
+    return header, event_iter()
+
+# ----------------------------------------------------------------------------------------
+def iter_streaming_yaml_events(fname):  # yield (byte offset, event) for each event in record-per-line yaml file <fname>, so you can keep just the offsets of the ones you want, and reread them later with read_streaming_yaml_event()
+    with open(fname) as yamlfile:
+        yamlfile.readline()  # header
+        while True:
+            offset = yamlfile.tell()
+            line = yamlfile.readline()
+            if line == '':
+                break
+            if line.strip() != '':
+                yield offset, json.loads(line)
 
 # ----------------------------------------------------------------------------------------
-def parse_yaml_annotations(glfo, yamlfo, n_max_queries, synth_single_seqs, dont_add_implicit_info):
-    annotation_list = []
+def read_streaming_yaml_event(yamlfile, glfo, offset, dont_add_implicit_info=False):  # read (and process, as in iter_yaml_annotations()) the event at <offset> in the (open) record-per-line yaml file <yamlfile>
+    yamlfile.seek(offset)
+    return next(iter_yaml_annotations(glfo, [json.loads(yamlfile.readline())], dont_add_implicit_info=dont_add_implicit_info))
+
+# ----------------------------------------------------------------------------------------
+def convert_yaml_output(infname, outfname, streaming):  # rewrite <infname> to <outfname> in either the record-per-line (<streaming> True) or original format
+    header, events = open_yaml_output(infname)
+    with open(outfname, 'w') as yamlfile:
+        write_yaml_records(yamlfile, header['germline-info'], header['partitions'], events, streaming=streaming)
+
+# ----------------------------------------------------------------------------------------
+def iter_yaml_annotations(glfo, events, n_max_queries=-1, synth_single_seqs=False, dont_add_implicit_info=False):
     n_queries_read = 0
-    for line in yamlfo['events']:
+    for line in events:
+        compact_line(line)
         if not line['invalid']:
             transfer_indel_reversed_seqs(line)
             if not dont_add_implicit_info:  # it's kind of slow, although most of the time you probably want all the extra info
+                line = LazyLine(line)
                 add_implicit_info(glfo, line)  # don't use the germline info in <yamlfo>, in case we decide we want to modify it in the calling fcn
         if synth_single_seqs and len(line['unique_ids']) > 1:
             for iseq in range(len(line['unique_ids'])):
-                annotation_list.append(synthesize_single_seq_line(line, iseq))
+                yield synthesize_single_seq_line(line, iseq)
         else:
-            annotation_list.append(line)
+            yield line
 
         n_queries_read += len(line['unique_ids'])
         if n_max_queries > 0 and n_queries_read >= n_max_queries:
             break
 
-    return annotation_list
-
 # ----------------------------------------------------------------------------------------
 def read_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_implicit_info=False, seed_unique_id=None, cpath=None, skip_annotations=False, glfo=None, debug=False):
     annotation_list = None
@@ -3748,7 +4329,9 @@ def read_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_impli
             with open(fname) as csvfile:
                 for line in csv.DictReader(csvfile):
                     process_input_line(line)
+                    compact_line(line)
                     if not dont_add_implicit_info:
+                        line = LazyLine(line)
                         add_implicit_info(glfo, line)
                     annotation_list.append(line)
                     n_queries_read += 1
@@ -3764,19 +4347,19 @@ def read_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_impli
     return glfo, annotation_list, cpath
 
 # ----------------------------------------------------------------------------------------
-def read_yaml_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_implicit_info=False, seed_unique_id=None, cpath=None, skip_annotations=False, debug=False):
-    with open(fname) as yamlfile:
-        # import yaml
-        # yamlfo = yaml.load(yamlfile, Loader=yaml.CLoader)
-        yamlfo = json.load(yamlfile)  # way tf faster than full yaml (only lost information is ordering in ordered dicts, but that's only per-gene support and germline info, neither of whose order we care much about)
-        if debug:
-            print '  read yaml version %s from %s' % (yamlfo['version-info']['partis-yaml'], fname)
+def read_yaml_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_implicit_info=False, seed_unique_id=None, cpath=None, skip_annotations=False, iterate_annotations=False, debug=False):
+    """ if <iterate_annotations> is set, the returned annotation "list" is instead an iterator that reads (for record-per-line files) each annotation from the file as it goes """
+    yamlfo, events = open_yaml_output(fname)
+    if debug:
+        print '  read yaml version %s from %s' % (yamlfo['version-info']['partis-yaml'], fname)
 
     glfo = yamlfo['germline-info']  # it would probably be good to run the glfo through the checks that glutils.read_glfo() does, but on the other hand since we're reading from our own yaml file, those have almost certainly already been done
 
     annotation_list = None
     if not skip_annotations:  # may not really be worthwhile, but oh well
-        annotation_list = parse_yaml_annotations(glfo, yamlfo, n_max_queries, synth_single_seqs, dont_add_implicit_info)
+        annotation_list = iter_yaml_annotations(glfo, events, n_max_queries=n_max_queries, synth_single_seqs=synth_single_seqs, dont_add_implicit_info=dont_add_implicit_info)
+        if not iterate_annotations:
+            annotation_list = list(annotation_list)
 
     partition_lines = yamlfo['partitions']
     if cpath is None:   # allowing the caller to pass in <cpath> is kind of awkward, but it's used for backward compatibility in clusterpath.readfile()
@@ -11,6 +11,8 @@ from collections import OrderedDict
 import csv
 import numpy
 import traceback
+import hashlib
+import json
 
 import utils
 import glutils
@@ -78,9 +80,10 @@ class Waterer(object):
         self.indel_reruns = set()  # queries that either failed during indel handling, or had successful indel handling: in both cases we rerun them, with a super large gap open to prevent further indels
 
         self.skipped_unproductive_queries, self.kept_unproductive_queries = set(), set()
+        self.unused_cache_lines = []  # lines from the sw cache file that aren't in <self.input_info> (see read_cachefile())
 
-        self.my_gldir = self.args.workdir + '/sw-' + glutils.glfo_dir
-        glutils.write_glfo(self.my_gldir, self.glfo)  # NOTE gets overwritten by read_cachefile()
+        self.glfo_base_dir = self.args.workdir + '/' + glutils.glfo_dir  # shared with the hmm (partitiondriver removes them at the end)
+        self.my_gldir = glutils.get_cached_glfo_dir(self.glfo_base_dir, self.glfo)  # NOTE gets replaced in read_cachefile() (only written if this germline set isn't already there)
 
         if not os.path.exists(self.args.ig_sw_binary):
             raise Exception('ig-sw binary d.n.e: %s' % self.args.ig_sw_binary)
@@ -88,6 +91,12 @@ class Waterer(object):
     # ----------------------------------------------------------------------------------------
     def run(self, cachefname=None):
         start = time.time()
+        processing_start = self.run_sw()
+        self.finalize(cachefname)
+        print '    water time: %.1f  (ig-sw %.1f  processing %.1f)' % (time.time() - start, time.time() - processing_start, self.ig_sw_time)
+
+    # ----------------------------------------------------------------------------------------
+    def run_sw(self):  # run ig-sw on everybody in <self.remaining_queries> (returns the time at which we started processing the output)
         base_infname = 'query-seqs.fa'
         base_outfname = 'query-seqs.sam'
 
@@ -110,8 +119,7 @@ class Waterer(object):
                 break
             itry += 1
 
-        self.finalize(cachefname)
-        print '    water time: %.1f  (ig-sw %.1f  processing %.1f)' % (time.time() - start, time.time() - processing_start, self.ig_sw_time)
+        return processing_start
 
     # ----------------------------------------------------------------------------------------
     def clean_cache(self, cache_path):
@@ -123,8 +131,23 @@ class Waterer(object):
             print '  removing old sw cache glfo %s-glfo' % cache_path
             glutils.remove_glfo_files(cache_path + '-glfo', self.args.locus)
 
+    # ----------------------------------------------------------------------------------------
+    def get_cache_key_base(self):  # everything besides the query sequence that goes into the per-query cache keys, i.e. the germline set and the parameters that affect sw results
+        glstr = json.dumps({k : self.glfo[k] for k in ['seqs'] + [c + '-positions' for c in utils.conserved_codons[self.args.locus].values()]}, sort_keys=True)
+        argstr = repr([self.args.locus, self.match_score, self.vs_info is None, self.gap_open_penalty, self.args.no_indel_gap_open_penalty, self.args.n_max_per_region, self.args.max_vj_mut_freq,
+                       self.args.skip_unproductive, self.args.linearham, self.args.is_data, self.args.dont_remove_framework_insertions, self.args.write_trimmed_and_padded_seqs_to_sw_cachefname])
+        return hashlib.md5(glstr + argstr).hexdigest()
+
+    # ----------------------------------------------------------------------------------------
+    def get_cache_key(self, query, key_base):  # key for <query> in the sw cache file: a hash of its input sequence, plus <key_base> (from get_cache_key_base())
+        return hashlib.md5(key_base + self.input_info[query]['seqs'][0]).hexdigest()
+
     # ----------------------------------------------------------------------------------------
     def read_cachefile(self, cachefname):
+        """
+        Read sw results from <cachefname>, and then (for new-style cache files with per-query keys) run sw on any queries that weren't in it and rewrite the file.
+        Cached annotations are only used if their key (a hash of the sequence, germline set, and sw parameters) matches, so the file can be reused for any input file that shares sequences with it.
+        """
         start = time.time()
         print '        reading sw results from %s' % cachefname
 
@@ -141,22 +164,85 @@ class Waterer(object):
         else:
             raise Exception('unhandled sw cache file suffix %s' % cachefname)
 
-        for line in reader:  # NOTE failed queries are *not* written to the cache file -- they're assumed to be whatever's in input info that's missing
+        key_base = self.get_cache_key_base()  # NOTE has to come after we (maybe) replace <self.glfo> with the one from the cache file
+        query_keys = {q : self.get_cache_key(q, key_base) for q in self.remaining_queries}
+
+        keyed_cache = False  # old cache files don't have per-query keys, in which case we just take whatever's there (and the rest are failures)
+        cached_lines, other_lines, keyless_lines = [], [], []
+        all_duplicates = set()  # uids that any (keyed) line in the file lists as its duplicates, i.e. which have invalid lines because they were removed as duplicates (rather than because they failed)
+        for line in reader:  # NOTE failed queries are *not* written to old-style cache files -- they're assumed to be whatever's in input info that's missing
             if utils.getsuffix(cachefname) == '.csv':
                 utils.process_input_line(line)
+                utils.compact_line(line)
                 for key in [k for k in [r + '_per_gene_support' for r in utils.regions] if k in line]:  # new files shouldn't have this, but I think I need to leave it for reading older files
                     del line[key]
             assert len(line['unique_ids']) == 1  # would only fail if this was not actually an sw cache file, but it's still nice to check since so many places in waterer assume it's length 1
-            if line['unique_ids'][0] not in self.input_info:
+            uid = line['unique_ids'][0]
+            cache_key = line.pop('sw_cache_key', None)
+            if cache_key is None:
+                if uid in query_keys:
+                    keyless_lines.append(line)
                 continue
+            keyed_cache = True
+            if not line['invalid']:
+                all_duplicates |= set(line['duplicates'][0])
+            if uid in query_keys and cache_key == query_keys[uid]:
+                cached_lines.append(line)
+            elif uid not in self.input_info:
+                other_lines.append((cache_key, line))
+            # otherwise it's out of date (i.e. the sequence, germline set, or sw parameters have changed), so we rerun it
+        if not keyed_cache:  # if the file has keys, though, lines without one can't be checked, so we rerun them
+            cached_lines = keyless_lines
+        del keyless_lines
+
+        uncached_queries_by_key = {}  # queries that aren't in the cache file under their own uid, but whose sequence may be there under another one
+        for query in set(query_keys) - set(l['unique_ids'][0] for l in cached_lines):
+            if query_keys[query] not in uncached_queries_by_key:
+                uncached_queries_by_key[query_keys[query]] = []
+            uncached_queries_by_key[query_keys[query]].append(query)
+        self.unused_cache_lines = []  # lines from the cache file that don't correspond to anything in <self.input_info>, which we write back to the file so they're there the next time
+        for cache_key, line in other_lines:
+            if not line['invalid']:
+                del line['seqs']  # added by utils.transfer_indel_reversed_seqs()
+            if not line['invalid'] and len(uncached_queries_by_key.get(cache_key, [])) > 0:  # NOTE invalid lines don't get reused for other uids, since we can't tell if they failed or were removed as duplicates (in which case they wouldn't be in any kept query's duplicates), so we just rerun those queries
+                newline = copy.deepcopy(line)
+                newline['unique_ids'] = [uncached_queries_by_key[cache_key].pop()]
+                newline['duplicates'] = [[]]  # the old ones are uids from some other input file (duplicate removal will find any in this one)
+                utils.transfer_indel_reversed_seqs(newline)
+                cached_lines.append(newline)
+            line['sw_cache_key'] = cache_key  # put the key back, so we can check it the next time we read the file
+            self.unused_cache_lines.append(line)
+
+        cached_invalid = set(l['unique_ids'][0] for l in cached_lines if l.get('invalid', False))  # queries that either failed, or were removed as duplicates, when the cache file was written (so we don't rerun them) NOTE csv cache files don't have 'invalid'
+        cached_invalid &= self.remaining_queries
+        for uids in [[self.args.seed_unique_id], self.args.queries, self.args.queries_to_include]:  # these would've been kept in duplicate removal if they'd been set when the cache file was written
+            if uids is not None:
+                cached_invalid -= set(uids)
+        cached_failures = cached_invalid - all_duplicates  # duplicates only get added back below if the query they're a duplicate of is also cached (otherwise they may not be duplicates any more, so we rerun them)
+        for line in cached_lines:
+            if line.get('invalid', False):
+                continue
+            if keyed_cache:  # only keep duplicates whose own (invalid) line is still in the cache with the right key (if their sequence changed, they may no longer be duplicates, so we rerun them)
+                line['duplicates'] = [[d for d in line['duplicates'][0] if d in cached_invalid]]
+                cached_failures |= set(line['duplicates'][0])
+            line = utils.LazyLine(line)
             utils.add_implicit_info(self.glfo, line, aligned_gl_seqs=self.aligned_gl_seqs)
             if indelutils.has_indels(line['indelfos'][0]):
                 self.info['indels'][line['unique_ids'][0]] = line['indelfos'][0]
             self.add_to_info(line)
 
-        glutils.write_glfo(self.my_gldir, self.glfo)
+        glutils.release_cached_glfo_dir(self.my_gldir)  # <self.glfo> may have changed above
+        self.my_gldir = glutils.get_cached_glfo_dir(self.glfo_base_dir, self.glfo)
 
-        self.finalize(cachefname=None, just_read_cachefile=True)
+        uncached_queries = self.remaining_queries - cached_failures
+        if keyed_cache and len(uncached_queries) > 0:
+            print '        running sw on %d / %d queries missing from sw cache' % (len(uncached_queries), len(self.input_info))
+            self.remaining_queries = uncached_queries
+            self.run_sw()
+            self.remaining_queries |= cached_failures
+            self.finalize(cachefname=cachefname)
+        else:
+            self.finalize(cachefname=None, just_read_cachefile=True)
         print '        water time: %.1f' % (time.time()-start)
 
     # ----------------------------------------------------------------------------------------
@@ -171,11 +257,22 @@ class Waterer(object):
             glutils.write_glfo(cachebase + '-glfo', self.glfo)
 
         # NOTE do _not_ add extra headers here since if they're in the sw cache file I'd have to deal with removing them when I read it
-        # NOTE does *not* write failed queries also
         headers = utils.sw_cache_headers
         if self.args.linearham:
             headers = utils.add_lists(headers, ['flexbounds', 'relpos'])
-        utils.write_annotations(cachefname, self.glfo, [self.info[q]for q in self.info['queries']], headers)
+        if utils.getsuffix(cachefname) == '.csv':  # NOTE does *not* write failed queries also
+            utils.write_annotations(cachefname, self.glfo, [self.info[q] for q in self.info['queries']], headers)
+        else:  # whereas for yaml files we write a per-query key, as well as (invalid) lines for failed queries, so the next time we read it we know which queries we don't need to rerun
+            key_base = self.get_cache_key_base()
+            annotation_list = []
+            for query in self.info['queries']:
+                line = copy.copy(self.info[query])  # NOTE *not* dict(self.info[query], ...), which skips any LazyLine keys that haven't been calculated yet
+                line['sw_cache_key'] = self.get_cache_key(query, key_base)
+                annotation_list.append(line)
+            passed_queries = set(self.info['queries'])
+            failed_queries = [{'unique_ids' : [q], 'invalid' : True, 'input_seqs' : self.input_info[q]['seqs'], 'sw_cache_key' : self.get_cache_key(q, key_base)}
+                              for q in self.input_info if q not in passed_queries]
+            utils.write_annotations(cachefname, self.glfo, annotation_list, headers + ['sw_cache_key'], failed_queries=failed_queries + self.unused_cache_lines)
 
     # ----------------------------------------------------------------------------------------
     def finalize(self, cachefname=None, just_read_cachefile=False):
@@ -251,7 +348,7 @@ class Waterer(object):
             if self.parameter_out_dir is not None and not self.args.dont_write_parameters:
                 pcounter.write(self.parameter_out_dir)
 
-        glutils.remove_glfo_files(self.my_gldir, self.args.locus)
+        glutils.release_cached_glfo_dir(self.my_gldir)
         sys.stdout.flush()
 
     # ----------------------------------------------------------------------------------------
@@ -499,6 +596,16 @@ class Waterer(object):
             del self.info['indels'][query]
         self.info['removed-queries'].add(query)
 
+    # ----------------------------------------------------------------------------------------
+    def remove_queries(self, queries):  # same as remove_query(), but for lots of queries at once (removing them one at a time from self.info['queries'] is quadratic)
+        queries = set(queries)
+        for query in queries:
+            del self.info[query]
+            if query in self.info['indels']:
+                del self.info['indels'][query]
+        self.info['queries'][:] = [q for q in self.info['queries'] if q not in queries]
+        self.info['removed-queries'] |= queries
+
     # ----------------------------------------------------------------------------------------
     def add_dummy_d_match(self, qinfo, first_v_qr_end):
         dummy_d = glutils.dummy_d_genes[self.args.locus]
@@ -1194,19 +1301,52 @@ class Waterer(object):
             #     print '%s reinstated seq not in input sequence:\n    %s\n    %s' % (utils.color('yellow', 'warning'), reinstated_seq, self.input_info[uid]['seqs'][0])
             return return_seq
         # ----------------------------------------------------------------------------------------
+        def add_key_seq(keyseq, uid):
+            seqs_to_keep[keyseq] = [uid]
+            if not self.args.also_remove_duplicate_sequences_with_different_lengths:
+                return
+            cdr3_length = self.info[uid]['cdr3_length']
+            if cdr3_length not in kmer_index:
+                kmer_index[cdr3_length] = {'short' : [], 'kmers' : {}, 'all' : []}
+            kmer_index[cdr3_length]['all'].append(keyseq)
+            if len(keyseq) < kmer_len:
+                kmer_index[cdr3_length]['short'].append(keyseq)
+                return
+            for ipos in range(0, len(keyseq) - kmer_len + 1, kmer_len):  # non-overlapping kmers: enough to find any key contained in a query (via its first kmer), and any key containing a query that's at least 2*kmer_len - 1 long
+                kmer = keyseq[ipos : ipos + kmer_len]
+                if kmer not in kmer_index[cdr3_length]['kmers']:
+                    kmer_index[cdr3_length]['kmers'][kmer] = []
+                kmer_index[cdr3_length]['kmers'][kmer].append(keyseq)
+        # ----------------------------------------------------------------------------------------
+        def get_containment_matches(seq, cdr3_length):  # return the set of key seqs with the same cdr3 length that are sub- or super-strings of <seq>
+            if cdr3_length not in kmer_index:
+                return set()
+            cinfo = kmer_index[cdr3_length]
+            if len(seq) < 2 * kmer_len - 1:  # too short to be sure the index would find everything, so check all the keys
+                candidates = cinfo['all']
+            else:
+                candidates = set(cinfo['short'])
+                for ipos in range(len(seq) - kmer_len + 1):
+                    kmer = seq[ipos : ipos + kmer_len]
+                    if kmer in cinfo['kmers']:
+                        candidates.update(cinfo['kmers'][kmer])
+            return set(kseq for kseq in candidates if seq in kseq or kseq in seq)
+        # ----------------------------------------------------------------------------------------
         def get_key_seq(uid):  # return the sequence which will serve as the key for <uid>
             seq = getseq(uid)
             if not self.args.also_remove_duplicate_sequences_with_different_lengths:  # this is probably significantly slower, otherwise I might make it the default
                 return seq
             else:
-                for kseq, kuids in seqs_to_keep.items():
-                    if self.info[kuids[0]]['cdr3_length'] != self.info[uid]['cdr3_length']:
-                        continue
-                    if seq in kseq or kseq in seq:  # note that this keeps the first one we happen to come across -- it'd be better to keep the longest one, but this is fine for now
-                        if debug:
-                            print '      using keyseq from %s instead of %s' % (kuids, uid)
-                        return kseq
-                return seq  # if we fall through, it didn't match anybody
+                matches = get_containment_matches(seq, self.info[uid]['cdr3_length'])
+                if len(matches) == 0:
+                    return seq  # it didn't match anybody
+                if len(matches) == 1:
+                    kseq = list(matches)[0]
+                else:  # note that this keeps the first one we happen to come across in <seqs_to_keep> -- it'd be better to keep the longest one, but this is fine for now
+                    kseq = next(ks for ks in seqs_to_keep if ks in matches)
+                if debug:
+                    print '      using keyseq from %s instead of %s' % (seqs_to_keep[kseq], uid)
+                return kseq
 
         uids_to_pre_keep = set()  # add these uids/seqs before looping through all the queries
         if self.args.seed_unique_id is not None:
@@ -1220,16 +1360,19 @@ class Waterer(object):
             print 'pre-keeping %s' % ' '.join(uids_to_pre_keep)
             print '  checking pre-keepers'
         seqs_to_keep = {}  # seq : [uids that correspond to seq]
+        kmer_len = 20
+        kmer_index = {}  # cdr3 length : {'kmers' : {kmer : [key seqs with <kmer> at a multiple of <kmer_len>]}, 'short' : [key seqs shorter than <kmer_len>], 'all' : [all key seqs]} (only used with --also-remove-duplicate-sequences-with-different-lengths)
         for utpk in uids_to_pre_keep:
             if utpk not in self.info:
                 print 'requested uid %s not in sw info (probably failed above)' % utpk
                 continue
             keyseq = get_key_seq(utpk)
             if keyseq not in seqs_to_keep:  # NOTE it's kind of weird to have more than one uid for a sequence, but it probably just means the user specified some duplicate sequences with --queries
-                seqs_to_keep[keyseq] = []
+                add_key_seq(keyseq, utpk)
                 if debug:
                     print '      new key for %s' % utpk
-            seqs_to_keep[keyseq].append(utpk)
+            else:
+                seqs_to_keep[keyseq].append(utpk)
             if debug:
                 if len(seqs_to_keep[keyseq]) > 1:
                     print '    add to existing key: %s' % ' '.join(seqs_to_keep[keyseq])
@@ -1237,21 +1380,23 @@ class Waterer(object):
         if debug:
             print '  checking non-pre-kept'
         n_kept, n_removed = len(uids_to_pre_keep), 0
-        for uid in copy.deepcopy(self.info['queries']):
+        uids_to_remove = []
+        for uid in self.info['queries']:
             if uid in uids_to_pre_keep:
                 continue
             keyseq = get_key_seq(uid)
             if keyseq in seqs_to_keep:
                 seqs_to_keep[keyseq].append(uid)
-                self.remove_query(uid)
+                uids_to_remove.append(uid)
                 n_removed += 1
                 if debug:
                     print '    removing %s' % uid
             else:
-                seqs_to_keep[keyseq] = [uid]
+                add_key_seq(keyseq, uid)
                 n_kept += 1
                 if debug:
                     print '    new key for %s' % uid
+        self.remove_queries(uids_to_remove)
 
         for seq, uids in seqs_to_keep.items():
             assert uids[0] in self.info  # the first one should've been the one we kept
@@ -7,6 +7,7 @@ import glob
 import math
 import shutil
 import time
+import platform
 from collections import OrderedDict
 from subprocess import Popen, PIPE, check_call, check_output, CalledProcessError
 import colored_traceback.always
@@ -646,6 +647,163 @@ class Tester(object):
         if n_different_length > 0:
             print utils.color('red', '        %d different length' % n_different_length)
 
+# ----------------------------------------------------------------------------------------
+class Benchmarker(object):
+    """ Run each pipeline stage on simulated samples of fixed sizes, recording wall time, cpu time (including all subprocesses), peak rss, and number of subprocesses, and compare to the history of previous runs on this machine. """
+    # ----------------------------------------------------------------------------------------
+    def __init__(self, args):
+        self.args = args
+        self.partis = './bin/partis'
+        self.stages = utils.get_arg_list(args.benchmark_stages, choices=['simulate', 'sw', 'cache-parameters', 'annotate', 'partition'])
+        self.sizes = utils.get_arg_list(args.benchmark_sizes, intify=True)
+        self.n_procs = args.benchmark_n_procs if args.benchmark_n_procs is not None else utils.auto_n_procs()
+        self.basedir = 'test/new-results/benchmark'
+        self.sim_param_dir = 'test/reference-results/test/parameters/simu'  # parameters for the bundled simulation, which we use to simulate each sample
+        self.n_leaves = 5
+        self.metrics = ['wall', 'cpu', 'max_rss_mb', 'n_subprocs']
+        self.history_headers = ['time', 'host', 'commit', 'stage', 'n_seqs', 'n_procs'] + self.metrics
+        self.min_history = 3  # need at least this many previous runs to say anything about significance
+        self.logfname = self.basedir + '/benchmark.log'
+
+    # ----------------------------------------------------------------------------------------
+    def get_cmd_str(self, stage, n_seqs):
+        sizedir = '%s/%d' % (self.basedir, n_seqs)
+        simfname = sizedir + '/simu.yaml'
+        cmd_str = self.partis + ' ' + (stage if stage != 'sw' else 'cache-parameters')
+        if stage == 'simulate':
+            n_events = int(math.ceil(float(n_seqs) / self.n_leaves))
+            cmd_str += ' --parameter-dir %s --outfname %s --n-sim-events %d --n-trees %d --n-leaves %d --constant-number-of-leaves' % (self.sim_param_dir, simfname, n_events, n_events, self.n_leaves)
+        else:
+            if not os.path.exists(simfname) and not self.args.dry_run:
+                raise Exception('simulation file %s doesn\'t exist (you need to also run the \'simulate\' stage)' % simfname)
+            cmd_str += ' --infname %s --is-simu --n-max-queries %d' % (simfname, n_seqs)
+            cmd_str += ' --parameter-dir %s/parameters%s' % (sizedir, '-sw' if stage == 'sw' else '')  # the sw stage gets its own parameter dir, so its sw cache file doesn't get used by the later stages
+            if stage == 'sw':
+                cmd_str += ' --only-smith-waterman'
+            if stage in ['annotate', 'partition']:
+                cmd_str += ' --outfname %s/%s.yaml' % (sizedir, stage)
+        cmd_str += ' --seed 1 --n-procs %d --simulation-germline-dir data/germlines/human' % self.n_procs
+        return cmd_str
+
+    # ----------------------------------------------------------------------------------------
+    def read_n_forks(self):  # total number of processes created on this machine since boot (so the difference is only meaningful if nothing else is running)
+        with open('/proc/stat') as statfile:
+            for line in statfile:
+                if line.split()[0] == 'processes':
+                    return int(line.split()[1])
+        raise Exception('couldn\'t find number of processes in /proc/stat')
+
+    # ----------------------------------------------------------------------------------------
+    def run_stage(self, stage, n_seqs):
+        cmd_str = self.get_cmd_str(stage, n_seqs)
+        logstr = '%s   %s' % (utils.color('green', '%s %d' % (stage, n_seqs), width=30, padside='right'), cmd_str)
+        print logstr if utils.len_excluding_colors(logstr) < self.args.print_width else logstr[:self.args.print_width] + '[...]'
+        if self.args.dry_run:
+            return None
+        with open(self.logfname, 'a') as logfile:
+            logfile.write(logstr + '\n')
+        n_forks_before = self.read_n_forks()
+        start = time.time()
+        with open(self.logfname, 'a') as logfile:
+            proc = Popen(cmd_str.split(), stdout=logfile, stderr=logfile)
+            _, status, rusage = os.wait4(proc.pid, 0)  # unlike getrusage(), this gives us the usage for just this process (and all of its [waited-for] descendants)
+        wall_time = time.time() - start
+        if status != 0:
+            print '  log tail:'
+            print utils.pad_lines(check_output(['tail', self.logfname]))
+            sys.exit(1)
+        return {'wall' : wall_time,
+                'cpu' : rusage.ru_utime + rusage.ru_stime,
+                'max_rss_mb' : rusage.ru_maxrss / 1024.,  # kb on linux (NOTE this is the max over individual processes, not the total)
+                'n_subprocs' : self.read_n_forks() - n_forks_before - 1}  # don't count the partis process itself
+
+    # ----------------------------------------------------------------------------------------
+    def read_history(self):
+        history = []
+        if not os.path.exists(self.args.benchmark_history):
+            return history
+        with open(self.args.benchmark_history) as histfile:
+            for line in csv.DictReader(histfile):
+                for key in ['n_seqs', 'n_procs']:
+                    line[key] = int(line[key])
+                for key in self.metrics:
+                    line[key] = float(line[key])
+                history.append(line)
+        return history
+
+    # ----------------------------------------------------------------------------------------
+    def write_history(self, new_lines):
+        write_header = not os.path.exists(self.args.benchmark_history)
+        with open(self.args.benchmark_history, 'a') as histfile:
+            writer = csv.DictWriter(histfile, self.history_headers)
+            if write_header:
+                writer.writeheader()
+            for line in new_lines:
+                writer.writerow(line)
+
+    # ----------------------------------------------------------------------------------------
+    def compare_to_history(self, history, new_lines):
+        import scipy.stats
+        print 'comparing to %d previous benchmark results in %s (flagging changes with p < %.3f)' % (len(history), self.args.benchmark_history, self.args.benchmark_significance)
+        print '  %30s   %s' % ('', '   '.join(['%22s' % m for m in self.metrics]))
+        n_regressions = 0
+        for line in new_lines:
+            previous = [hl for hl in history if all(hl[k] == line[k] for k in ['host', 'stage', 'n_seqs', 'n_procs'])]
+            print '  %30s  ' % ('%s %d' % (line['stage'], line['n_seqs'])),
+            for metric in self.metrics:
+                valstr = '%9.1f' % line[metric]
+                if len(previous) < self.min_history:
+                    print '%9s %12s' % (valstr, '(%d prev)' % len(previous)),
+                    continue
+                prevals = numpy.array([hl[metric] for hl in previous])
+                mean, std = numpy.mean(prevals), numpy.std(prevals, ddof=1)
+                if std == 0.:  # e.g. number of subprocs
+                    pval = 0. if line[metric] != mean else 1.
+                else:  # two-sided prediction interval for a new observation from the same (normal) distribution as the previous ones
+                    tval = (line[metric] - mean) / (std * math.sqrt(1. + 1. / len(prevals)))
+                    pval = 2 * scipy.stats.t.sf(abs(tval), len(prevals) - 1)
+                changestr = '%+.2f' % ((line[metric] - mean) / mean if mean != 0. else 0.)
+                if pval < self.args.benchmark_significance:
+                    if line[metric] > mean:
+                        changestr = utils.color('red', changestr, width=12)
+                        n_regressions += 1
+                    else:
+                        changestr = utils.color('green', changestr, width=12)
+                else:
+                    changestr = '%12s' % ('ok' if abs(line[metric] - mean) < 0.5 else changestr)
+                print '%9s %s' % (valstr, changestr),
+            print ''
+        if n_regressions > 0:
+            print '  %s %d significant regression%s' % (utils.color('red', 'warning'), n_regressions, utils.plural(n_regressions))
+
+    # ----------------------------------------------------------------------------------------
+    def run(self):
+        if not os.path.exists(self.basedir):
+            os.makedirs(self.basedir)
+        if not self.args.dry_run:
+            open(self.logfname, 'w').close()
+        try:
+            commit = check_output(['git', 'rev-parse', '--short', 'HEAD']).strip()
+        except CalledProcessError:
+            commit = 'unknown'
+        history = self.read_history()
+        new_lines = []
+        for n_seqs in self.sizes:
+            sizedir = '%s/%d' % (self.basedir, n_seqs)
+            for subdir in ['parameters', 'parameters-sw']:  # start from scratch each time, so cached info from a previous run doesn't affect the times
+                if os.path.exists(sizedir + '/' + subdir) and not self.args.dry_run:
+                    shutil.rmtree(sizedir + '/' + subdir)
+            for stage in self.stages:
+                result = self.run_stage(stage, n_seqs)
+                if result is None:
+                    continue
+                result.update({'time' : time.strftime('%Y-%m-%d %H:%M:%S'), 'host' : platform.node(), 'commit' : commit, 'stage' : stage, 'n_seqs' : n_seqs, 'n_procs' : self.n_procs})
+                new_lines.append(result)
+        if self.args.dry_run:
+            return
+        self.compare_to_history(history, new_lines)
+        self.write_history(new_lines)
+
 # ----------------------------------------------------------------------------------------
 parser = argparse.ArgumentParser()
 parser.add_argument('--dont-run', action='store_true', help='don\'t actually run anything, just check the results')
@@ -660,6 +818,12 @@ parser.add_argument('--print-width', type=int, default=300)
 # example to make comparison plots:
 #   ./bin/compare-plotdirs.py --plotdirs test/reference-results/simu-new-performance/sw:test/new-results/simu-new-performance/sw --names ref:new --outdir $www/partis/tmp/test-plots
 
+parser.add_argument('--benchmark', action='store_true', help='instead of the usual tests, run performance benchmarks: each stage in --benchmark-stages on simulated samples of each size in --benchmark-sizes, comparing wall time, cpu time, peak rss, and number of subprocesses to previous runs on this machine')
+parser.add_argument('--benchmark-sizes', default='1000:10000:100000', help='colon-separated list of sample sizes (number of sequences) for --benchmark')
+parser.add_argument('--benchmark-stages', default='simulate:sw:cache-parameters:annotate:partition', help='colon-separated list of stages to run for --benchmark (simulate generates the input for the others)')
+parser.add_argument('--benchmark-n-procs', type=int, help='number of procs for --benchmark (default: utils.auto_n_procs())')
+parser.add_argument('--benchmark-history', default='test/new-results/benchmark-history.csv', help='csv file with results of previous --benchmark runs (new results are appended)')
+parser.add_argument('--benchmark-significance', type=float, default=0.01, help='p value below which to flag changes compared to the --benchmark-history')
 parser.add_argument('--glfo-dir', default='data/germlines/human')
 parser.add_argument('--locus', default='igh')
 args = parser.parse_args()
@@ -667,6 +831,10 @@ args = parser.parse_args()
 # if not args.quick and not args.only_ref and not args.skip_ref:
 #     print '%s even if you\'re about to bust the cache, there\'s probably not really a reason to be running the ref *and* non-ref stuff' % utils.color('yellow', 'warning')
 
+if args.benchmark:
+    Benchmarker(args).run()
+    sys.exit(0)
+
 tester = Tester()
 if args.bust_cache:
     tester.bust_cache()
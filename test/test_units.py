@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# unit tests for some of the smaller pieces in python/ (the full-pipeline tests are in test/test.py). Run with either ./test/test_units.py or python -m pytest test/test_units.py
+import bz2
+import copy
+import gzip
+import itertools
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy
+partis_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(1, partis_dir + '/python')
+
+import utils
+import clustermetrics
+import seqfileopener
+from clusterpath import ClusterPath, PartitionList
+
+sw_cache_fname = partis_dir + '/test/reference-results/test/parameters/data/sw-cache.yaml'
+simu_fname = partis_dir + '/test/reference-results/test/simu.yaml'
+
+# ----------------------------------------------------------------------------------------
+class TestLazyLine(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.glfo, self.raw_lines, _ = utils.read_yaml_output(sw_cache_fname, n_max_queries=10, dont_add_implicit_info=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    # ----------------------------------------------------------------------------------------
+    def get_lines(self, lazy):
+        lines = []
+        for rawline in copy.deepcopy(self.raw_lines):
+            line = utils.LazyLine(rawline) if lazy else rawline
+            utils.add_implicit_info(self.glfo, line)
+            if lazy:
+                line['stops']  # calculate one group, but leave the rest (e.g. mut_freqs) pending, like after Waterer.add_to_info()
+                self.assertTrue(len(line.pending) > 0)
+            lines.append(line)
+        return lines
+
+    # ----------------------------------------------------------------------------------------
+    def write_and_read(self, lines, basename, extra_headers=None):
+        fname = '%s/%s.yaml' % (self.workdir, basename)
+        utils.write_annotations(fname, self.glfo, lines, utils.sw_cache_headers + (extra_headers if extra_headers is not None else []))
+        _, annotations, _ = utils.read_yaml_output(fname, dont_add_implicit_info=True)
+        return annotations
+
+    # ----------------------------------------------------------------------------------------
+    def test_pending_keys(self):
+        lazyline, eagerline = self.get_lines(True)[0], self.get_lines(False)[0]
+        self.assertEqual(set(lazyline), set(eagerline))
+        self.assertTrue('mut_freqs' in lazyline)
+        self.assertEqual(lazyline['mut_freqs'], eagerline['mut_freqs'])
+        self.assertEqual(lazyline, eagerline)
+
+    # ----------------------------------------------------------------------------------------
+    def test_copy(self):
+        lazyline, eagerline = self.get_lines(True)[0], self.get_lines(False)[0]
+        self.assertEqual(dict(copy.copy(lazyline)), eagerline)
+        self.assertEqual(dict(copy.deepcopy(lazyline)), eagerline)
+
+    # ----------------------------------------------------------------------------------------
+    def test_write_annotations(self):  # this is what Waterer.write_cachefile() does
+        outlines = {}
+        for lazy in [True, False]:
+            lines = []
+            for line in self.get_lines(lazy):
+                line = copy.copy(line)
+                line['sw_cache_key'] = 'x'
+                lines.append(line)
+            outlines[lazy] = self.write_and_read(lines, 'lazy' if lazy else 'eager', extra_headers=['sw_cache_key'])
+        self.assertEqual(outlines[True], outlines[False])
+        self.assertTrue(all('mut_freqs' in l and l['sw_cache_key'] == 'x' for l in outlines[True]))
+
+    # ----------------------------------------------------------------------------------------
+    def test_write_uncopied(self):  # and the LazyLine itself should also be fine
+        self.assertEqual(self.write_and_read(self.get_lines(True), 'lazy'), self.write_and_read(self.get_lines(False), 'eager'))
+
+# ----------------------------------------------------------------------------------------
+class TestPerSeqArrays(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.glfo, self.annotations, _ = utils.read_yaml_output(simu_fname, n_max_queries=50)
+        self.headers = [h for h in utils.annotation_headers if h in self.annotations[0] or h in utils.special_indel_columns_for_output]
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    # ----------------------------------------------------------------------------------------
+    def test_types(self):
+        for line in self.annotations:
+            for key, dtype in utils.per_seq_array_dtypes.items():
+                self.assertTrue(isinstance(line[key], numpy.ndarray) and line[key].dtype == dtype)
+                self.assertEqual(len(line[key]), len(line['unique_ids']))
+
+    # ----------------------------------------------------------------------------------------
+    def test_write_and_read(self):
+        for suffix in ['.yaml', '.csv']:
+            fname = self.workdir + '/annotations' + suffix
+            utils.write_annotations(fname, self.glfo, self.annotations, self.headers)
+            _, reread, _ = utils.read_output(fname, glfo=self.glfo)
+            for line, reline in zip(self.annotations, reread):
+                for key in utils.per_seq_array_dtypes:
+                    self.assertTrue(isinstance(reline[key], numpy.ndarray))
+                    self.assertEqual(line[key].tolist(), reline[key].tolist())
+        yamlfo = utils.get_yamlfo_for_output(self.annotations[0], self.headers)
+        self.assertTrue(all(type(yamlfo[k]) == list for k in utils.per_seq_array_dtypes))
+
+    # ----------------------------------------------------------------------------------------
+    def test_synthesize(self):
+        line = [l for l in self.annotations if len(l['unique_ids']) > 1][0]
+        reco_info = {line['unique_ids'][iseq] : utils.synthesize_single_seq_line(line, iseq) for iseq in range(len(line['unique_ids']))}
+        multiline = utils.synthesize_multi_seq_line_from_reco_info(line['unique_ids'], reco_info)
+        for key in utils.per_seq_array_dtypes:
+            self.assertEqual(line[key].tolist(), multiline[key].tolist())
+        self.assertEqual(line, copy.deepcopy(line))  # make sure comparison works with the arrays
+        self.assertEqual(line, multiline)
+        multiline['mut_freqs'][0] += 0.1
+        self.assertNotEqual(line, multiline)
+
+# ----------------------------------------------------------------------------------------
+class TestClusterMetrics(unittest.TestCase):  # compare the vectorized functions in clustermetrics to the straightforward (slow) implementations that they replaced
+    def setUp(self):
+        self.random = random.Random(1)
+
+    # ----------------------------------------------------------------------------------------
+    def random_partition(self, uids, n_clusters):
+        clusters = [[] for _ in range(n_clusters)]
+        for uid in uids:
+            clusters[self.random.randint(0, n_clusters - 1)].append(uid)
+        return [c for c in clusters if len(c) > 0]
+
+    # ----------------------------------------------------------------------------------------
+    def get_partition_pairs(self, n_pairs=30):
+        pairs = []
+        for _ in range(n_pairs):
+            uids = ['u%d' % i for i in range(self.random.randint(1, 60))]
+            pairs.append((self.random_partition(uids, self.random.randint(1, len(uids))), self.random_partition(uids, self.random.randint(1, len(uids)))))
+        uids = ['u%d' % i for i in range(10)]
+        pairs += [([uids], [uids]), ([[u] for u in uids], [[u] for u in uids]), ([uids], [[u] for u in uids]), ([[u] for u in uids], [uids])]  # edge cases
+        return pairs
+
+    # ----------------------------------------------------------------------------------------
+    def old_ccfs(self, partition, true_partition, reco_ids, seed_unique_id=None):  # the loops from the old utils.new_ccfs_that_need_better_names()
+        mean_clonal_fraction, mean_fraction_present, n_uids = 0., 0., 0
+        for true_cluster in true_partition:
+            if seed_unique_id is not None and seed_unique_id not in true_cluster:
+                continue
+            for uid in true_cluster:
+                if seed_unique_id is not None and uid != seed_unique_id:
+                    continue
+                inferred_cluster = [c for c in partition if uid in c][0]
+                mean_clonal_fraction += float(len([u for u in inferred_cluster if reco_ids[u] == reco_ids[uid]])) / len(inferred_cluster)
+                mean_fraction_present += float(len([u for u in true_cluster if u in inferred_cluster])) / len(true_cluster)
+                n_uids += 1
+        return mean_clonal_fraction / n_uids, mean_fraction_present / n_uids
+
+    # ----------------------------------------------------------------------------------------
+    def brute_ami(self, part_a, part_b):  # formula from (older versions of) sklearn.metrics.cluster.adjusted_mutual_info_score()
+        n_tot = sum(len(c) for c in part_a)
+        sizes_a, sizes_b = [len(c) for c in part_a], [len(c) for c in part_b]
+        if (len(part_a) == len(part_b) == 1):
+            return 1.
+        def entropy(sizes):
+            return -sum(float(s) / n_tot * math.log(float(s) / n_tot) for s in sizes)
+        mi = 0.
+        for ca in part_a:
+            for cb in part_b:
+                nij = len(set(ca) & set(cb))
+                if nij > 0:
+                    mi += float(nij) / n_tot * math.log(float(n_tot) * nij / (len(ca) * len(cb)))
+        emi = 0.
+        for a in sizes_a:
+            for b in sizes_b:
+                for nij in range(max(1, a + b - n_tot), min(a, b) + 1):
+                    lgn = math.lgamma(a + 1) + math.lgamma(b + 1) + math.lgamma(n_tot - a + 1) + math.lgamma(n_tot - b + 1) - math.lgamma(n_tot + 1) - math.lgamma(nij + 1) - math.lgamma(a - nij + 1) - math.lgamma(b - nij + 1) - math.lgamma(n_tot - a - b + nij + 1)
+                    emi += float(nij) / n_tot * math.log(float(n_tot) * nij / (a * b)) * math.exp(lgn)
+        return (mi - emi) / (max(entropy(sizes_a), entropy(sizes_b)) - emi)
+
+    # ----------------------------------------------------------------------------------------
+    def brute_ari(self, part_a, part_b):  # count pairs of uids directly
+        clids_a, clids_b = [{u : i for i, c in enumerate(p) for u in c} for p in (part_a, part_b)]
+        n_both, n_a, n_b, n_pairs = 0, 0, 0, 0
+        for u1, u2 in itertools.combinations(sorted(clids_a), 2):
+            same_a, same_b = clids_a[u1] == clids_a[u2], clids_b[u1] == clids_b[u2]
+            n_both += same_a and same_b
+            n_a += same_a
+            n_b += same_b
+            n_pairs += 1
+        if n_pairs == 0 or n_a == n_b in (0, n_pairs):
+            return 1.
+        expected = float(n_a) * n_b / n_pairs
+        return (n_both - expected) / (0.5 * (n_a + n_b) - expected)
+
+    # ----------------------------------------------------------------------------------------
+    def test_ccfs(self):
+        for partition, true_partition in self.get_partition_pairs():
+            reco_ids = {u : i for i, c in enumerate(true_partition) for u in c}
+            for seed_uid in [None, partition[0][0]]:
+                new_vals = clustermetrics.ccfs(partition, true_partition, reco_ids, seed_unique_id=seed_uid)
+                for new_val, old_val in zip(new_vals, self.old_ccfs(partition, true_partition, reco_ids, seed_unique_id=seed_uid)):
+                    self.assertAlmostEqual(new_val, old_val, places=12)
+                for none_val, new_val in zip(clustermetrics.ccfs(partition, None, reco_ids, seed_unique_id=seed_uid), new_vals):  # None means get the true partition from <reco_ids> (which only differs in the order of the true clusters, so the sums can differ by rounding)
+                    self.assertAlmostEqual(none_val, new_val, places=12)
+
+    # ----------------------------------------------------------------------------------------
+    def test_ccfs_with_duplicates(self):  # seed partitioning can put the seed in several clusters
+        partition = [['s', 'a', 'b'], ['c', 's'], ['d']]
+        true_partition = [['s', 'a', 'c'], ['b', 'd']]
+        reco_ids = {u : i for i, c in enumerate(true_partition) for u in c}
+        self.assertEqual(clustermetrics.ccfs(partition, true_partition, reco_ids, seed_unique_id='s'), self.old_ccfs(partition, true_partition, reco_ids, seed_unique_id='s'))
+
+    # ----------------------------------------------------------------------------------------
+    def test_cluster_labels(self):
+        for part_a, part_b in self.get_partition_pairs():
+            labels_a, labels_b = utils.get_cluster_list_for_sklearn(part_a, part_b)
+            self.assertEqual(labels_a, [i for i, c in enumerate(part_a) for _ in c])
+            self.assertEqual(labels_b, [utils.find_uid_in_partition(u, part_b) for c in part_a for u in c])
+        with self.assertRaises(Exception):
+            utils.get_cluster_list_for_sklearn([['a', 'b']], [['a']])
+        with self.assertRaises(Exception):
+            utils.get_cluster_list_for_sklearn([['a']], [['a', 'b']])
+
+    # ----------------------------------------------------------------------------------------
+    def test_intersection_matrix(self):
+        for part_a, part_b in self.get_partition_pairs():
+            imatrix = clustermetrics.intersection_matrix(part_a, part_b).tolist()
+            self.assertEqual(imatrix, [[len([u for u in ca if u in cb]) for cb in part_b] for ca in part_a])
+
+    # ----------------------------------------------------------------------------------------
+    def test_ami_and_ari(self):
+        for part_a, part_b in self.get_partition_pairs():
+            self.assertAlmostEqual(utils.adjusted_mutual_information(part_a, part_b), self.brute_ami(part_a, part_b), places=10)
+            self.assertAlmostEqual(utils.adjusted_rand_index(part_a, part_b), self.brute_ari(part_a, part_b), places=10)
+
+# ----------------------------------------------------------------------------------------
+class TestIterateFastx(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        rand = random.Random(1)
+        self.seqfos = [{'name' : 'seq-%d' % i, 'seq' : ''.join(rand.choice('ACGT') for _ in range(rand.randint(1, 150))), 'infostrs' : ['seq-%d' % i, 'x=%d' % i, 'y']} for i in range(25)]
+        fastalines, fastqlines = [], []
+        for sfo in self.seqfos:
+            fastalines += ['>%s %s|y' % (sfo['name'], sfo['infostrs'][1])] + [sfo['seq'][i : i + 60].lower() for i in range(0, len(sfo['seq']), 60)]  # multi-line (and lower case) fasta
+            fastqlines += ['@%s %s\ty' % (sfo['name'], sfo['infostrs'][1]), sfo['seq'], '+', 'I' * len(sfo['seq'])]
+        self.fnames = []
+        for suffix, lines in [('.fa', fastalines), ('.fastq', fastqlines)]:
+            text = '\n'.join(lines) + '\n'
+            for compressed_suffix, openfcn in [('', open), ('.gz', gzip.open), ('.bz2', bz2.BZ2File)]:
+                for basename in ['seqs' + suffix, 'seqs-%s.txt' % suffix.lstrip('.')]:  # unrecognized suffix, so the type is figured out from the first line
+                    fname = self.workdir + '/' + basename + compressed_suffix
+                    outfile = openfcn(fname, 'w')
+                    outfile.write(text)
+                    outfile.close()
+                    self.fnames.append(fname)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    # ----------------------------------------------------------------------------------------
+    def test_read(self):
+        for fname in self.fnames:
+            for chunk_size in [None, 7, 100]:
+                self.assertEqual(list(utils.iterate_fastx(fname, chunk_size=chunk_size)), self.seqfos, '%s with chunk size %s' % (fname, chunk_size))
+            self.assertEqual(utils.read_fastx(fname), self.seqfos)
+
+    # ----------------------------------------------------------------------------------------
+    def test_subsets(self):
+        queries = ['seq-3', 'seq-17', 'seq-8']
+        for fname in self.fnames:
+            self.assertEqual(list(utils.iterate_fastx(fname, n_max_queries=5, chunk_size=10)), self.seqfos[:5])
+            self.assertEqual(list(utils.iterate_fastx(fname, istartstop=(4, 9), chunk_size=10)), self.seqfos[4 : 9])
+            self.assertEqual(list(utils.iterate_fastx(fname, queries=queries, chunk_size=10)), [sfo for sfo in self.seqfos if sfo['name'] in queries])
+
+    # ----------------------------------------------------------------------------------------
+    def test_allowed_chars(self):
+        for fname in self.fnames:
+            self.assertEqual(len(list(utils.iterate_fastx(fname, allowed_chars='ACGT'))), len(self.seqfos))
+            with self.assertRaises(Exception):
+                list(utils.iterate_fastx(fname, allowed_chars='ACG'))
+
+    # ----------------------------------------------------------------------------------------
+    def test_skipped_seqs_not_checked(self):  # seqfileopener should only check the alphabet of sequences that it keeps
+        class Args(object):
+            def __getattr__(self, attr):
+                return None
+        fname = self.workdir + '/bad-chars.fa'
+        with open(fname, 'w') as fastafile:
+            fastafile.write('>a\nACGT\n>b\nACGTXXGT\n>c\nACGT\n')
+        args = Args()
+        args.istartstop = [0, 1]
+        self.assertEqual(seqfileopener.read_sequence_file(fname, True, args=args)[0].keys(), ['a'])
+        args = Args()
+        args.queries = ['a', 'c']
+        self.assertEqual(seqfileopener.read_sequence_file(fname, True, args=args)[0].keys(), ['a', 'c'])
+        with self.assertRaises(Exception):
+            seqfileopener.read_sequence_file(fname, True, args=Args())
+
+# ----------------------------------------------------------------------------------------
+class TestHamming(unittest.TestCase):  # compare the numpy hamming functions to the per-character loop that they replaced
+    def setUp(self):
+        rand = random.Random(1)
+        self.seqs = [''.join(rand.choice('ACGTACGTACGTN.-') for _ in range(40)) for _ in range(15)] + ['N' * 40, '-' * 40]
+
+    # ----------------------------------------------------------------------------------------
+    def old_hamming_distance(self, seq1, seq2):
+        skip_chars = set(utils.ambiguous_bases + utils.gap_chars)
+        distance, len_excluding_ambig, mutated_positions = 0, 0, []
+        for ich in range(len(seq1)):
+            if seq1[ich] in skip_chars or seq2[ich] in skip_chars:
+                continue
+            len_excluding_ambig += 1
+            if seq1[ich] != seq2[ich]:
+                distance += 1
+                mutated_positions.append(ich)
+        return distance, len_excluding_ambig, mutated_positions
+
+    # ----------------------------------------------------------------------------------------
+    def old_hamming_fraction(self, seq1, seq2):
+        distance, len_excluding_ambig, _ = self.old_hamming_distance(seq1, seq2)
+        return distance / float(len_excluding_ambig) if len_excluding_ambig > 0 else 0.
+
+    # ----------------------------------------------------------------------------------------
+    def test_pairs(self):
+        min_numpy_length = utils.hamming_min_numpy_length
+        try:
+            for utils.hamming_min_numpy_length in [0, 1000]:  # check both the numpy and the plain loop versions
+                for seq1 in self.seqs:
+                    for seq2 in self.seqs:
+                        old_vals = self.old_hamming_distance(seq1, seq2)
+                        self.assertEqual(utils.hamming_distance(seq1, seq2), old_vals[0])
+                        self.assertEqual(utils.hamming_distance(seq1, seq2, return_len_excluding_ambig=True), old_vals[:2])
+                        self.assertEqual(utils.hamming_distance(seq1, seq2, return_mutated_positions=True), (old_vals[0], old_vals[2]))
+                        self.assertEqual(utils.hamming_distance(seq1, seq2, return_len_excluding_ambig=True, return_mutated_positions=True), old_vals)
+                        self.assertEqual(utils.hamming_fraction(seq1, seq2), self.old_hamming_fraction(seq1, seq2))
+        finally:
+            utils.hamming_min_numpy_length = min_numpy_length
+        self.assertEqual(utils.hamming_distance('', ''), 0)
+        with self.assertRaises(Exception):
+            utils.hamming_distance('ACG', 'AC')
+
+    # ----------------------------------------------------------------------------------------
+    def test_batches(self):
+        old_distances = [[self.old_hamming_distance(s1, s2)[0] for s2 in self.seqs] for s1 in self.seqs]
+        old_fractions = [[self.old_hamming_fraction(s1, s2) for s2 in self.seqs] for s1 in self.seqs]
+        for iseq, seq in enumerate(self.seqs):
+            self.assertEqual(utils.hamming_distances(seq, self.seqs).tolist(), old_distances[iseq])
+            self.assertEqual(utils.hamming_fractions(seq, self.seqs).tolist(), old_fractions[iseq])
+        self.assertEqual(utils.hamming_distance_matrix(self.seqs).tolist(), old_distances)
+        self.assertEqual(utils.hamming_distance_matrix(self.seqs[:3], self.seqs).tolist(), old_distances[:3])
+        numpy.testing.assert_allclose(utils.hamming_fraction_matrix(self.seqs), old_fractions, rtol=0, atol=1e-15)
+
+# ----------------------------------------------------------------------------------------
+class TestPartitionList(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.partitions = [[['a'], ['b'], ['c'], ['d']], [['a', 'b'], ['c'], ['d']], [['a', 'b'], ['c', 'a'], ['d']]]
+        self.cpath = ClusterPath()
+        for ipart, partition in enumerate(self.partitions):
+            self.cpath.add_partition(partition, logprob=float(ipart), n_procs=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    # ----------------------------------------------------------------------------------------
+    def test_round_trip(self):
+        plist = PartitionList()
+        for partition in self.partitions:
+            plist.append(partition)
+        self.assertEqual(list(plist), self.partitions)
+        self.assertEqual(plist[-1], self.partitions[-1])
+        self.assertEqual([plist.n_clusters(i) for i in range(len(plist))], [len(p) for p in self.partitions])
+        self.assertEqual(plist.pop(0), self.partitions[0])
+        self.assertEqual(list(plist), self.partitions[1:])
+
+    # ----------------------------------------------------------------------------------------
+    def test_modify_in_place(self):  # modifying a returned partition shouldn't do anything to the stored one (or to the cached copy)
+        partition = self.cpath.partitions[self.cpath.i_best]
+        partition[:] = [['x']]
+        partition = self.cpath.partitions[self.cpath.i_best]
+        partition[0].append('x')
+        self.assertEqual(self.cpath.partitions[self.cpath.i_best], self.partitions[self.cpath.i_best])
+
+    # ----------------------------------------------------------------------------------------
+    def test_set_and_write(self):  # what PartitionDriver.merge_shared_clusters() does
+        merged_partition = [['d'], ['a', 'b', 'c']]
+        self.cpath.partitions[self.cpath.i_best] = merged_partition
+        self.cpath.partitions[0]  # decode a different one, so the cache no longer has the best partition
+        self.assertEqual(self.cpath.partitions[self.cpath.i_best], merged_partition)
+        for partition_strs in [False, True]:
+            lines = self.cpath.get_partition_lines(True, partition_strs=partition_strs)
+            best_line = [l for l in lines if l['logprob'] == self.cpath.logprobs[self.cpath.i_best]][0]
+            self.assertEqual(best_line['partition'], 'd;a:b:c' if partition_strs else merged_partition)
+        outfname = self.workdir + '/partitions.csv'
+        self.cpath.write(outfname, True)
+        new_cpath = ClusterPath(fname=outfname)
+        self.assertEqual(new_cpath.partitions[new_cpath.i_best], merged_partition)
+        self.assertEqual(list(new_cpath.partitions), self.partitions[:-1] + [merged_partition])
+
+# ----------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()